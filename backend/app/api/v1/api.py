@@ -10,10 +10,22 @@ api_router_v1.include_router(superadmin_auth.router, prefix="/superadmin", tags=
 api_router_v1.include_router(admins.router, prefix="/admins", tags=["SuperAdmin - Admins Management"])
 api_router_v1.include_router(plans.router, prefix="/plans", tags=["SuperAdmin - Plans Management"]) # This is for SA to manage all plans
 
-from .endpoints import superadmin_auth, admins, plans, admin_auth, admin_features, vpn_users, payment
+from .endpoints import superadmin_auth, admins, plans, admin_auth, admin_features, vpn_users, payment, monitoring, exports, imports, nodes
 
 # Admin Endpoints
 api_router_v1.include_router(admin_auth.router, prefix="/admin", tags=["Admin Auth"])
 api_router_v1.include_router(admin_features.router, prefix="/admin", tags=["Admin Features"]) # e.g., viewing active plans for themselves
 api_router_v1.include_router(vpn_users.router, prefix="/admin", tags=["Admin - VPN User Management"]) # Added VPN users router under /admin
 api_router_v1.include_router(payment.router, tags=["Payment"]) # Payment endpoints (some admin, some public callback)
+
+# Panel-wide exports (SuperAdmin only)
+api_router_v1.include_router(exports.router, prefix="/superadmin/exports", tags=["SuperAdmin - Exports"])
+
+# Adopting existing Marzban users (SuperAdmin only)
+api_router_v1.include_router(imports.router, prefix="/superadmin/imports", tags=["SuperAdmin - Imports"])
+
+# Marzban node registry (SuperAdmin only)
+api_router_v1.include_router(nodes.router, prefix="/superadmin/nodes", tags=["SuperAdmin - Marzban Nodes"])
+
+# Monitoring Endpoints (SuperAdmin only)
+api_router_v1.include_router(monitoring.router, prefix="/superadmin/monitoring", tags=["SuperAdmin - Monitoring"])
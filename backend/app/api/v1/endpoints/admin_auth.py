@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 
 from .... import schemas, models
-from ....database import get_db
+from ....database import get_async_db
 from ....security import (
-    verify_password,
+    verify_password_async,
+    PasswordHashingBusy,
     create_access_token,
     ACCESS_TOKEN_EXPIRE_MINUTES,
     get_current_admin # Use the admin-specific dependency
@@ -17,16 +19,28 @@ router = APIRouter()
 @router.post("/login/token", response_model=schemas.Token)
 async def login_admin_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Admin login for token.
     Uses OAuth2PasswordRequestForm, so expects 'username' and 'password'
     in a form-data body.
     """
-    admin_user = db.query(models.Admin).filter(models.Admin.username == form_data.username).first()
+    result = await db.execute(select(models.Admin).where(models.Admin.username == form_data.username))
+    admin_user = result.scalars().first()
 
-    if not admin_user or not verify_password(form_data.password, admin_user.hashed_password):
+    password_ok, new_hash = False, None
+    if admin_user:
+        try:
+            # bcrypt runs on the hashing executor so other requests keep being served meanwhile
+            password_ok, new_hash = await verify_password_async(form_data.password, admin_user.hashed_password)
+        except PasswordHashingBusy:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts in progress. Please retry shortly.",
+                headers={"Retry-After": "1"},
+            )
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password for Admin",
@@ -39,6 +53,11 @@ async def login_admin_for_access_token(
             detail="Admin account is inactive.",
         )
 
+    if new_hash:
+        # Stored hash used outdated settings (e.g. a lower BCRYPT_ROUNDS); upgrade it transparently
+        admin_user.hashed_password = new_hash
+        await db.commit()
+
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": admin_user.username, "type": "admin"}, # "sub" is standard, added "type"
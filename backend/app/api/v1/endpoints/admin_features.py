@@ -1,28 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 
 from .... import schemas, models
-from ....database import get_db
+from ....database import get_async_db
 from ....security import get_current_admin
+from ....services.plan_cache import get_active_plans, cache_control_header
 
 router = APIRouter()
 
 @router.get("/plans", response_model=List[schemas.Plan])
 async def admin_read_active_plans(
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin) # Protected
 ):
     """
     Fetch all active plans. Accessible by authenticated Admins.
+    An empty list is a valid response when no plan is active.
+    The list is served from a cache that plan changes invalidate. Send the returned `ETag`
+    back as `If-None-Match` to get a 304 without a body while the plans are unchanged.
     """
-    active_plans = db.query(models.Plan).filter(models.Plan.is_active == True).all()
-    if not active_plans:
-        # It's not an error if there are no active plans, just return an empty list.
-        # If you want to signal "no content" specifically, you could use status.HTTP_204_NO_CONTENT
-        # but that usually means the response body is empty. Here, an empty list is valid JSON.
-        return []
-    return active_plans
+    etag, body = await get_active_plans(db)
+    headers = {"ETag": etag, "Cache-Control": cache_control_header()}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # More admin-specific, non-CRUD features can be added here later.
 # For example, dashboard summary, account balance, etc.
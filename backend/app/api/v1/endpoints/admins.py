@@ -1,10 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
 from .... import schemas, models # Adjusted import path
 from ....database import get_db
-from ....security import get_password_hash, get_current_super_admin # For protecting these routes
+from ....security import get_password_hash, get_current_super_admin, ACCESS_TOKEN_EXPIRE_MINUTES # For protecting these routes
+from ....services.principal_cache import invalidate_principal, revoke_principal, PRINCIPAL_ADMIN
+from ....pagination import keyset_paginate, set_next_cursor
+from ....services.node_service import is_known_node
+from ....services import ledger_service
 
 router = APIRouter()
 
@@ -27,6 +31,9 @@ def create_admin(
     if db_admin_by_email:
         raise HTTPException(status_code=400, detail="Email already registered")
 
+    if admin_in.marzban_node and not is_known_node(admin_in.marzban_node):
+        raise HTTPException(status_code=400, detail=f"Unknown Marzban node '{admin_in.marzban_node}'.")
+
     hashed_password = get_password_hash(admin_in.password)
 
     # Ensure created_by_super_admin_id is set if provided, otherwise it's null
@@ -35,11 +42,13 @@ def create_admin(
         username=admin_in.username,
         email=admin_in.email,
         hashed_password=hashed_password,
-        balance=admin_in.balance if admin_in.balance is not None else 0.0,
         is_active=admin_in.is_active if admin_in.is_active is not None else True,
+        marzban_node=admin_in.marzban_node,
         created_by_super_admin_id=current_super_admin.id # Associate with the creating SuperAdmin
     )
     db.add(db_admin)
+    db.flush()
+    ledger_service.open_ledger(db, db_admin, opening_balance=admin_in.balance or 0.0)
     db.commit()
     db.refresh(db_admin)
     return db_admin
@@ -60,15 +69,22 @@ def read_admin(
 
 @router.get("/", response_model=List[schemas.Admin])
 def read_admins(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
 ):
     """
     Get a list of all Admins. Only accessible by SuperAdmins.
+    Full pages return an `X-Next-Cursor` header; pass it as `cursor` to get the next page.
     """
-    admins = db.query(models.Admin).offset(skip).limit(limit).all()
+    query = keyset_paginate(db.query(models.Admin), models.Admin.created_at, models.Admin.id, cursor, limit)
+    if not cursor:
+        query = query.offset(skip)
+    admins = query.all()
+    set_next_cursor(response, admins, limit)
     return admins
 
 @router.put("/{admin_id}", response_model=schemas.Admin)
@@ -98,10 +114,26 @@ def update_admin(
         if existing_admin:
             raise HTTPException(status_code=400, detail="Email already taken")
 
+    if update_data.get('marzban_node') and not is_known_node(update_data['marzban_node']):
+        raise HTTPException(status_code=400, detail=f"Unknown Marzban node '{update_data['marzban_node']}'.")
+
+    previous_username = db_admin.username
+    target_balance = update_data.pop('balance', None)
     for field, value in update_data.items():
         setattr(db_admin, field, value)
+    if target_balance is not None:
+        # Setting the balance books the difference, so the ledger still explains every change.
+        # The lock keeps purchases from changing the balance between reading it and booking.
+        difference = ledger_service.to_minor(target_balance) - ledger_service.lock_balance(db, db_admin.id)
+        if difference:
+            db.add(ledger_service.ledger_entry(
+                db_admin.id, difference, ledger_service.KIND_ADJUSTMENT,
+                note=f"Balance set to {target_balance}", created_by_super_admin_id=current_super_admin.id
+            ))
 
     db.commit()
+    # Deactivation, balance changes etc. must reach the auth cache of every worker
+    invalidate_principal(PRINCIPAL_ADMIN, previous_username)
     db.refresh(db_admin)
     return db_admin
 
@@ -124,10 +156,84 @@ def delete_admin(
     # For example, what happens to VPN users owned by this admin?
     # This needs to be defined by business logic. For now, direct delete.
 
+    # The balance ledger is kept for good (see models.BalanceLedgerEntry)
+    has_ledger_entries = db.query(models.BalanceLedgerEntry.id).filter(models.BalanceLedgerEntry.admin_id == admin_id).first()
+    if has_ledger_entries:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Admin has balance history and can't be deleted. Deactivate the admin instead (is_active=false)."
+        )
+
     db.delete(db_admin)
     db.commit()
+    invalidate_principal(PRINCIPAL_ADMIN, db_admin.username)
     return db_admin # Or return {"message": "Admin deleted successfully"}
 
+@router.post("/{admin_id}/revoke-tokens", response_model=schemas.Admin)
+def revoke_admin_tokens(
+    admin_id: int,
+    db: Session = Depends(get_db),
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Log an Admin out everywhere: every access token issued to them so far is rejected
+    (on all workers within a second) and they have to log in again. Only accessible by SuperAdmins.
+    """
+    db_admin = db.query(models.Admin).filter(models.Admin.id == admin_id).first()
+    if not db_admin:
+        raise HTTPException(status_code=404, detail="Admin not found")
+
+    revoke_principal(PRINCIPAL_ADMIN, db_admin.username, token_lifetime_seconds=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+    return db_admin
+
 
 # Note: Changing an admin's password should be handled by a separate, dedicated endpoint
 # for security reasons, which is not implemented in this version.
+
+
+@router.post("/{admin_id}/balance-adjustments", response_model=schemas.BalanceLedgerEntry, status_code=status.HTTP_201_CREATED)
+def adjust_admin_balance(
+    admin_id: int,
+    adjustment_in: schemas.BalanceAdjustment,
+    db: Session = Depends(get_db),
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Credit (positive amount) or debit (negative amount) an Admin's balance. Recorded in the
+    balance ledger with the SuperAdmin and note. Only accessible by SuperAdmins.
+    """
+    db_admin = db.query(models.Admin).filter(models.Admin.id == admin_id).first()
+    if not db_admin:
+        raise HTTPException(status_code=404, detail="Admin not found")
+    amount_minor = ledger_service.to_minor(adjustment_in.amount)
+    if amount_minor == 0:
+        raise HTTPException(status_code=400, detail="Amount must not be zero.")
+
+    entry = ledger_service.ledger_entry(
+        db_admin.id, amount_minor, ledger_service.KIND_ADJUSTMENT,
+        note=adjustment_in.note, created_by_super_admin_id=current_super_admin.id
+    )
+    db.add(entry)
+    db.commit()
+    invalidate_principal(PRINCIPAL_ADMIN, db_admin.username) # Cached principal carries the old balance
+    db.refresh(entry)
+    return entry
+
+@router.get("/{admin_id}/balance-ledger", response_model=List[schemas.BalanceLedgerEntry])
+def read_admin_balance_ledger(
+    admin_id: int,
+    response: Response,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    An Admin's balance ledger, newest first. Only accessible by SuperAdmins.
+    Full pages return an `X-Next-Cursor` header; pass it as `cursor` to get the next page.
+    """
+    entry = models.BalanceLedgerEntry
+    query = keyset_paginate(db.query(entry).filter(entry.admin_id == admin_id), entry.id, entry.id, cursor, limit, descending=True)
+    entries = query.all()
+    set_next_cursor(response, entries, limit, sort_attr="id")
+    return entries
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from typing import Optional
+from datetime import datetime
+
+from .... import schemas, models
+from ....security import get_current_super_admin # For protecting these routes
+from ....services import export_service
+from .vpn_users import filtered_vpn_users_query
+from .payment import filtered_payment_logs_query
+
+router = APIRouter()
+
+# Panel-wide exports for SuperAdmins (e.g. monthly accounting). Admins export their own data
+# via /admin/vpnusers/export and /admin/payments/logs/export.
+
+@router.get("/vpnusers")
+async def export_all_vpn_users(
+    admin_id: Optional[int] = None, # Limit the export to one admin
+    filters: schemas.VpnUserFilters = Depends(),
+    export_format: str = Query("csv", alias="format"),
+    gzip: bool = False,
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Download the VPN users of all admins (or of `admin_id`) as CSV or NDJSON, streamed row by row.
+    """
+    statement = filtered_vpn_users_query(export_service.vpn_users_export_select(), admin_id, filters)
+    try:
+        return export_service.export_response(
+            statement, export_service.VPN_USER_EXPORT_COLUMNS, export_format, "vpn-users", compress=gzip
+        )
+    except export_service.ExportError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@router.get("/payments")
+async def export_all_payment_logs(
+    admin_id: Optional[int] = None, # Limit the export to one admin
+    status_filter: Optional[str] = Query(None, alias="status"),
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    export_format: str = Query("csv", alias="format"),
+    gzip: bool = False,
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Download the payment logs of all admins (or of `admin_id`) as CSV or NDJSON, streamed row by row.
+    """
+    statement = filtered_payment_logs_query(
+        export_service.payment_logs_export_select(), admin_id, status_filter, created_after, created_before
+    )
+    try:
+        return export_service.export_response(
+            statement, export_service.PAYMENT_LOG_EXPORT_COLUMNS, export_format, "payment-logs", compress=gzip
+        )
+    except export_service.ExportError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+import json
+
+from .... import schemas, models
+from ....security import get_current_super_admin # For protecting these routes
+from ....services import import_service, marzban_service
+
+router = APIRouter()
+
+@router.post("/marzban")
+async def import_marzban_users(
+    import_in: schemas.MarzbanImportRequest,
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Adopt users that already exist on Marzban into the panel for one admin (e.g. onboarding a reseller).
+    Defaults to a dry run; send `"dry_run": false` to write. Users already in the panel are left alone,
+    so an interrupted import can simply be run again.
+
+    Streams NDJSON: one line per Marzban page, then a summary line with `"done": true`
+    (or `"done": false` and an `error` if Marzban failed part-way).
+    """
+    try:
+        plans = await import_service.validate_import_request(import_in)
+    except import_service.MarzbanImportError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    async def _stream():
+        try:
+            async for progress in import_service.import_marzban_users(import_in, plans):
+                yield json.dumps(progress) + "\n"
+        except (marzban_service.MarzbanAPIError, import_service.MarzbanImportError) as e:
+            yield json.dumps({"done": False, "error": str(e)}) + "\n"
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
@@ -0,0 +1,121 @@
+from fastapi import APIRouter, Depends
+from typing import Dict, Any
+
+from .... import models
+from ....database import engine, async_engine
+from ....pool_metrics import get_pool_stats
+from ....services.principal_cache import get_principal_cache_stats
+from ....services.marzban_service import get_user_cache_stats, get_client_resilience_stats
+from ....services.outbox_service import get_outbox_stats
+from ....services.enforcement_service import get_enforcement_stats
+from ....services.reconciliation_service import get_reconciliation_stats
+from ....services.payment_service import get_callback_stats
+from ....services.ledger_service import get_ledger_stats
+from ....security import get_current_super_admin, get_password_hashing_stats # For protecting these routes
+
+router = APIRouter()
+
+# Operational statistics for sizing and troubleshooting (SuperAdmin only)
+
+@router.get("/db-pool", response_model=Dict[str, Any])
+async def read_db_pool_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Connection pool statistics of this worker's DB engines: pool size, connections
+    checked out, overflow in use, checkout timeouts and a histogram of checkout wait times.
+    Each gunicorn worker has its own pools, so repeated calls may hit different workers.
+    """
+    stats = {"sync": get_pool_stats(engine, "sync")}
+    if async_engine is not None:
+        stats["async"] = get_pool_stats(async_engine.sync_engine, "async")
+    return stats
+
+
+@router.get("/password-hashing", response_model=Dict[str, Any])
+async def read_password_hashing_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Queue depth and timings of this worker's password hashing executor (logins).
+    A growing `queued` or `avg_wait_ms` means PASSWORD_HASH_WORKERS or BCRYPT_ROUNDS needs tuning.
+    """
+    return get_password_hashing_stats()
+
+
+@router.get("/principal-cache", response_model=Dict[str, Any])
+async def read_principal_cache_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """Size and hit/miss counters of this worker's authenticated principal cache."""
+    return get_principal_cache_stats()
+
+
+@router.get("/marzban-user-cache", response_model=Dict[str, Any])
+async def read_marzban_user_cache_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Size and counters of this worker's Marzban user details cache.
+    `coalesced` counts lookups that joined a request already in flight for the same user.
+    """
+    return get_user_cache_stats()
+
+
+@router.get("/marzban-client", response_model=Dict[str, Any])
+async def read_marzban_client_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    State of this worker's Marzban circuit breaker (closed / open / half_open), retry budget
+    and call bulkhead. `rejected` counts calls refused without asking Marzban.
+    """
+    return get_client_resilience_stats()
+
+
+@router.get("/marzban-outbox", response_model=Dict[str, Any])
+async def read_marzban_outbox_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Queued Marzban mutations by status (shared by all workers) and the earliest next attempt
+    of a pending entry. A growing 'pending' count means Marzban can't keep up or is down.
+    """
+    return await get_outbox_stats()
+
+
+@router.get("/enforcement", response_model=Dict[str, Any])
+async def read_enforcement_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Expiry / quota enforcement: when the last sweep finished (any worker), its watermark and
+    who holds the lease now, plus the counts of the last sweep this worker ran.
+    """
+    return await get_enforcement_stats()
+
+
+@router.get("/payments", response_model=Dict[str, Any])
+async def read_payment_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Payment settlement: pending payments old enough for reconciliation (count and age of the
+    oldest), the last reconciliation pass this worker ran (settled / expired counts, settle
+    latency from payment creation), and how callbacks of this worker were answered.
+    """
+    return {
+        "reconciliation": await get_reconciliation_stats(),
+        "callbacks_in_this_worker": get_callback_stats(),
+    }
+
+
+@router.get("/ledger", response_model=Dict[str, Any])
+async def read_ledger_stats(
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Balance ledger: how many entries balance reads still add on top of the snapshots, and
+    when the snapshots were last refreshed (any worker) and by whom.
+    """
+    return await get_ledger_stats()
@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from typing import List
+
+from .... import schemas, models
+from ....database import get_db
+from ....security import get_current_super_admin # For protecting these routes
+from ....services import node_service
+
+router = APIRouter()
+
+# Marzban node registry (SuperAdmin). Nodes are added by configuration (MARZBAN_NODES) and
+# registered on startup; here their region, capacity and whether they take new users are managed.
+
+def _node_out(db_node: models.MarzbanNode, users_by_node) -> schemas.MarzbanNode:
+    node = schemas.MarzbanNode.from_orm(db_node)
+    node.users = users_by_node.get(db_node.name, 0)
+    node.configured = node_service.is_known_node(db_node.name)
+    return node
+
+@router.get("/", response_model=List[schemas.MarzbanNode])
+def read_nodes(
+    db: Session = Depends(get_db),
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    List the Marzban nodes with the number of VPN users placed on each.
+    See the /superadmin/monitoring/marzban-client endpoint for the health of their connections.
+    """
+    users_by_node = node_service.count_users_by_node(db)
+    return [_node_out(db_node, users_by_node) for db_node in db.query(models.MarzbanNode).order_by(models.MarzbanNode.name).all()]
+
+@router.put("/{name}", response_model=schemas.MarzbanNode)
+def update_node(
+    name: str,
+    node_in: schemas.MarzbanNodeUpdate,
+    db: Session = Depends(get_db),
+    current_super_admin: models.SuperAdmin = Depends(get_current_super_admin) # Protects endpoint
+):
+    """
+    Update a node's region, capacity (max_users, null for no limit) or whether it takes new users.
+    Deactivating a node keeps its users where they are.
+    """
+    db_node = db.query(models.MarzbanNode).filter(models.MarzbanNode.name == name).first()
+    if db_node is None:
+        raise HTTPException(status_code=404, detail="Marzban node not found")
+
+    for field, value in node_in.dict(exclude_unset=True).items():
+        setattr(db_node, field, value)
+    db.commit()
+    db.refresh(db_node)
+    node_service.reset_node_loads()
+    return _node_out(db_node, node_service.count_users_by_node(db))
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Query, Response
 from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
+from typing import List, Optional
 
 from .... import schemas, models
-from ....database import get_db
+from ....database import get_async_db
 from ....security import get_current_admin
+from ....pagination import keyset_paginate, set_next_cursor
 from ....services import zarinpal_service
+from ....services import export_service
+from ....services import payment_service
 import os
 
 router = APIRouter()
@@ -16,7 +21,7 @@ FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:8080")
 @router.post("/admin/payments/request", response_model=schemas.PaymentRequestResponse)
 async def request_payment_url(
     payment_request: schemas.PaymentRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin)
 ):
     """
@@ -42,7 +47,7 @@ async def request_payment_url(
             status='pending'
         )
         db.add(new_log)
-        db.commit()
+        await db.commit()
 
         # Construct the payment URL and return it
         payment_url = zarinpal_service.get_start_pay_url(authority)
@@ -56,75 +61,85 @@ async def request_payment_url(
 @router.get("/payments/zarinpal/callback", include_in_schema=False) # Hide from public API docs
 async def handle_zarinpal_callback(
     request: Request,
-    db: Session = Depends(get_db),
     Status: str = Query(...),
     Authority: str = Query(...)
 ):
     """
     Callback endpoint for Zarinpal to redirect to after payment attempt.
-    This endpoint verifies the payment and updates the admin's balance.
+    This endpoint verifies the payment and updates the admin's balance. Repeated callbacks
+    for the same payment are answered from the recorded outcome without verifying again.
     """
-    # Find the pending payment log using the authority token
-    payment_log = db.query(models.PaymentLog).filter(models.PaymentLog.authority == Authority, models.PaymentLog.status == 'pending').first()
-
-    if not payment_log:
-        # This could happen if the authority is invalid or already processed.
-        # Redirect to a failure page on the frontend.
-        return RedirectResponse(url=f"{FRONTEND_URL}/payment/failed?error=transaction_not_found")
-
-    if Status != 'OK':
-        payment_log.status = 'failed'
-        db.commit()
-        return RedirectResponse(url=f"{FRONTEND_URL}/payment/failed?error=payment_cancelled")
-
     try:
-        # Verify the payment with Zarinpal
-        ref_id = await zarinpal_service.verify_payment(
-            amount=int(payment_log.amount),
-            authority=Authority
-        )
-
-        # Payment is successful
-        payment_log.status = 'completed'
-        payment_log.ref_id = ref_id
-        payment_log.verified_at = datetime.utcnow()
-
-        # Update the admin's balance
-        admin_user = db.query(models.Admin).filter(models.Admin.id == payment_log.admin_id).first()
-        if admin_user:
-            admin_user.balance += payment_log.amount
-
-        db.commit()
-
-        # Redirect to success page on frontend
-        return RedirectResponse(url=f"{FRONTEND_URL}/payment/success?ref_id={ref_id}")
-
-    except zarinpal_service.ZarinpalError as e:
-        payment_log.status = 'failed'
-        db.commit()
-        print(f"Zarinpal verification error: {e.message}")
-        return RedirectResponse(url=f"{FRONTEND_URL}/payment/failed?error=verification_failed&code={e.code}")
+        outcome = await payment_service.process_zarinpal_callback(Authority, Status == 'OK')
     except Exception as e:
-        payment_log.status = 'failed'
-        db.commit()
         print(f"Internal error during callback handling: {str(e)}")
         return RedirectResponse(url=f"{FRONTEND_URL}/payment/failed?error=internal_error")
 
+    if outcome["status"] == payment_service.STATUS_COMPLETED:
+        # Redirect to success page on frontend
+        return RedirectResponse(url=f"{FRONTEND_URL}/payment/success?ref_id={outcome['ref_id']}")
+    url = f"{FRONTEND_URL}/payment/failed?error={outcome['error']}"
+    if "code" in outcome:
+        url += f"&code={outcome['code']}"
+    return RedirectResponse(url=url)
+
+
+def filtered_payment_logs_query(query, admin_id: Optional[int], status_filter: Optional[str] = None,
+                                created_after: Optional[datetime] = None, created_before: Optional[datetime] = None):
+    """Applies the payment log filters to a Select over models.PaymentLog. admin_id=None means all admins."""
+    if admin_id is not None:
+        query = query.where(models.PaymentLog.admin_id == admin_id)
+    if status_filter:
+        query = query.where(models.PaymentLog.status == status_filter)
+    if created_after is not None:
+        query = query.where(models.PaymentLog.created_at >= created_after)
+    if created_before is not None:
+        query = query.where(models.PaymentLog.created_at < created_before)
+    return query
+
+@router.get("/admin/payments/logs/export")
+async def export_admin_payment_logs(
+    current_admin: models.Admin = Depends(get_current_admin),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    export_format: str = Query("csv", alias="format"),
+    gzip: bool = False
+):
+    """
+    Download the current admin's payment history (e.g. one month via created_after/created_before)
+    as CSV or NDJSON, streamed row by row.
+    """
+    statement = filtered_payment_logs_query(
+        export_service.payment_logs_export_select(), current_admin.id, status_filter, created_after, created_before
+    )
+    try:
+        return export_service.export_response(
+            statement, export_service.PAYMENT_LOG_EXPORT_COLUMNS, export_format, "payment-logs", compress=gzip
+        )
+    except export_service.ExportError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 @router.get("/admin/payments/logs", response_model=List[schemas.PaymentLog])
 async def get_admin_payment_logs(
-    db: Session = Depends(get_db),
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin),
     skip: int = 0,
-    limit: int = 20
+    limit: int = 20,
+    cursor: Optional[str] = None
 ):
     """
-    An authenticated admin retrieves their own payment history.
+    An authenticated admin retrieves their own payment history, newest first.
+    Full pages return an `X-Next-Cursor` header; pass it as `cursor` to get the next page.
     """
-    logs = db.query(models.PaymentLog)\
-             .filter(models.PaymentLog.admin_id == current_admin.id)\
-             .order_by(models.PaymentLog.created_at.desc())\
-             .offset(skip)\
-             .limit(limit)\
-             .all()
+    query = keyset_paginate(
+        select(models.PaymentLog).where(models.PaymentLog.admin_id == current_admin.id),
+        models.PaymentLog.created_at, models.PaymentLog.id, cursor, limit, descending=True
+    )
+    if not cursor:
+        query = query.offset(skip)
+    result = await db.execute(query)
+    logs = result.scalars().all()
+    set_next_cursor(response, logs, limit)
     return logs
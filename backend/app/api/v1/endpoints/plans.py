@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
 from .... import schemas, models # Adjusted import path
 from ....database import get_db
 from ....security import get_current_super_admin # For protecting these routes
+from ....pagination import keyset_paginate, set_next_cursor
+from ....services.plan_cache import bump_plans_version
+from ....services.node_service import is_known_node
 
 router = APIRouter()
 
@@ -22,10 +25,13 @@ def create_plan(
     db_plan_by_name = db.query(models.Plan).filter(models.Plan.name == plan_in.name).first()
     if db_plan_by_name:
         raise HTTPException(status_code=400, detail=f"Plan with name '{plan_in.name}' already exists.")
+    if plan_in.marzban_node and not is_known_node(plan_in.marzban_node):
+        raise HTTPException(status_code=400, detail=f"Unknown Marzban node '{plan_in.marzban_node}'.")
 
     db_plan = models.Plan(**plan_in.dict())
     db.add(db_plan)
     db.commit()
+    bump_plans_version()
     db.refresh(db_plan)
     return db_plan
 
@@ -45,8 +51,10 @@ def read_plan(
 
 @router.get("/", response_model=List[schemas.Plan])
 def read_plans(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     # No current_super_admin dependency here if plans are public to view by anyone,
     # or add it if only super admins can see all plans.
@@ -56,8 +64,13 @@ def read_plans(
 ):
     """
     Get a list of all Plans. Only accessible by SuperAdmins via this endpoint.
+    Full pages return an `X-Next-Cursor` header; pass it as `cursor` to get the next page.
     """
-    plans = db.query(models.Plan).offset(skip).limit(limit).all()
+    query = keyset_paginate(db.query(models.Plan), models.Plan.created_at, models.Plan.id, cursor, limit)
+    if not cursor:
+        query = query.offset(skip)
+    plans = query.all()
+    set_next_cursor(response, plans, limit)
     return plans
 
 @router.put("/{plan_id}", response_model=schemas.Plan)
@@ -81,10 +94,14 @@ def update_plan(
         if existing_plan:
             raise HTTPException(status_code=400, detail=f"Plan with name '{update_data['name']}' already exists.")
 
+    if update_data.get('marzban_node') and not is_known_node(update_data['marzban_node']):
+        raise HTTPException(status_code=400, detail=f"Unknown Marzban node '{update_data['marzban_node']}'.")
+
     for field, value in update_data.items():
         setattr(db_plan, field, value)
 
     db.commit()
+    bump_plans_version()
     db.refresh(db_plan)
     return db_plan
 
@@ -112,4 +129,5 @@ def delete_plan(
 
     db.delete(db_plan)
     db.commit()
+    bump_plans_version()
     return db_plan # Or return {"message": "Plan deleted successfully"}
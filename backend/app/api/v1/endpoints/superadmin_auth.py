@@ -1,32 +1,50 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm # Use this for standard login form
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 
 from .... import schemas, models # Adjusted import path
-from ....database import get_db
-from ....security import verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_super_admin
+from ....database import get_async_db
+from ....security import verify_password_async, PasswordHashingBusy, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_super_admin
 
 router = APIRouter()
 
 @router.post("/login/token", response_model=schemas.Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     SuperAdmin login for token.
     Uses OAuth2PasswordRequestForm, so expects 'username' and 'password'
     in a form-data body.
     """
-    super_admin = db.query(models.SuperAdmin).filter(models.SuperAdmin.username == form_data.username).first()
-    if not super_admin or not verify_password(form_data.password, super_admin.hashed_password):
+    result = await db.execute(select(models.SuperAdmin).where(models.SuperAdmin.username == form_data.username))
+    super_admin = result.scalars().first()
+    password_ok, new_hash = False, None
+    if super_admin:
+        try:
+            # bcrypt runs on the hashing executor so other requests keep being served meanwhile
+            password_ok, new_hash = await verify_password_async(form_data.password, super_admin.hashed_password)
+        except PasswordHashingBusy:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts in progress. Please retry shortly.",
+                headers={"Retry-After": "1"},
+            )
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password for SuperAdmin",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+    if new_hash:
+        # Stored hash used outdated settings (e.g. a lower BCRYPT_ROUNDS); upgrade it transparently
+        super_admin.hashed_password = new_hash
+        await db.commit()
+
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": super_admin.username, "type": "super_admin"}, # "sub" is standard for subject (username)
@@ -1,217 +1,708 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Query, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, update, delete, or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Dict, Any, Optional, Set
 from datetime import datetime, timedelta
+import asyncio
+import json
+import os
 
 from .... import schemas, models
-from ....database import get_db
+from ....database import get_async_db, AsyncSessionLocal
 from ....security import get_current_admin
+from ....pagination import keyset_paginate, set_next_cursor, capped_count_query, set_total_count
 from ....services import marzban_service # Assuming marzban_service is in app.services
+from ....services import usage_sync_service
+from ....services import export_service
+from ....services import outbox_service
+from ....services import node_service
+from ....services import ledger_service
+from ....services import enforcement_service
+from ....services import import_service
+from ....services.principal_cache import invalidate_principal, PRINCIPAL_ADMIN
 
 router = APIRouter(
     prefix="/vpnusers", # Prefix for all routes in this router
     tags=["Admin - VPN User Management"]
 )
 
-@router.post("/", response_model=schemas.VpnUser, status_code=status.HTTP_201_CREATED)
+# Batch operations: maximum users per request and concurrent Marzban calls per bulk operation
+VPN_USER_BATCH_MAX_SIZE = int(os.getenv("VPN_USER_BATCH_MAX_SIZE", "500"))
+VPN_USER_BULK_MAX_SIZE = int(os.getenv("VPN_USER_BULK_MAX_SIZE", "5000")) # Bulk delete / reset
+MARZBAN_BATCH_CONCURRENCY = int(os.getenv("MARZBAN_BATCH_CONCURRENCY", "20"))
+
+def _marzban_http_error(e: marzban_service.MarzbanAPIError, context: str) -> HTTPException:
+    """502 for errors from Marzban; 503 + Retry-After when the call was refused without asking it (circuit open)."""
+    if isinstance(e, marzban_service.MarzbanUnavailableError):
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"{context}: {e.detail}",
+                             headers={"Retry-After": str(e.retry_after)})
+    return HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"{context}: {e.detail}")
+
+def _snapshot_details(db_user: models.VpnUser) -> schemas.MarzbanUserDetail:
+    """Marzban details as of the last usage sync."""
+    return schemas.MarzbanUserDetail(
+        username=db_user.marzban_username,
+        status=db_user.status_from_marzban or "unknown",
+        used_traffic=db_user.used_traffic or 0,
+        data_limit=db_user.data_limit or 0,
+        expire=db_user.marzban_expire,
+        subscription_url=db_user.subscription_url,
+        links=None # Raw links are not part of the snapshot; use subscription-info or live=true
+    )
+
+@router.post("/", response_model=schemas.VpnUser, status_code=status.HTTP_202_ACCEPTED)
 async def create_vpn_user(
     vpn_user_in: schemas.VpnUserCreate,
-    db: Session = Depends(get_db),
-    current_admin: models.Admin = Depends(get_current_admin)
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """
     Create a new VPN user for the current admin.
+    The user is stored with provisioning_status 'pending' and created in Marzban in the
+    background (see services/outbox_service.py); poll GET /{marzban_username}/provisioning
+    until it is 'provisioned'. Retrying with the same Idempotency-Key returns the original user.
     """
+    if idempotency_key:
+        idempotency_key = f"{current_admin.id}:{idempotency_key}"
+        entry = await outbox_service.get_entry_by_idempotency_key(db, idempotency_key)
+        if entry is not None:
+            result = await db.execute(
+                select(models.VpnUser).where(models.VpnUser.marzban_username == entry.marzban_username,
+                                             models.VpnUser.admin_id == current_admin.id)
+            )
+            db_user = result.scalars().first()
+            if db_user is None or entry.operation != outbox_service.OP_CREATE_USER:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Idempotency-Key was already used for another request.")
+            return db_user
+
     # 1. Validate Plan
-    plan = db.query(models.Plan).filter(models.Plan.id == vpn_user_in.plan_id, models.Plan.is_active == True).first()
+    result = await db.execute(select(models.Plan).where(models.Plan.id == vpn_user_in.plan_id, models.Plan.is_active == True))
+    plan = result.scalars().first()
     if not plan:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Active plan not found.")
 
     # 2. Check for existing Marzban username in our DB (globally unique for Marzban)
-    existing_db_user = db.query(models.VpnUser).filter(models.VpnUser.marzban_username == vpn_user_in.marzban_username).first()
+    result = await db.execute(select(models.VpnUser.id).where(models.VpnUser.marzban_username == vpn_user_in.marzban_username))
+    existing_db_user = result.first()
     if existing_db_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Username '{vpn_user_in.marzban_username}' already exists in our panel.")
 
-    # (Future: Check admin balance against plan price if payments are implemented)
-
-    # 3. Create user in Marzban
+    # 3. Pick the Marzban node by the placement policy
     try:
-        # Note: marzban_service.add_marzban_user is a placeholder.
-        # Its actual payload and response need to be confirmed with live Marzban API.
-        # For now, it's assumed it takes username, data_limit_gb, and duration_days.
-        # Marzban itself might handle data_limit and expiry differently (e.g. via node settings or subscription params)
-        # The service function should abstract this.
-        marzban_user = await marzban_service.add_marzban_user(
-            username=vpn_user_in.marzban_username,
-            data_limit_gb=plan.data_limit_gb,
-            duration_days=plan.duration_days
-        )
-        # Assuming marzban_user response contains at least 'username'
-        if not marzban_user or marzban_user.get("username") != vpn_user_in.marzban_username:
-             raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Failed to create user in Marzban or Marzban response inconsistent.")
-
-    except marzban_service.MarzbanAPIError as e:
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Marzban API error: {e.detail}")
-    except Exception as e: # Catch any other unexpected errors from the service call
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred with Marzban service: {str(e)}")
-
-
-    # 4. Create user in local database
+        node = await node_service.choose_node(db, current_admin, plan)
+    except node_service.NodePlacementError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    # 4. Reserve the price, create the user locally and queue its creation in Marzban, in one transaction.
+    # The outbox commits the hold once Marzban created the user, or releases it if that fails for good.
+    payload = {"data_limit_gb": plan.data_limit_gb, "duration_days": plan.duration_days, "node": node}
+    if ledger_service.BILLING_ENABLED and plan.price:
+        try:
+            hold = await ledger_service.place_hold(
+                db, current_admin.id, ledger_service.to_minor(plan.price),
+                note=ledger_service.purchase_note(plan, vpn_user_in.marzban_username)
+            )
+        except ledger_service.InsufficientBalanceError as e:
+            raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail=str(e))
+        payload["hold_id"] = hold.id
     db_vpn_user = models.VpnUser(
-        marzban_username=vpn_user_in.marzban_username, # Use the confirmed username from Marzban if it can differ
+        marzban_username=vpn_user_in.marzban_username,
         admin_id=current_admin.id,
         plan_id=plan.id,
         notes=vpn_user_in.notes,
         is_active=True, # Default to active
-        expires_at=datetime.utcnow() + timedelta(days=plan.duration_days) if plan.duration_days > 0 else None
+        expires_at=datetime.utcnow() + timedelta(days=plan.duration_days) if plan.duration_days > 0 else None,
+        provisioning_status="pending",
+        marzban_node=node
     )
     db.add(db_vpn_user)
-    db.commit()
-    db.refresh(db_vpn_user)
+    outbox_service.enqueue(
+        db, outbox_service.OP_CREATE_USER, vpn_user_in.marzban_username, current_admin.id,
+        payload, idempotency_key=idempotency_key
+    )
+    try:
+        await db.commit()
+    except IntegrityError:
+        # A concurrent request took the username (or the Idempotency-Key) first
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username '{vpn_user_in.marzban_username}' is already being created.")
+    outbox_service.notify_outbox()
+    if "hold_id" in payload:
+        invalidate_principal(PRINCIPAL_ADMIN, current_admin.username) # Cached principal carries the old held balance
+    await db.refresh(db_vpn_user)
 
     return db_vpn_user
 
 
+def _expand_batch_usernames(batch_in: schemas.VpnUserBatchCreate) -> List[str]:
+    """Returns the usernames of a batch request, either as given or generated from the prefix pattern."""
+    if batch_in.usernames:
+        return [u.strip() for u in batch_in.usernames if u and u.strip()]
+    if batch_in.username_prefix and batch_in.count:
+        return [
+            f"{batch_in.username_prefix}{str(n).zfill(batch_in.number_width)}"
+            for n in range(batch_in.start, batch_in.start + batch_in.count)
+        ]
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Provide either 'usernames' or 'username_prefix' with 'count'.")
+
+
+@router.post("/batch", response_model=schemas.VpnUserBatchResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_vpn_users_batch(
+    batch_in: schemas.VpnUserBatchCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin)
+):
+    """
+    Create many VPN users on one plan for the current admin.
+    Like the single create, the users are stored with provisioning_status 'pending' and created in
+    Marzban in the background by the outbox: one bulk insert (which skips usernames that already
+    exist), one price hold per stored user and their outbox entries are committed together, so
+    nothing exists in Marzban that the panel doesn't know about. The response reports per user
+    whether it was queued ("created") or why not; poll GET /{marzban_username}/provisioning.
+    The whole batch goes to one node, picked by the placement policy.
+    """
+    result = await db.execute(select(models.Plan).where(models.Plan.id == batch_in.plan_id, models.Plan.is_active == True))
+    plan = result.scalars().first()
+    if not plan:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Active plan not found.")
+
+    usernames = _expand_batch_usernames(batch_in)
+    if not usernames:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The batch contains no usernames.")
+    if len(usernames) > VPN_USER_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A batch can contain at most {VPN_USER_BATCH_MAX_SIZE} users.")
+    if len(set(usernames)) != len(usernames):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The batch contains duplicate usernames.")
+
+    # One query for the uniqueness check of the whole batch
+    result = await db.execute(select(models.VpnUser.marzban_username).where(models.VpnUser.marzban_username.in_(usernames)))
+    existing = set(result.scalars().all())
+
+    try:
+        node = await node_service.choose_node(db, current_admin, plan, count=len(usernames) - len(existing))
+    except node_service.NodePlacementError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    # Store the users, reserve their price and queue their creation in Marzban, in one transaction
+    expires_at = datetime.utcnow() + timedelta(days=plan.duration_days) if plan.duration_days > 0 else None
+    rows = [
+        {
+            "marzban_username": username,
+            "admin_id": current_admin.id,
+            "plan_id": plan.id,
+            "notes": batch_in.notes,
+            "is_active": True,
+            "expires_at": expires_at,
+            "provisioning_status": "pending",
+            "marzban_node": node,
+        }
+        for username in usernames if username not in existing
+    ]
+    # Usernames taken since the uniqueness check (e.g. by a concurrent create) are skipped, not an error
+    inserted = await import_service.insert_vpn_users_ignoring_duplicates(db, rows)
+    queued = [username for username in usernames if username in inserted]
+    payload = {"data_limit_gb": plan.data_limit_gb, "duration_days": plan.duration_days, "node": node}
+    hold_ids: Dict[str, int] = {}
+    if ledger_service.BILLING_ENABLED and plan.price and queued:
+        try:
+            holds = await ledger_service.place_holds(
+                db, current_admin.id, ledger_service.to_minor(plan.price),
+                notes=[ledger_service.purchase_note(plan, username) for username in queued]
+            )
+        except ledger_service.InsufficientBalanceError as e:
+            await db.rollback()
+            raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail=str(e))
+        hold_ids = {username: hold.id for username, hold in zip(queued, holds)}
+    for username in queued:
+        entry_payload = {**payload, "hold_id": hold_ids[username]} if username in hold_ids else payload
+        outbox_service.enqueue(db, outbox_service.OP_CREATE_USER, username, current_admin.id, entry_payload)
+    if queued:
+        await db.commit()
+        outbox_service.notify_outbox()
+    if hold_ids:
+        invalidate_principal(PRINCIPAL_ADMIN, current_admin.username) # Cached principal carries the old held balance
+
+    results = [
+        schemas.VpnUserBatchResult(marzban_username=username, success=True) if username in inserted
+        else schemas.VpnUserBatchResult(marzban_username=username, success=False, detail="Username already exists in our panel.")
+        for username in usernames
+    ]
+    return schemas.VpnUserBatchResponse(
+        requested=len(usernames),
+        created=len(queued),
+        failed=len(usernames) - len(queued),
+        results=results
+    )
+
+
+def _expired_condition():
+    return or_(models.VpnUser.expires_at <= datetime.utcnow(), models.VpnUser.status_from_marzban == "expired")
+
+def _over_limit_condition():
+    return or_(
+        and_(models.VpnUser.data_limit > 0, models.VpnUser.used_traffic >= models.VpnUser.data_limit),
+        models.VpnUser.status_from_marzban == "limited"
+    )
+
+async def _select_owned_users(db: AsyncSession, admin_id: int, action: schemas.VpnUserBulkAction) -> List[Any]:
+    """
+    Resolves a bulk action to the (id, marzban_username, marzban_node) rows owned by the admin, in one query.
+    Only provisioned users: pending ones aren't in Marzban yet (their queued creation would bring
+    them back) and deleting ones are already handled by the outbox.
+    """
+    query = select(models.VpnUser.id, models.VpnUser.marzban_username, models.VpnUser.marzban_node)\
+        .where(models.VpnUser.admin_id == admin_id, models.VpnUser.provisioning_status == "provisioned")
+    if action.usernames:
+        query = query.where(models.VpnUser.marzban_username.in_(action.usernames))
+    elif action.filter == "expired":
+        query = query.where(_expired_condition())
+    elif action.filter == "over_limit":
+        query = query.where(_over_limit_condition())
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Provide 'usernames' or a filter ('expired' or 'over_limit').")
+
+    result = await db.execute(query.limit(VPN_USER_BULK_MAX_SIZE + 1))
+    rows = result.all()
+    if len(rows) > VPN_USER_BULK_MAX_SIZE:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A bulk operation can affect at most {VPN_USER_BULK_MAX_SIZE} users.")
+    return rows
+
+
+# Running bulk actions, referenced so they aren't garbage collected before they finish
+_bulk_jobs: Set[asyncio.Task] = set()
+
+def _bulk_progress_stream(action_name: str, requested: List[str], rows: List[Any], marzban_call, apply_locally):
+    """
+    Streams NDJSON progress for a bulk action: one line per user as its Marzban call finishes,
+    then a summary line. `marzban_call(username, node=...)` runs on all of the users' nodes in
+    parallel, MARZBAN_BATCH_CONCURRENCY at a time per node, and the local rows of all successful
+    users are changed by `await apply_locally(db, ids)` in one transaction (which may queue outbox entries).
+    The work runs in a task of its own, so a client that goes away doesn't leave users changed
+    in Marzban but not in our panel.
+    """
+    id_by_username = {row.marzban_username: row.id for row in rows}
+    node_by_username = {row.marzban_username: row.marzban_node for row in rows}
+    lines: asyncio.Queue = asyncio.Queue()
+
+    async def _run() -> None:
+        succeeded_ids: List[int] = []
+        failed = 0
+
+        # Usernames that were asked for explicitly but don't belong to this admin
+        for username in requested:
+            if username not in id_by_username:
+                failed += 1
+                lines.put_nowait(json.dumps({"marzban_username": username, "success": False,
+                                             "detail": "VPN user not found in your panel, or still being created or deleted."}) + "\n")
+
+        # One semaphore per node: a slow node doesn't use up the concurrency of the others
+        semaphores = {node: asyncio.Semaphore(MARZBAN_BATCH_CONCURRENCY) for node in set(node_by_username.values())}
+
+        async def _call(username: str) -> Dict[str, Any]:
+            node = node_by_username[username]
+            async with semaphores[node]:
+                try:
+                    await marzban_call(username, node=node)
+                    return {"marzban_username": username, "success": True}
+                except marzban_service.MarzbanAPIError as e:
+                    return {"marzban_username": username, "success": False, "detail": f"Marzban API error: {e.detail}"}
+                except Exception as e:
+                    return {"marzban_username": username, "success": False, "detail": f"Unexpected error: {str(e)}"}
+
+        try:
+            for next_result in asyncio.as_completed([_call(username) for username in id_by_username]):
+                result = await next_result
+                if result["success"]:
+                    succeeded_ids.append(id_by_username[result["marzban_username"]])
+                else:
+                    failed += 1
+                lines.put_nowait(json.dumps(result) + "\n")
+        finally:
+            # Even when interrupted (e.g. on shutdown), what Marzban already did is recorded
+            if succeeded_ids:
+                # The request's session may already be closed while streaming, so use our own
+                async with AsyncSessionLocal() as db:
+                    await apply_locally(db, succeeded_ids)
+                    await db.commit()
+                outbox_service.notify_outbox() # In case apply_locally queued Marzban changes
+
+        lines.put_nowait(json.dumps({
+            "done": True,
+            "action": action_name,
+            "requested": len(requested) if requested else len(rows),
+            "succeeded": len(succeeded_ids),
+            "failed": failed
+        }) + "\n")
+
+    async def _run_to_end() -> None:
+        try:
+            await _run()
+        finally:
+            lines.put_nowait(None) # End of the stream, also if the job failed
+
+    async def _stream():
+        job = asyncio.create_task(_run_to_end())
+        _bulk_jobs.add(job)
+        job.add_done_callback(_bulk_jobs.discard)
+        while True:
+            line = await lines.get()
+            if line is None:
+                break
+            yield line
+        await job # Raises the job's error, if any
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+
+@router.post("/bulk/delete")
+async def bulk_delete_vpn_users(
+    action: schemas.VpnUserBulkAction,
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin)
+):
+    """
+    Delete many VPN users, selected by username list or filter, from Marzban and our panel.
+    Progress is streamed as NDJSON, one line per user followed by a summary line.
+    Users already missing in Marzban are deleted locally as well.
+    """
+    rows = await _select_owned_users(db, current_admin.id, action)
+
+    async def _delete_in_marzban(username: str, node: Optional[str] = None) -> None:
+        try:
+            await marzban_service.delete_marzban_user(username, node=node)
+        except marzban_service.MarzbanAPIError as e:
+            if e.status_code != 404: # Already gone in Marzban is fine for a cleanup
+                raise
+
+    async def _delete_locally(session: AsyncSession, ids: List[int]) -> None:
+        await session.execute(
+            delete(models.VpnUser).where(models.VpnUser.id.in_(ids), models.VpnUser.provisioning_status == "provisioned")
+        )
+
+    return _bulk_progress_stream("delete", action.usernames or [], rows, _delete_in_marzban, _delete_locally)
+
+
+@router.post("/bulk/reset-traffic")
+async def bulk_reset_vpn_user_traffic(
+    action: schemas.VpnUserBulkAction,
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin)
+):
+    """
+    Reset traffic for many VPN users, selected by username list or filter.
+    Progress is streamed as NDJSON, one line per user followed by a summary line.
+    Users the enforcement sweep deactivated for their quota are activated again.
+    """
+    rows = await _select_owned_users(db, current_admin.id, action)
+
+    async def _reset_locally(session: AsyncSession, ids: List[int]) -> None:
+        await session.execute(
+            update(models.VpnUser)
+            .where(models.VpnUser.id.in_(ids))
+            .values(updated_at=datetime.utcnow(), used_traffic=0, usage_fingerprint=None)
+        )
+        await enforcement_service.reactivate_after_reset(session, ids)
+
+    return _bulk_progress_stream("reset-traffic", action.usernames or [], rows, marzban_service.reset_marzban_user_traffic, _reset_locally)
+
+
+# sort key -> (column, model attribute for the cursor or None if the column is nullable and
+# can only be paged with skip)
+_VPN_USER_SORT_KEYS = {
+    "created_at": (models.VpnUser.created_at, "created_at"),
+    "username": (models.VpnUser.marzban_username, "marzban_username"),
+    "expires_at": (models.VpnUser.expires_at, None),
+    "used_traffic": (models.VpnUser.used_traffic, None),
+}
+_VPN_USER_STATES = ("active", "inactive", "expired", "over_limit")
+
+def filtered_vpn_users_query(query, admin_id: Optional[int], filters: schemas.VpnUserFilters):
+    """Applies the listing filters to a Select over models.VpnUser. admin_id=None means all admins."""
+    if admin_id is not None:
+        query = query.where(models.VpnUser.admin_id == admin_id)
+    if filters.plan_id is not None:
+        query = query.where(models.VpnUser.plan_id == filters.plan_id)
+    if filters.state == "active":
+        query = query.where(
+            models.VpnUser.is_active.is_(True),
+            or_(models.VpnUser.expires_at.is_(None), models.VpnUser.expires_at > datetime.utcnow())
+        )
+    elif filters.state == "inactive":
+        query = query.where(models.VpnUser.is_active.is_(False))
+    elif filters.state == "expired":
+        query = query.where(_expired_condition())
+    elif filters.state == "over_limit":
+        query = query.where(_over_limit_condition())
+    elif filters.state is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"state must be one of {', '.join(_VPN_USER_STATES)}.")
+    if filters.marzban_status:
+        query = query.where(models.VpnUser.status_from_marzban == filters.marzban_status)
+    if filters.expires_after is not None:
+        query = query.where(models.VpnUser.expires_at >= filters.expires_after)
+    if filters.expires_before is not None:
+        query = query.where(models.VpnUser.expires_at < filters.expires_before)
+    # LIKE patterns are escaped, so '%' and '_' in the input match literally
+    if filters.username_prefix:
+        query = query.where(models.VpnUser.marzban_username.startswith(filters.username_prefix, autoescape=True))
+    if filters.search:
+        query = query.where(models.VpnUser.marzban_username.contains(filters.search, autoescape=True))
+    return query
+
+def _vpn_user_sort(sort: str):
+    """Returns (column, cursor attribute or None, descending) for a sort parameter like "-expires_at"."""
+    descending = sort.startswith("-")
+    key = sort.lstrip("-")
+    if key not in _VPN_USER_SORT_KEYS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"sort must be one of {', '.join(_VPN_USER_SORT_KEYS)} (prefix with '-' for descending).")
+    column, cursor_attr = _VPN_USER_SORT_KEYS[key]
+    return column, cursor_attr, descending
+
 @router.get("/", response_model=List[schemas.VpnUser])
 async def list_admin_vpn_users(
-    db: Session = Depends(get_db),
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin),
+    filters: schemas.VpnUserFilters = Depends(),
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    with_total: bool = False
 ):
     """
-    List all VPN users belonging to the current admin.
+    List the VPN users belonging to the current admin, filtered and sorted on the server
+    (see schemas.VpnUserFilters). Oldest first by default.
+
+    Full pages return an `X-Next-Cursor` header; pass it as `cursor` to get the next page
+    (keyset pagination, `skip` is ignored then). Cursors work with the created_at and
+    username sorts; the other sorts page with `skip`.
+    With `with_total=true` the number of matching users is returned in `X-Total-Count`
+    (a lower bound if `X-Total-Count-Exact` is false).
     """
-    users = db.query(models.VpnUser)\
-              .filter(models.VpnUser.admin_id == current_admin.id)\
-              .offset(skip)\
-              .limit(limit)\
-              .all()
-    return users
+    sort_col, cursor_attr, descending = _vpn_user_sort(filters.sort)
+    filtered = filtered_vpn_users_query(select(models.VpnUser), current_admin.id, filters)
+
+    if cursor_attr:
+        query = keyset_paginate(filtered, sort_col, models.VpnUser.id, cursor, limit, descending=descending)
+    elif cursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cursors are not supported with sort '{filters.sort}', use skip.")
+    else:
+        query = filtered.order_by(sort_col.desc() if descending else sort_col.asc(), models.VpnUser.id).limit(limit)
+    if not cursor:
+        query = query.offset(skip)
+
+    result = await db.execute(query)
+    vpn_users = result.scalars().all()
+    if cursor_attr:
+        set_next_cursor(response, vpn_users, limit, sort_attr=cursor_attr)
+    if with_total:
+        set_total_count(response, (await db.execute(capped_count_query(filtered))).scalar_one())
+    return vpn_users
+
+@router.get("/export")
+async def export_admin_vpn_users(
+    current_admin: models.Admin = Depends(get_current_admin),
+    filters: schemas.VpnUserFilters = Depends(),
+    export_format: str = Query("csv", alias="format"),
+    gzip: bool = False
+):
+    """
+    Download the current admin's VPN users (same filters as the listing) as CSV or NDJSON.
+    Rows are streamed from a server-side cursor, so memory stays flat however many users there are.
+    """
+    statement = filtered_vpn_users_query(export_service.vpn_users_export_select(), current_admin.id, filters)
+    try:
+        return export_service.export_response(
+            statement, export_service.VPN_USER_EXPORT_COLUMNS, export_format, "vpn-users", compress=gzip
+        )
+    except export_service.ExportError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 @router.get("/{marzban_username}", response_model=schemas.VpnUserWithMarzbanDetails)
 async def get_vpn_user_details(
     marzban_username: str,
-    db: Session = Depends(get_db),
-    current_admin: models.Admin = Depends(get_current_admin)
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin),
+    live: bool = False
 ):
     """
-    Get details for a specific VPN user, including live info from Marzban.
+    Get details for a specific VPN user.
+    Usage is served from the local snapshot synced from Marzban while it is fresh
+    (MARZBAN_USAGE_MAX_STALENESS_SECONDS); pass `live=true` to always ask Marzban.
     """
-    db_user = db.query(models.VpnUser)\
-                .filter(models.VpnUser.marzban_username == marzban_username,
-                        models.VpnUser.admin_id == current_admin.id)\
-                .first()
+    result = await db.execute(
+        select(models.VpnUser).where(models.VpnUser.marzban_username == marzban_username,
+                                     models.VpnUser.admin_id == current_admin.id)
+    )
+    db_user = result.scalars().first()
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="VPN user not found in your panel.")
 
     marzban_details_dict = None
-    try:
-        # marzban_user_data = await marzban_service.get_marzban_user_details(marzban_username)
-        # This is a placeholder; real Marzban API might have different structure
-        # For now, creating a mock structure for MarzbanUserDetail schema
-        # In a real scenario, you'd map the actual Marzban response to MarzbanUserDetail
-        raw_marzban_data = await marzban_service.get_marzban_user_details(marzban_username)
-        marzban_details_dict = schemas.MarzbanUserDetail(
-            username=raw_marzban_data.get("username", marzban_username),
-            status=raw_marzban_data.get("status", "unknown"),
-            used_traffic=raw_marzban_data.get("used_traffic", 0),
-            data_limit=raw_marzban_data.get("data_limit", 0),
-            expire=raw_marzban_data.get("expire"),
-            subscription_url=raw_marzban_data.get("subscription_url"),
-            links=raw_marzban_data.get("links", [])
-        )
-
-    except marzban_service.MarzbanAPIError as e:
-        # Log the error but don't fail the whole request if Marzban is down, just return panel data
-        print(f"Could not fetch live details from Marzban for {marzban_username}: {e.detail}")
-    except Exception as e:
-        print(f"Unexpected error fetching live details from Marzban for {marzban_username}: {str(e)}")
+    if db_user.provisioning_status in ("pending", "failed"):
+        pass # Not in Marzban (yet); see /provisioning
+    elif not live and usage_sync_service.is_snapshot_fresh(db_user):
+        marzban_details_dict = _snapshot_details(db_user)
+    else:
+        try:
+            # live=true asks Marzban itself; a stale snapshot may be refreshed from the short-lived cache
+            raw_marzban_data = await marzban_service.get_marzban_user_details(
+                marzban_username, node=db_user.marzban_node, use_cache=not live
+            )
+            marzban_details_dict = schemas.MarzbanUserDetail(
+                username=raw_marzban_data.get("username", marzban_username),
+                status=raw_marzban_data.get("status", "unknown"),
+                used_traffic=raw_marzban_data.get("used_traffic") or 0,
+                data_limit=raw_marzban_data.get("data_limit") or 0,
+                expire=raw_marzban_data.get("expire"),
+                subscription_url=raw_marzban_data.get("subscription_url"),
+                links=raw_marzban_data.get("links", [])
+            )
+
+            # Refresh the snapshot with what we just fetched
+            snapshot = usage_sync_service.snapshot_from_marzban(raw_marzban_data)
+            for field, value in snapshot.items():
+                setattr(db_user, field, value)
+            db_user.usage_fingerprint = usage_sync_service.usage_fingerprint(snapshot)
+            db_user.usage_synced_at = datetime.utcnow()
+            await db.commit()
+            await db.refresh(db_user)
+
+        except marzban_service.MarzbanAPIError as e:
+            # Log the error but don't fail the whole request if Marzban is down, just return panel data
+            # (with the last synced snapshot, however old, if there is one)
+            print(f"Could not fetch live details from Marzban for {marzban_username}: {e.detail}")
+            if db_user.usage_synced_at is not None:
+                marzban_details_dict = _snapshot_details(db_user)
+        except Exception as e:
+            print(f"Unexpected error fetching live details from Marzban for {marzban_username}: {str(e)}")
 
     response_user = schemas.VpnUser.from_orm(db_user)
     return schemas.VpnUserWithMarzbanDetails(**response_user.dict(), marzban_details=marzban_details_dict)
 
 
-@router.delete("/{marzban_username}", status_code=status.HTTP_200_OK) # Or 204 No Content
+@router.delete("/{marzban_username}", status_code=status.HTTP_202_ACCEPTED)
 async def delete_vpn_user(
     marzban_username: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin)
 ):
     """
     Delete a VPN user. This removes the user from Marzban and our panel.
+    The user is marked 'deleting' and disabled right away; the deletion in Marzban (after which
+    the local row is removed) runs in the background. Poll GET /{marzban_username}/provisioning.
     """
-    db_user = db.query(models.VpnUser)\
-                .filter(models.VpnUser.marzban_username == marzban_username,
-                        models.VpnUser.admin_id == current_admin.id)\
-                .first()
+    result = await db.execute(
+        select(models.VpnUser).where(models.VpnUser.marzban_username == marzban_username,
+                                     models.VpnUser.admin_id == current_admin.id)
+    )
+    db_user = result.scalars().first()
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="VPN user not found in your panel.")
 
-    try:
-        await marzban_service.delete_marzban_user(marzban_username)
-    except marzban_service.MarzbanAPIError as e:
-        # Decide on behavior: if Marzban delete fails, do we still delete from our panel?
-        # For now, let's raise an error and not delete from our panel if Marzban fails.
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Marzban API error during delete: {e.detail}")
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred with Marzban service during delete: {str(e)}")
-
-    db.delete(db_user)
-    db.commit()
+    if db_user.provisioning_status == "failed":
+        # Never created in Marzban: nothing to undo there
+        await db.delete(db_user)
+        await db.commit()
+        return {"message": f"VPN user '{marzban_username}' deleted successfully.", "provisioning_status": "deleted"}
+
+    if db_user.provisioning_status != "deleting":
+        # A pending creation is applied first; the outbox keeps one user's operations in order
+        db_user.provisioning_status = "deleting"
+        db_user.is_active = False
+        outbox_service.enqueue(db, outbox_service.OP_DELETE_USER, marzban_username, current_admin.id,
+                               {"node": db_user.marzban_node} if db_user.marzban_node else None)
+        await db.commit()
+        outbox_service.notify_outbox()
 
     # (Future: Sync deletion with Abresani API)
 
-    return {"message": f"VPN user '{marzban_username}' deleted successfully."}
+    return {"message": f"Deletion of VPN user '{marzban_username}' is queued.", "provisioning_status": "deleting"}
+
+
+@router.get("/{marzban_username}/provisioning", response_model=schemas.VpnUserProvisioning)
+async def get_vpn_user_provisioning(
+    marzban_username: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_admin: models.Admin = Depends(get_current_admin)
+):
+    """
+    Provisioning status of a VPN user and its latest queued Marzban operation.
+    'deleted' means the deletion has completed and the user is gone from the panel.
+    """
+    result = await db.execute(
+        select(models.VpnUser.provisioning_status).where(models.VpnUser.marzban_username == marzban_username,
+                                                         models.VpnUser.admin_id == current_admin.id)
+    )
+    provisioning_status = result.scalar()
+    entry = await outbox_service.get_latest_entry(db, marzban_username)
+    if provisioning_status is None:
+        # Only report deletions of this admin's users, not whether a username exists elsewhere
+        if (entry is None or entry.admin_id != current_admin.id
+                or entry.operation != outbox_service.OP_DELETE_USER or entry.status != outbox_service.STATUS_DONE):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="VPN user not found in your panel.")
+        provisioning_status = "deleted"
+    return schemas.VpnUserProvisioning(
+        marzban_username=marzban_username,
+        provisioning_status=provisioning_status,
+        outbox=schemas.MarzbanOutboxEntry.from_orm(entry) if entry else None
+    )
 
 
 @router.post("/{marzban_username}/reset-traffic", response_model=schemas.VpnUserWithMarzbanDetails)
 async def reset_vpn_user_traffic(
     marzban_username: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_admin: models.Admin = Depends(get_current_admin)
 ):
     """
     Reset traffic for a specific VPN user via Marzban.
+    A user the enforcement sweep deactivated for its quota is activated again.
     """
-    db_user = db.query(models.VpnUser)\
-                .filter(models.VpnUser.marzban_username == marzban_username,
-                        models.VpnUser.admin_id == current_admin.id)\
-                .first()
+    result = await db.execute(
+        select(models.VpnUser).where(models.VpnUser.marzban_username == marzban_username,
+                                     models.VpnUser.admin_id == current_admin.id)
+    )
+    db_user = result.scalars().first()
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="VPN user not found in your panel.")
 
     try:
-        # modify_marzban_user with reset_traffic=True calls the /reset endpoint in the service
-        await marzban_service.modify_marzban_user(marzban_username, {"reset_traffic": True})
+        await marzban_service.reset_marzban_user_traffic(marzban_username, node=db_user.marzban_node)
     except marzban_service.MarzbanAPIError as e:
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Marzban API error during traffic reset: {e.detail}")
+        raise _marzban_http_error(e, "Marzban API error during traffic reset")
     except Exception as e:
          raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred with Marzban service during traffic reset: {str(e)}")
 
     # Optionally, update local user's 'updated_at' or a specific field if needed
     db_user.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(db_user)
+    reactivated = await enforcement_service.reactivate_after_reset(db, [db_user.id])
+    await db.commit()
+    if reactivated:
+        outbox_service.notify_outbox()
+    await db.refresh(db_user)
 
     # Fetch updated details to return
-    return await get_vpn_user_details(marzban_username, db, current_admin)
+    return await get_vpn_user_details(marzban_username, db, current_admin, live=True)
 
 
 @router.get("/{marzban_username}/subscription-info", response_model=Dict[str, Any])
 async def get_vpn_user_subscription_info(
     marzban_username: str,
-    db: Session = Depends(get_db), # Not strictly needed if only hitting Marzban, but good for auth
+    db: AsyncSession = Depends(get_async_db), # Not strictly needed if only hitting Marzban, but good for auth
     current_admin: models.Admin = Depends(get_current_admin)
 ):
     """
     Get subscription URL and potentially other link info for a VPN user from Marzban.
     """
     # First, verify the user belongs to this admin in our DB, even if we only fetch from Marzban
-    db_user = db.query(models.VpnUser)\
-                .filter(models.VpnUser.marzban_username == marzban_username,
-                        models.VpnUser.admin_id == current_admin.id)\
-                .first()
+    result = await db.execute(
+        select(models.VpnUser).where(models.VpnUser.marzban_username == marzban_username,
+                                     models.VpnUser.admin_id == current_admin.id)
+    )
+    db_user = result.scalars().first()
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="VPN user not found in your panel.")
 
@@ -219,7 +710,7 @@ async def get_vpn_user_subscription_info(
         # This placeholder function in marzban_service currently just calls get_marzban_user_details
         # and extracts 'subscription_url'. A more direct Marzban endpoint might exist.
         # The get_marzban_user_details returns a dict, let's use that.
-        user_marzban_data = await marzban_service.get_marzban_user_details(marzban_username)
+        user_marzban_data = await marzban_service.get_marzban_user_details(marzban_username, node=db_user.marzban_node)
 
         subscription_url = user_marzban_data.get("subscription_url")
         raw_links = user_marzban_data.get("links", []) # List of individual proxy links
@@ -234,7 +725,15 @@ async def get_vpn_user_subscription_info(
             # Frontend can generate QR code from subscription_url
         }
     except marzban_service.MarzbanAPIError as e:
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Marzban API error getting subscription info: {e.detail}")
+        if e.status_code >= 500 and db_user.subscription_url:
+            # Marzban is down or the breaker is open: the synced subscription URL is still valid for QR codes
+            return {
+                "marzban_username": marzban_username,
+                "subscription_url": db_user.subscription_url,
+                "raw_links": [],
+                "from_snapshot": True
+            }
+        raise _marzban_http_error(e, "Marzban API error getting subscription info")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"An unexpected error occurred with Marzban service: {str(e)}")
 
@@ -1,13 +1,17 @@
 from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.orm import Session
 import os
 from dotenv import load_dotenv
 
 from .database import engine, Base, get_db, SessionLocal
 from . import models # Import models to ensure they are registered with Base
+from . import metrics
+from .schema_upgrade import upgrade_schema
 from .api.v1.api import api_router_v1 # Import the v1 API router
-from .security import get_password_hash # For initial super admin creation
+from .security import get_password_hash, shutdown_password_executor # For initial super admin creation
 from .schemas import SuperAdminCreate # For initial super admin creation
+from .services import marzban_service, usage_sync_service, outbox_service, node_service, enforcement_service, reconciliation_service, ledger_service
 
 load_dotenv()
 
@@ -16,6 +20,9 @@ load_dotenv()
 try:
     Base.metadata.create_all(bind=engine)
     print("Database tables created successfully (if they didn't exist).")
+    added_columns = upgrade_schema(engine, Base.metadata)
+    if added_columns:
+        print(f"Added columns to existing tables: {', '.join(added_columns)}")
 except Exception as e:
     print(f"Error creating database tables: {e}")
 
@@ -30,6 +37,10 @@ app = FastAPI(
 # Include the v1 router
 app.include_router(api_router_v1, prefix="/api/v1")
 
+# Request latency by route template and status, plus the DB time of each request (see /metrics)
+if metrics.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 
 @app.on_event("startup")
 async def startup_event():
@@ -65,6 +76,51 @@ async def startup_event():
     finally:
         db.close()
 
+    # Registry rows for the configured Marzban nodes (region, capacity, active flag)
+    db = SessionLocal()
+    try:
+        node_service.sync_node_registry(db)
+    except Exception as e:
+        print(f"Error during Marzban node registration: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    # Balance ledgers for admins that don't have one yet (carrying over their old balance)
+    db = SessionLocal()
+    try:
+        ledger_service.open_ledgers(db)
+    except Exception as e:
+        print(f"Error while opening balance ledgers: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    # One pooled HTTP client per Marzban node and worker, reused by all calls to that node
+    await marzban_service.init_marzban_clients()
+    # Keep the local usage snapshot in sync with Marzban in the background
+    usage_sync_service.start_usage_sync()
+    # Apply queued Marzban mutations (user creation / deletion) in the background
+    outbox_service.start_outbox_worker()
+    # Deactivate expired and over-quota users (one worker across all hosts per sweep)
+    enforcement_service.start_enforcement()
+    reconciliation_service.start_reconciliation()
+    ledger_service.start_snapshot_refresh()
+    # Share this worker's metrics with the worker that answers the next scrape
+    metrics.start_metrics_flush()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await usage_sync_service.stop_usage_sync()
+    await enforcement_service.stop_enforcement()
+    await reconciliation_service.stop_reconciliation()
+    await ledger_service.stop_snapshot_refresh()
+    await outbox_service.stop_outbox_worker()
+    await marzban_service.close_marzban_clients()
+    await metrics.stop_metrics_flush()
+    shutdown_password_executor()
+
 
 @app.get("/")
 async def root():
@@ -74,3 +130,10 @@ async def root():
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
+
+# Prometheus scrape endpoint. Not proxied by nginx (only /api is): scrape 127.0.0.1:8000/metrics
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,317 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+# Prometheus metrics, served in the text format on /metrics (not proxied by nginx, scrape the
+# backend port from the host). Each worker counts in memory; with several gunicorn workers set
+# METRICS_MULTIPROC_DIR so every worker writes its counts there and /metrics sums all of them.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "") # Empty: per-process metrics only
+METRICS_FLUSH_INTERVAL_SECONDS = float(os.getenv("METRICS_FLUSH_INTERVAL_SECONDS", "10")) # Staleness of the other workers' counts
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+UNMATCHED_ROUTE = "<unmatched>" # 404s etc.: one series instead of one per requested path
+
+
+class Histogram:
+    """A Prometheus histogram with labels. Thread-safe: sync endpoints run in a threadpool."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> per-bucket counts (last one is +Inf, not cumulative) followed by the sum
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def dump(self) -> Dict[str, List[float]]:
+        with self._lock:
+            return {json.dumps(labels): list(series) for labels, series in self._series.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def render(self, series: Dict[str, List[float]]) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key in sorted(series):
+            values = series[key]
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, json.loads(key))]
+            cumulative = 0
+            for bound, count in zip([_format(b) for b in self.buckets] + ["+Inf"], values[:-1]):
+                cumulative += count
+                bucket_labels = ",".join(labels + ['le="%s"' % bound])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {_format(cumulative)}")
+            selector = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{selector} {_format(values[-1])}")
+            lines.append(f"{self.name}_count{selector} {_format(cumulative)}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to answer an HTTP request, by route template and status.",
+    ("method", "route", "status"), LATENCY_BUCKETS,
+)
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries run while answering an HTTP request.",
+    ("method", "route"), QUERY_COUNT_BUCKETS,
+)
+HTTP_REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent in database queries while answering an HTTP request.",
+    ("method", "route"), LATENCY_BUCKETS,
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Time of single database queries (requests and background jobs), by engine.",
+    ("engine",), QUERY_LATENCY_BUCKETS,
+)
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds", "Time of calls to Marzban and Zarinpal (including retries), by outcome.",
+    ("upstream", "operation", "node", "outcome"), LATENCY_BUCKETS,
+)
+
+_histograms = [HTTP_REQUEST_DURATION, HTTP_REQUEST_DB_QUERIES, HTTP_REQUEST_DB_SECONDS, DB_QUERY_DURATION, UPSTREAM_REQUEST_DURATION]
+
+# Queries and query time of the current HTTP request. A mutable list, so queries run in the
+# threadpool (sync endpoints, which get a copy of the context) still add to the request's totals.
+_request_db_usage: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("request_db_usage", default=None)
+
+
+# --- Collection ---
+
+@contextmanager
+def observe_upstream(upstream: str, operation: str, node: str = "") -> Iterator[None]:
+    """
+    Times a call to an external service. The outcome label is "ok", the error's status_code
+    (Marzban) or code (Zarinpal), "error" for other exceptions and "cancelled".
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome = str(getattr(e, "status_code", getattr(e, "code", "error")))
+        raise
+    finally:
+        if METRICS_ENABLED:
+            UPSTREAM_REQUEST_DURATION.observe(time.perf_counter() - started, upstream, operation, node, outcome)
+
+def observed_upstream(upstream: str, operation: str):
+    """Decorator form of observe_upstream() for async functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with observe_upstream(upstream, operation):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_engine(engine, label: str) -> None:
+    """Times every query of a (sync) engine; for an AsyncEngine pass its .sync_engine."""
+    if not METRICS_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _record_query(conn, label)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        if exception_context.connection is not None:
+            _record_query(exception_context.connection, label)
+
+def _record_query(conn, label: str) -> None:
+    started = conn.info.get("metrics_query_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    DB_QUERY_DURATION.observe(elapsed, label)
+    usage = _request_db_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, status and database usage of every HTTP request,
+    labelled with the route template (e.g. /api/v1/admin/vpnusers/{vpn_user_id}) rather than the path.
+    Plain ASGI instead of BaseHTTPMiddleware, so streamed responses (exports) pass through unbuffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._templates: Optional[Dict[Any, str]] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        usage = [0, 0.0]
+        token = _request_db_usage.set(usage)
+        status = "500" # If the app raises before answering
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_db_usage.reset(token)
+            method, route = scope["method"], self._route_template(scope)
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, method, route, status)
+            HTTP_REQUEST_DB_QUERIES.observe(usage[0], method, route)
+            HTTP_REQUEST_DB_SECONDS.observe(usage[1], method, route)
+
+    def _route_template(self, scope) -> str:
+        # The router leaves the matched endpoint in the scope
+        endpoint = scope.get("endpoint")
+        if endpoint is None or "app" not in scope:
+            return UNMATCHED_ROUTE
+        if self._templates is None:
+            templates: Dict[Any, str] = {}
+            for route in scope["app"].routes:
+                if hasattr(route, "endpoint") and hasattr(route, "path_format"):
+                    templates.setdefault(route.endpoint, route.path_format)
+            self._templates = templates
+        return self._templates.get(endpoint, UNMATCHED_ROUTE)
+
+
+# --- Exposition ---
+
+def _worker_file() -> str:
+    return os.path.join(METRICS_MULTIPROC_DIR, f"worker-{os.getpid()}.json")
+
+def flush_metrics() -> None:
+    """Writes this worker's counts to METRICS_MULTIPROC_DIR (atomically: readers never see half a file)."""
+    if not METRICS_MULTIPROC_DIR:
+        return
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    data = {histogram.name: histogram.dump() for histogram in _histograms}
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_MULTIPROC_DIR, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, _worker_file())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _collect() -> Dict[str, Dict[str, List[float]]]:
+    """This worker's counts, or the sum over all workers' files in multiprocess mode."""
+    if not METRICS_MULTIPROC_DIR:
+        return {histogram.name: histogram.dump() for histogram in _histograms}
+    flush_metrics()
+    merged: Dict[str, Dict[str, List[float]]] = {histogram.name: {} for histogram in _histograms}
+    for filename in os.listdir(METRICS_MULTIPROC_DIR):
+        if not filename.startswith("worker-"):
+            continue
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, filename)) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping unreadable metrics file {filename}: {e}")
+            continue
+        # Files of exited workers are kept, so counters never go backwards while the service runs
+        for name, series in data.items():
+            if name not in merged:
+                continue
+            for key, values in series.items():
+                total = merged[name].get(key)
+                if total is None or len(total) != len(values):
+                    merged[name][key] = list(values)
+                else:
+                    merged[name][key] = [a + b for a, b in zip(total, values)]
+    return merged
+
+def render_metrics() -> str:
+    collected = _collect()
+    lines: List[str] = []
+    for histogram in _histograms:
+        lines.extend(histogram.render(collected[histogram.name]))
+    return "\n".join(lines) + "\n"
+
+def reset_metrics() -> None:
+    """Forgets this worker's counts (tests)."""
+    for histogram in _histograms:
+        histogram.clear()
+
+
+_flush_task: Optional[asyncio.Task] = None
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL_SECONDS)
+        try:
+            flush_metrics()
+        except OSError as e:
+            print(f"Writing metrics to {METRICS_MULTIPROC_DIR} failed: {e}")
+
+def start_metrics_flush() -> None:
+    """Starts writing this worker's counts for the other workers' /metrics. Called on app startup."""
+    global _flush_task
+    if not METRICS_ENABLED or not METRICS_MULTIPROC_DIR or (_flush_task and not _flush_task.done()):
+        return
+    _flush_task = asyncio.create_task(_flush_loop())
+
+async def stop_metrics_flush() -> None:
+    """Stops the flush loop and writes the final counts. Called on app shutdown."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    if METRICS_ENABLED and METRICS_MULTIPROC_DIR:
+        try:
+            flush_metrics()
+        except OSError as e:
+            print(f"Writing metrics to {METRICS_MULTIPROC_DIR} failed: {e}")
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Boolean, Text, Index, DDL, event, UniqueConstraint, select, cast
+from sqlalchemy.orm import relationship, column_property
 from sqlalchemy.sql import func # For server-side default timestamp
 from .database import Base
 
@@ -21,8 +21,12 @@ class Admin(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     email = Column(String, unique=True, index=True, nullable=False)
-    balance = Column(Float, default=0.0)
+    # Balance before the ledger existed; only read once to open the admin's ledger (ledger_service.open_ledgers).
+    # The balance itself is balance_minor below.
+    legacy_balance = Column("balance", Float, default=0.0)
     is_active = Column(Boolean, default=True)
+    # Node this admin's new users go to under the 'by_admin' placement policy (None: least loaded)
+    marzban_node = Column(String, ForeignKey("marzban_nodes.name"), nullable=True)
     created_by_super_admin_id = Column(Integer, ForeignKey("super_admins.id")) # Optional: link to creating super_admin
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -32,6 +36,16 @@ class Admin(Base):
     vpn_users = relationship("VpnUser", back_populates="owner_admin", cascade="all, delete-orphan")
     payment_logs = relationship("PaymentLog", back_populates="admin", cascade="all, delete-orphan")
 
+    @property
+    def balance(self) -> float:
+        """The balance in currency units, as loaded with the row."""
+        return (self.balance_minor or 0) / BALANCE_MINOR_UNITS
+
+    @property
+    def held_balance(self) -> float:
+        """Reserved for purchases in progress; not available for new ones."""
+        return (self.held_minor or 0) / BALANCE_MINOR_UNITS
+
 
 class Plan(Base):
     __tablename__ = "plans"
@@ -42,6 +56,25 @@ class Plan(Base):
     duration_days = Column(Integer, nullable=False) # Duration in days
     data_limit_gb = Column(Float, nullable=False) # Data limit in GB
     is_active = Column(Boolean, default=True)
+    # Node this plan's new users go to under the 'by_plan' placement policy (None: least loaded)
+    marzban_node = Column(String, ForeignKey("marzban_nodes.name"), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class MarzbanNode(Base):
+    """
+    A Marzban panel users can be placed on. URLs and credentials stay in the environment
+    (MARZBAN_API_BASE_URL / MARZBAN_NODES); a row per configured node is created on startup
+    and holds what the SuperAdmin manages: region, capacity and whether it takes new users.
+    """
+    __tablename__ = "marzban_nodes"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True, nullable=False) # As in the configuration
+    region = Column(String, nullable=True)
+    max_users = Column(Integer, nullable=True) # None: no limit
+    is_active = Column(Boolean, default=True, nullable=False) # False: keeps its users, gets no new ones
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -88,8 +121,13 @@ class VpnUser(Base):
 
     abresani_user_id = Column(String, unique=True, index=True, nullable=True) # For Abresani integration
 
+    # Marzban node the user lives on; None for users created before multi-node support (default node)
+    marzban_node = Column(String, ForeignKey("marzban_nodes.name"), index=True, nullable=True)
+
     is_active = Column(Boolean, default=True) # Overall status in our panel
-    # status_from_marzban = Column(String, nullable=True) # e.g., "active", "disabled", "expired", "limited" from Marzban
+    # Why the enforcement sweep deactivated the user ("expired" or "over_quota"); None otherwise.
+    # Resetting the traffic of a user deactivated for its quota activates it again.
+    disabled_reason = Column(String, nullable=True)
 
     # Dates
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -98,17 +136,50 @@ class VpnUser(Base):
     # For simplicity, let's store it, calculated at creation time.
     expires_at = Column(DateTime(timezone=True), nullable=True)
 
-    # Usage data (can be periodically synced from Marzban)
-    # used_traffic_up = Column(BigInteger, default=0) # Bytes
-    # used_traffic_down = Column(BigInteger, default=0) # Bytes
-    # data_limit_from_plan = Column(BigInteger, default=0) # Bytes, denormalized from plan for snapshot
+    # Usage snapshot, periodically synced from Marzban in bulk (see services/usage_sync_service.py)
+    status_from_marzban = Column(String, nullable=True) # e.g., "active", "disabled", "expired", "limited" from Marzban
+    used_traffic = Column(BigInteger, nullable=True) # Bytes
+    data_limit = Column(BigInteger, nullable=True) # Bytes, 0 or None means unlimited
+    marzban_expire = Column(BigInteger, nullable=True) # Expiry timestamp as reported by Marzban
+    subscription_url = Column(String, nullable=True)
+    usage_synced_at = Column(DateTime(timezone=True), nullable=True) # When the snapshot was last written
+    usage_fingerprint = Column(String(40), nullable=True) # Hash of the snapshot fields, to skip unchanged rows
+    usage_checked_at = Column(DateTime(timezone=True), nullable=True) # When a sync last saw the user in Marzban, changed or not
 
     notes = Column(String, nullable=True) # Admin notes for this user
 
+    # Where the user stands in Marzban: 'pending' (creation queued in the outbox), 'provisioned',
+    # 'deleting' (deletion queued) or 'failed' (the outbox gave up, see marzban_outbox.last_error)
+    provisioning_status = Column(String, default="provisioned", server_default="provisioned", nullable=False)
+
     # Relationships
     owner_admin = relationship("Admin", back_populates="vpn_users")
     plan = relationship("Plan") # No back_populates needed if Plan doesn't need to list VpnUsers directly often
 
+    __table_args__ = (
+        # Serves the per-admin listing in (created_at, id) order and its keyset cursors
+        Index("ix_vpn_users_admin_created_id", "admin_id", "created_at", "id"),
+        # Listing filters and sorts (plan, expiry window, username prefix / username order)
+        Index("ix_vpn_users_admin_plan", "admin_id", "plan_id"),
+        Index("ix_vpn_users_admin_expires", "admin_id", "expires_at"),
+        Index("ix_vpn_users_admin_username", "admin_id", "marzban_username"),
+        # Enforcement sweeps (services/enforcement_service.py): active users past their expiry,
+        # and active users whose usage snapshot changed since the last sweep
+        Index("ix_vpn_users_active_expires", "is_active", "expires_at"),
+        Index("ix_vpn_users_active_synced", "is_active", "usage_synced_at"),
+        # Substring search on PostgreSQL (trigram GIN); other databases scan the admin's users
+        Index(
+            "ix_vpn_users_username_trgm", "marzban_username",
+            postgresql_using="gin", postgresql_ops={"marzban_username": "gin_trgm_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
+
+# The trigram index above needs the pg_trgm extension
+event.listen(
+    VpnUser.__table__, "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+
 class PaymentLog(Base):
     __tablename__ = "payment_logs"
     id = Column(Integer, primary_key=True, index=True)
@@ -121,13 +192,150 @@ class PaymentLog(Base):
     # Zarinpal's final reference ID after successful verification
     ref_id = Column(String, unique=True, index=True, nullable=True)
 
-    status = Column(String, default='pending', nullable=False) # e.g., 'pending', 'completed', 'failed'
+    status = Column(String, default='pending', nullable=False) # 'pending', 'verifying', 'completed', 'failed' or 'expired'
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     verified_at = Column(DateTime(timezone=True), nullable=True) # Timestamp of successful verification
+    # When a callback moved the payment to 'verifying'; a claim older than the verify lease may be taken over
+    verifying_since = Column(DateTime(timezone=True), nullable=True)
 
     admin = relationship("Admin", back_populates="payment_logs")
 
+    __table_args__ = (
+        # Serves the per-admin payment history in (created_at, id) order and its keyset cursors
+        Index("ix_payment_logs_admin_created_id", "admin_id", "created_at", "id"),
+        # Lets the reconciler range-scan old pending payments instead of the whole table
+        Index("ix_payment_logs_status_created", "status", "created_at"),
+    )
+
+class MarzbanOutbox(Base):
+    """
+    Marzban mutations waiting to be applied (see services/outbox_service.py). An entry is written
+    in the same transaction as the local change, so the two can't drift apart on a crash.
+    """
+    __tablename__ = "marzban_outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    operation = Column(String, nullable=False) # 'create_user' or 'delete_user'
+    marzban_username = Column(String, index=True, nullable=False)
+    admin_id = Column(Integer, ForeignKey("admins.id"), nullable=True) # Owner of the user, for status lookups
+    payload = Column(Text, nullable=True) # JSON arguments of the operation
+    # Unique per intent: a client retrying with the same Idempotency-Key gets the original entry
+    idempotency_key = Column(String, unique=True, nullable=False)
+
+    status = Column(String, default="pending", nullable=False) # 'pending', 'done' or 'failed'
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    locked_until = Column(DateTime(timezone=True), nullable=True) # Lease of the worker applying it
+    last_error = Column(String, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Serves the worker's scan for due entries
+        Index("ix_marzban_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+class SchedulerLease(Base):
+    """
+    One row per periodic background job. The worker holding an unexpired lease runs the job;
+    the row also keeps the job's progress (e.g. the watermark of the enforcement sweep).
+    See services/lease_service.py.
+    """
+    __tablename__ = "scheduler_leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=True) # "<host>:<pid>" of the worker holding the lease
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    last_run_at = Column(DateTime(timezone=True), nullable=True) # End of the last completed run
+    watermark = Column(DateTime(timezone=True), nullable=True) # Job-specific progress marker
+
+# Balances are kept in integer minor units: hundredths of the currency unit of plan prices and payments
+BALANCE_MINOR_UNITS = 100
+
+class BalanceLedgerEntry(Base):
+    """
+    Append-only record of every balance change of an admin (see services/ledger_service.py).
+    Rows are never updated or deleted; a correction is a new entry.
+    """
+    __tablename__ = "balance_ledger"
+    id = Column(Integer, primary_key=True, index=True)
+    # RESTRICT: an admin with balance history is deactivated rather than deleted, so the history stays
+    admin_id = Column(Integer, ForeignKey("admins.id", ondelete="RESTRICT"), nullable=False)
+    amount_minor = Column(BigInteger, nullable=False) # Positive for credits, negative for debits
+    kind = Column(String, nullable=False) # 'opening', 'payment', 'purchase' or 'adjustment'
+    # What the entry is for, e.g. "payment:12"; unique per kind, so the same credit can't be booked twice
+    reference = Column(String, nullable=True)
+    note = Column(String, nullable=True)
+    created_by_super_admin_id = Column(Integer, ForeignKey("super_admins.id"), nullable=True) # For adjustments
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Serves the balance delta (entries after the snapshot) and the per-admin history
+        Index("ix_balance_ledger_admin_id_id", "admin_id", "id"),
+        UniqueConstraint("kind", "reference", name="uq_balance_ledger_kind_reference"),
+    )
+
+    @property
+    def amount(self) -> float:
+        return self.amount_minor / BALANCE_MINOR_UNITS
+
+class BalanceSnapshot(Base):
+    """
+    An admin's balance folded up to ledger entry `last_entry_id`. Refreshed periodically, so
+    balance reads only add the few entries since then (see Admin.balance_minor).
+    """
+    __tablename__ = "balance_snapshots"
+    admin_id = Column(Integer, ForeignKey("admins.id", ondelete="CASCADE"), primary_key=True)
+    balance_minor = Column(BigInteger, nullable=False, default=0)
+    last_entry_id = Column(Integer, nullable=False, default=0)
+    # Sum of the admin's open holds (models.BalanceHold); the available balance is the balance minus this
+    held_minor = Column(BigInteger, nullable=False, default=0, server_default="0")
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class BalanceHold(Base):
+    """
+    Part of an admin's balance reserved for a purchase in progress (see ledger_service.place_hold).
+    Committed into a ledger debit once the purchase went through, released otherwise.
+    """
+    __tablename__ = "balance_holds"
+    id = Column(Integer, primary_key=True, index=True)
+    admin_id = Column(Integer, ForeignKey("admins.id", ondelete="CASCADE"), nullable=False, index=True)
+    amount_minor = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default="held") # 'held', 'committed', 'released' or 'expired'
+    note = Column(String, nullable=True) # Becomes the note of the debit
+    expires_at = Column(DateTime(timezone=True), nullable=False) # Released by the sweeper after this
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    settled_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # The sweeper's range scan for abandoned holds
+        Index("ix_balance_holds_status_expires", "status", "expires_at"),
+    )
+
+def balance_minor_expression(admin_id):
+    """SQL for an admin's balance in minor units: the snapshot plus the ledger entries after it."""
+    snapshot = (
+        select(BalanceSnapshot.balance_minor).where(BalanceSnapshot.admin_id == admin_id)
+        .correlate_except(BalanceSnapshot).scalar_subquery()
+    )
+    snapshot_entry = (
+        select(BalanceSnapshot.last_entry_id).where(BalanceSnapshot.admin_id == admin_id)
+        .correlate_except(BalanceSnapshot).scalar_subquery()
+    )
+    delta = (
+        select(func.coalesce(func.sum(BalanceLedgerEntry.amount_minor), 0))
+        .where(BalanceLedgerEntry.admin_id == admin_id, BalanceLedgerEntry.id > func.coalesce(snapshot_entry, 0))
+        .correlate_except(BalanceLedgerEntry).scalar_subquery()
+    )
+    return cast(func.coalesce(snapshot, 0) + delta, BigInteger)
+
+# Loaded with every Admin row: one primary key lookup plus an index range over the recent entries
+Admin.balance_minor = column_property(balance_minor_expression(Admin.id))
+Admin.held_minor = column_property(
+    func.coalesce(select(BalanceSnapshot.held_minor).where(BalanceSnapshot.admin_id == Admin.id)
+                  .correlate_except(BalanceSnapshot).scalar_subquery(), 0)
+)
+
 # To create tables in the database, you'd typically use Alembic or a similar migration tool,
 # or for simple cases: Base.metadata.create_all(bind=engine)
 # This line should be called cautiously, ideally managed by a migration system in a real app.
@@ -0,0 +1,99 @@
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+from sqlalchemy import DateTime, and_, func, literal, or_, select
+
+from .database import engine
+
+# Listings return their rows as a plain list; the cursor for the next page travels in this header.
+# It is set whenever a page is full, in both offset and cursor mode, so a client can start with
+# ?limit=N and continue with ?cursor=<X-Next-Cursor> until the header is missing.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Optional totals are counted exactly up to this many rows. Beyond it the count stops and
+# the header carries the cap as a lower bound, flagged by X-Total-Count-Exact: false.
+TOTAL_COUNT_HEADER = "X-Total-Count"
+TOTAL_COUNT_EXACT_HEADER = "X-Total-Count-Exact"
+LIST_COUNT_EXACT_LIMIT = int(os.getenv("LIST_COUNT_EXACT_LIMIT", "10000"))
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """Opaque cursor pointing just after the row with this (sort value, id)."""
+    if isinstance(sort_value, datetime):
+        raw = ["dt", sort_value.isoformat(), row_id]
+    else:
+        raw = ["v", sort_value, row_id]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    """Raises HTTPException(400) for cursors that were not produced by encode_cursor()."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        kind, sort_value, row_id = json.loads(raw)
+        if kind == "dt":
+            sort_value = datetime.fromisoformat(sort_value)
+        if sort_value is None:
+            raise ValueError("empty sort value")
+        return sort_value, int(row_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+# SQLite stores server-default timestamps as text without fractional seconds, so a bound
+# datetime never compares equal to them; both sides are normalized with datetime() there.
+# Other databases compare the column directly, so the composite (..., created_at, id) indexes serve the scan.
+_NORMALIZE_TIMESTAMPS = engine.dialect.name == "sqlite"
+
+def _sort_expression(column):
+    if _NORMALIZE_TIMESTAMPS and isinstance(column.type, DateTime):
+        return func.datetime(column)
+    return column
+
+def _cursor_value(column, value):
+    if _NORMALIZE_TIMESTAMPS and isinstance(column.type, DateTime):
+        return func.datetime(value)
+    return value
+
+def keyset_paginate(query, sort_col, id_col, cursor: Optional[str], limit: int, descending: bool = False):
+    """
+    Orders `query` (a Select or an ORM Query) by (sort_col, id) and, given a cursor,
+    restricts it to the rows after that cursor. The cost of a page no longer depends on
+    how deep it is, and rows inserted meanwhile don't shift later pages.
+    `sort_col` must be NOT NULL (e.g. created_at or a username).
+    """
+    sort_key = _sort_expression(sort_col)
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor)
+        sort_value = _cursor_value(sort_col, sort_value)
+        if descending:
+            query = query.filter(or_(sort_key < sort_value, and_(sort_key == sort_value, id_col < row_id)))
+        else:
+            query = query.filter(or_(sort_key > sort_value, and_(sort_key == sort_value, id_col > row_id)))
+    if descending:
+        query = query.order_by(sort_key.desc(), id_col.desc())
+    else:
+        query = query.order_by(sort_key.asc(), id_col.asc())
+    return query.limit(limit)
+
+def set_next_cursor(response: Response, rows: List[Any], limit: int, sort_attr: str = "created_at") -> None:
+    """Sets the X-Next-Cursor header from the last row of a full page."""
+    if rows and len(rows) >= limit:
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(last, sort_attr), last.id)
+
+def capped_count_query(query, cap: int = None):
+    """
+    SELECT count(*) over at most cap + 1 rows of a filtered Select (without ORDER BY / LIMIT),
+    so counting a huge result set stops early instead of scanning all of it.
+    """
+    cap = LIST_COUNT_EXACT_LIMIT if cap is None else cap
+    limited = query.with_only_columns(literal(1), maintain_column_froms=True).limit(cap + 1).subquery()
+    return select(func.count()).select_from(limited)
+
+def set_total_count(response: Response, count: int, cap: int = None) -> None:
+    cap = LIST_COUNT_EXACT_LIMIT if cap is None else cap
+    exact = count <= cap
+    response.headers[TOTAL_COUNT_HEADER] = str(count if exact else cap)
+    response.headers[TOTAL_COUNT_EXACT_HEADER] = "true" if exact else "false"
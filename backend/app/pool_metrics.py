@@ -0,0 +1,88 @@
+import threading
+import time
+from typing import Any, Dict
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+# Upper bounds (milliseconds) of the checkout wait-time histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PoolStats:
+    """Checkout counters and a wait-time histogram for one connection pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock() # The sync pool is used from FastAPI's threadpool
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_ms_sum = 0.0
+        self.wait_ms_max = 0.0
+        self.bucket_counts = [0] * (len(WAIT_BUCKETS_MS) + 1) # Last bucket is +Inf
+
+    def observe_wait(self, wait_ms: float, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_ms_sum += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+            for i, bound in enumerate(WAIT_BUCKETS_MS):
+                if wait_ms <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+            else:
+                self.bucket_counts[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            observed = self.checkouts + self.timeouts
+            # Cumulative counts, as in a Prometheus histogram
+            cumulative, buckets = 0, {}
+            for bound, count in zip([str(b) for b in WAIT_BUCKETS_MS] + ["+Inf"], self.bucket_counts):
+                cumulative += count
+                buckets[bound] = cumulative
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": round(self.wait_ms_sum / observed, 3) if observed else 0.0,
+                "wait_ms_max": round(self.wait_ms_max, 3),
+                "wait_ms_buckets": buckets,
+            }
+
+
+# One PoolStats per engine label ("sync", "async"); survives pool.recreate()
+_pool_stats: Dict[str, PoolStats] = {}
+
+def instrumented_pool_class(base_pool_class, label: str):
+    """
+    Returns a subclass of `base_pool_class` (e.g. QueuePool) that times how long each
+    checkout waits for a free connection and records it under `label`.
+    """
+    stats = _pool_stats.setdefault(label, PoolStats())
+
+    class InstrumentedPool(base_pool_class):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except PoolTimeoutError:
+                stats.observe_wait((time.perf_counter() - started) * 1000, timed_out=True)
+                raise
+            stats.observe_wait((time.perf_counter() - started) * 1000)
+            return connection
+
+    InstrumentedPool.__name__ = f"Instrumented{base_pool_class.__name__}"
+    return InstrumentedPool
+
+def get_pool_stats(engine, label: str) -> Dict[str, Any]:
+    """Current pool occupancy plus the recorded checkout statistics for an engine."""
+    pool = engine.pool
+    info: Dict[str, Any] = {"pool_class": type(pool).__name__, "status": pool.status()}
+    # Occupancy is only available on queue-based pools (not e.g. SQLite's default pools)
+    for attr in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, attr, None)
+        if callable(method):
+            info[attr] = method()
+    if label in _pool_stats:
+        info.update(_pool_stats[label].snapshot())
+    return info
@@ -0,0 +1,58 @@
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import AddConstraint, MetaData
+
+# create_all only creates missing tables, so columns and indexes added to existing tables
+# (usage snapshot, provisioning status, nodes, ...) are added here on startup.
+# Only additive changes are handled: new columns must be nullable or have a server default.
+
+
+def _existing_columns(engine: Engine, table_name: str) -> set:
+    return {column["name"] for column in inspect(engine).get_columns(table_name)}
+
+
+def _add_column(engine: Engine, table, column) -> bool:
+    """Adds `column` to `table`; returns False if another worker added it first."""
+    ddl_compiler = engine.dialect.ddl_compiler(engine.dialect, None)
+    preparer = engine.dialect.identifier_preparer
+    statement = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl_compiler.get_column_specification(column)}"
+    try:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(statement)
+    except Exception:
+        # Workers of the same deployment start together; only fail if the column is still missing
+        if column.name in _existing_columns(engine, table.name):
+            return False
+        raise
+    if engine.dialect.name != "sqlite": # SQLite can't add constraints to an existing table
+        for foreign_key in column.foreign_keys:
+            with engine.begin() as connection:
+                connection.execute(AddConstraint(foreign_key.constraint))
+    return True
+
+
+def _create_index(engine: Engine, index) -> None:
+    try:
+        index.create(engine, checkfirst=True) # Skips indexes limited to other dialects, too
+    except Exception:
+        if index.name not in {existing["name"] for existing in inspect(engine).get_indexes(index.table.name)}:
+            raise
+
+
+def upgrade_schema(engine: Engine, metadata: MetaData) -> list:
+    """
+    Adds the columns and indexes of `metadata` that are missing from tables that already exist.
+    Returns the added columns as "table.column".
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue # New tables come from create_all, with everything in place
+        missing = [column for column in table.columns if column.name not in _existing_columns(engine, table.name)]
+        for column in missing:
+            if _add_column(engine, table, column):
+                added.append(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            _create_index(engine, index)
+    return added
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 
 # --------------- Plan Schemas ---------------
@@ -9,6 +9,7 @@ class PlanBase(BaseModel):
     duration_days: int
     data_limit_gb: float
     is_active: bool = True
+    marzban_node: Optional[str] = None # Node for the 'by_plan' placement policy
 
 class PlanCreate(PlanBase):
     pass
@@ -19,6 +20,7 @@ class PlanUpdate(PlanBase):
     duration_days: Optional[int] = None
     data_limit_gb: Optional[float] = None
     is_active: Optional[bool] = None
+    marzban_node: Optional[str] = None
 
 class Plan(PlanBase): # Schema for returning a plan
     id: int
@@ -52,6 +54,7 @@ class AdminBase(BaseModel):
     email: EmailStr
     balance: float = 0.0
     is_active: bool = True
+    marzban_node: Optional[str] = None # Node for the 'by_admin' placement policy
 
 class AdminCreate(AdminBase):
     password: str
@@ -60,12 +63,14 @@ class AdminCreate(AdminBase):
 class AdminUpdate(BaseModel):
     username: Optional[str] = None
     email: Optional[EmailStr] = None
-    balance: Optional[float] = None
+    balance: Optional[float] = None # Recorded as an adjustment of the difference in the balance ledger
     is_active: Optional[bool] = None
+    marzban_node: Optional[str] = None
     # Password updates should be handled by a separate endpoint/schema for security
 
 class Admin(AdminBase): # Schema for returning an Admin
     id: int
+    held_balance: float = 0.0 # Part of the balance reserved for purchases in progress
     created_at: datetime
     updated_at: Optional[datetime] = None
     # created_by_super_admin_id: Optional[int] = None # Decide if this should be exposed
@@ -73,6 +78,24 @@ class Admin(AdminBase): # Schema for returning an Admin
     class Config:
         orm_mode = True
 
+class BalanceAdjustment(BaseModel):
+    amount: float # Positive credits, negative debits the admin's balance
+    note: Optional[str] = None
+
+class BalanceLedgerEntry(BaseModel):
+    id: int
+    admin_id: int
+    amount_minor: int
+    amount: float
+    kind: str
+    reference: Optional[str] = None
+    note: Optional[str] = None
+    created_by_super_admin_id: Optional[int] = None
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
 # Token Schemas for Authentication
 class Token(BaseModel):
     access_token: str
@@ -80,6 +103,8 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    jti: Optional[str] = None # Token id, part of the principal cache key
+    issued_at: Optional[int] = None # "iat" claim, checked against revocations
     # You can add more fields here like user_id, roles etc.
 
 # Login Schema
@@ -116,6 +141,14 @@ class VpnUser(VpnUserBase): # Schema for returning a VpnUser (includes fields fr
     created_at: datetime
     updated_at: Optional[datetime] = None
     expires_at: Optional[datetime] = None
+    # Usage snapshot synced from Marzban (None until the first sync)
+    status_from_marzban: Optional[str] = None
+    used_traffic: Optional[int] = None
+    data_limit: Optional[int] = None
+    subscription_url: Optional[str] = None
+    usage_synced_at: Optional[datetime] = None
+    provisioning_status: str = "provisioned" # 'pending', 'provisioned', 'deleting' or 'failed'
+    marzban_node: Optional[str] = None # None: the default node
     # We can include plan details or admin details if needed using nested schemas
     # plan: Optional[Plan] = None # Example of nesting, if Plan schema is defined above
     # owner_admin: Optional[Admin] # Might expose too much admin info
@@ -123,6 +156,61 @@ class VpnUser(VpnUserBase): # Schema for returning a VpnUser (includes fields fr
     class Config:
         orm_mode = True
 
+# Input schema for creating many VPN users on one plan in a single request.
+# Either pass explicit `usernames`, or a `username_prefix` with `count` to generate
+# e.g. shop-001..shop-500 (prefix "shop-", start 1, count 500, number_width 3).
+class VpnUserBatchCreate(BaseModel):
+    plan_id: int
+    usernames: Optional[List[str]] = None
+    username_prefix: Optional[str] = None
+    start: int = 1
+    count: Optional[int] = None
+    number_width: int = 3 # Zero-padding of the generated number
+    notes: Optional[str] = None
+
+class VpnUserBatchResult(BaseModel):
+    marzban_username: str
+    success: bool
+    detail: Optional[str] = None # Error message when success is False
+
+class VpnUserBatchResponse(BaseModel):
+    requested: int
+    created: int
+    failed: int
+    results: List[VpnUserBatchResult]
+
+# Input schema for bulk delete / bulk traffic reset. Select users either by
+# explicit `usernames` or by `filter`: "expired" or "over_limit" (data limit reached).
+class VpnUserBulkAction(BaseModel):
+    usernames: Optional[List[str]] = None
+    filter: Optional[str] = None
+
+# Input schema for adopting existing Marzban users into the panel (SuperAdmin).
+# Each user gets the plan from `plan_mapping` (username -> plan id) if listed, else a plan whose
+# data limit matches theirs (when match_plans_by_limits), else `default_plan_id`; otherwise it is skipped.
+class MarzbanImportRequest(BaseModel):
+    admin_id: int # Admin who will own the imported users
+    username_prefix: Optional[str] = None # Only import Marzban users whose name starts with this
+    plan_mapping: Dict[str, int] = {}
+    default_plan_id: Optional[int] = None
+    match_plans_by_limits: bool = True
+    dry_run: bool = True # Report what would be imported without writing anything
+    page_size: Optional[int] = None
+    node: Optional[str] = None # Marzban node to import from (None: the default node)
+
+# Query parameters for listing (and exporting) VPN users; used as `filters: VpnUserFilters = Depends()`.
+# state: "active", "inactive", "expired" or "over_limit". sort: "created_at", "username",
+# "expires_at" or "used_traffic", with a leading "-" for descending order.
+class VpnUserFilters(BaseModel):
+    plan_id: Optional[int] = None
+    state: Optional[str] = None
+    marzban_status: Optional[str] = None # Status from the last Marzban sync, e.g. "limited"
+    expires_after: Optional[datetime] = None
+    expires_before: Optional[datetime] = None
+    username_prefix: Optional[str] = None
+    search: Optional[str] = None # Substring of the username
+    sort: str = "created_at"
+
 # Schema to represent user details fetched from Marzban (can be more detailed)
 class MarzbanUserDetail(BaseModel):
     username: str
@@ -137,6 +225,47 @@ class MarzbanUserDetail(BaseModel):
 class VpnUserWithMarzbanDetails(VpnUser): # Extend VpnUser with Marzban live details
     marzban_details: Optional[MarzbanUserDetail] = None
 
+# A queued Marzban mutation of a VPN user, for polling the provisioning status
+class MarzbanOutboxEntry(BaseModel):
+    id: int
+    operation: str # 'create_user' or 'delete_user'
+    marzban_username: str
+    status: str # 'pending', 'done' or 'failed'
+    attempts: int
+    next_attempt_at: datetime
+    last_error: Optional[str] = None
+    created_at: datetime
+    processed_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class VpnUserProvisioning(BaseModel):
+    marzban_username: str
+    provisioning_status: str # 'pending', 'provisioned', 'deleting', 'failed' or 'deleted'
+    outbox: Optional[MarzbanOutboxEntry] = None # The latest queued operation, if any
+
+
+# --------------- Marzban Node Schemas ---------------
+class MarzbanNodeUpdate(BaseModel): # What the SuperAdmin manages; URL and credentials stay in the environment
+    region: Optional[str] = None
+    max_users: Optional[int] = None
+    is_active: Optional[bool] = None
+
+class MarzbanNode(BaseModel):
+    id: int
+    name: str
+    region: Optional[str] = None
+    max_users: Optional[int] = None
+    is_active: bool
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    users: int = 0 # VPN users placed on the node
+    configured: bool = True # False if the node was removed from the configuration
+
+    class Config:
+        orm_mode = True
+
 
 # --------------- PaymentLog Schemas ---------------
 class PaymentLogBase(BaseModel):
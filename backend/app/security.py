@@ -1,7 +1,12 @@
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
+import uuid
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel
@@ -11,7 +16,17 @@ from .schemas import TokenData # Assuming TokenData is in schemas.py
 load_dotenv()
 
 # Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor. Hashes made with a different cost are upgraded on the next successful login
+# (when PASSWORD_REHASH_ON_LOGIN is on), so the cost can be tuned without resetting passwords.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_REHASH_ON_LOGIN = os.getenv("PASSWORD_REHASH_ON_LOGIN", "true").lower() in ("1", "true", "yes")
+# bcrypt runs in its own small thread pool so logins never block the event loop.
+# More threads than CPU cores only adds contention; excess logins queue, and beyond
+# PASSWORD_HASH_MAX_PENDING they are rejected with 503 instead of piling up.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 SECRET_KEY = os.getenv("SECRET_KEY", "a_very_default_secret_key_for_dev_only")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
@@ -23,6 +38,89 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many hash/verify operations are already waiting for the executor."""
+    pass
+
+_hash_executor: Optional[ThreadPoolExecutor] = None
+_hash_stats_lock = threading.Lock()
+_hash_stats = {"submitted": 0, "started": 0, "completed": 0, "rejected": 0, "rehashed": 0,
+               "max_pending": 0, "busy_seconds": 0.0, "wait_seconds": 0.0}
+
+def _get_hash_executor() -> ThreadPoolExecutor:
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+    return _hash_executor
+
+def shutdown_password_executor() -> None:
+    """Stops the hashing threads. Called on app shutdown."""
+    global _hash_executor
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False)
+        _hash_executor = None
+
+async def _run_hashing(func, *args):
+    with _hash_stats_lock:
+        pending = _hash_stats["submitted"] - _hash_stats["completed"]
+        if pending >= PASSWORD_HASH_MAX_PENDING:
+            _hash_stats["rejected"] += 1
+            raise PasswordHashingBusy(f"{pending} password hashing operations already pending")
+        _hash_stats["submitted"] += 1
+        _hash_stats["max_pending"] = max(_hash_stats["max_pending"], pending + 1)
+    submitted_at = time.perf_counter()
+
+    def _timed():
+        started_at = time.perf_counter()
+        with _hash_stats_lock:
+            _hash_stats["started"] += 1
+            _hash_stats["wait_seconds"] += started_at - submitted_at
+        try:
+            return func(*args)
+        finally:
+            with _hash_stats_lock:
+                _hash_stats["completed"] += 1
+                _hash_stats["busy_seconds"] += time.perf_counter() - started_at
+
+    return await asyncio.get_running_loop().run_in_executor(_get_hash_executor(), _timed)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies a password on the hashing executor.
+    Returns (valid, new_hash); new_hash is set when the stored hash uses outdated
+    settings (e.g. fewer BCRYPT_ROUNDS) and should be saved in place of the old one.
+    """
+    valid, new_hash = await _run_hashing(pwd_context.verify_and_update, plain_password, hashed_password)
+    if not PASSWORD_REHASH_ON_LOGIN:
+        new_hash = None
+    if new_hash:
+        with _hash_stats_lock:
+            _hash_stats["rehashed"] += 1
+    return valid, new_hash
+
+async def get_password_hash_async(password: str) -> str:
+    """Hashes a password on the hashing executor."""
+    return await _run_hashing(pwd_context.hash, password)
+
+def get_password_hashing_stats() -> Dict[str, Any]:
+    """Queue depth and throughput of the hashing executor in this worker."""
+    with _hash_stats_lock:
+        stats = dict(_hash_stats)
+    completed = stats["completed"]
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "queued": stats["submitted"] - stats["started"], # Waiting for a free thread
+        "in_progress": stats["started"] - stats["completed"],
+        "max_pending": stats["max_pending"],
+        "completed": completed,
+        "rejected": stats["rejected"],
+        "rehashed": stats["rehashed"],
+        "avg_hash_ms": round(stats["busy_seconds"] * 1000 / completed, 3) if completed else 0.0,
+        "avg_wait_ms": round(stats["wait_seconds"] * 1000 / stats["started"], 3) if stats["started"] else 0.0,
+    }
+
 # JWT Token Handling
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
@@ -30,7 +128,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # jti identifies the token in the principal cache; iat lets revocations reject older tokens
+    to_encode.update({"exp": expire, "iat": datetime.utcnow(), "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -41,16 +140,20 @@ def decode_access_token(token: str) -> Optional[TokenData]:
         if username is None:
             return None
         # You could add more checks here, e.g., token type, scope, etc.
-        return TokenData(username=username) # Create a TokenData object
+        return TokenData(username=username, jti=payload.get("jti"), issued_at=payload.get("iat")) # Create a TokenData object
     except JWTError:
         return None
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import models # Assuming models.py is in the same directory or accessible
-from .database import get_db # Assuming get_db is in database.py
+from .database import get_async_db # Assuming get_async_db is in database.py
+from .services.principal_cache import (
+    get_cached_principal, cache_principal, is_token_revoked, PRINCIPAL_ADMIN, PRINCIPAL_SUPER_ADMIN
+)
 
 # OAuth2PasswordBearer for SuperAdmin. Token URL points to the SuperAdmin login endpoint.
 # Make sure this tokenUrl matches the actual login endpoint path.
@@ -62,7 +165,7 @@ oauth2_scheme_admin = OAuth2PasswordBearer(tokenUrl="/api/v1/admin/login/token")
 
 async def get_current_super_admin(
     token: str = Depends(oauth2_scheme_super_admin),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> models.SuperAdmin:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -72,10 +175,19 @@ async def get_current_super_admin(
     token_data = decode_access_token(token)
     if token_data is None or token_data.username is None:
         raise credentials_exception
+    if is_token_revoked(PRINCIPAL_SUPER_ADMIN, token_data.username, token_data.issued_at):
+        raise credentials_exception
 
-    user = db.query(models.SuperAdmin).filter(models.SuperAdmin.username == token_data.username).first()
+    # Served from the principal cache when possible, so most requests don't query the DB here
+    user = get_cached_principal(PRINCIPAL_SUPER_ADMIN, token_data.username, token_data.jti)
     if user is None:
-        raise credentials_exception
+        loaded_at = time.time()
+        result = await db.execute(select(models.SuperAdmin).where(models.SuperAdmin.username == token_data.username))
+        user = result.scalars().first()
+        if user is None:
+            raise credentials_exception
+        db.expunge(user) # Cached objects must not be tied to this request's session
+        cache_principal(PRINCIPAL_SUPER_ADMIN, token_data.username, token_data.jti, user, loaded_at)
     # Add more checks if needed, e.g., is_active
     return user
 
@@ -83,7 +195,7 @@ async def get_current_super_admin(
 # Placeholder for get_current_admin (similar to above but for Admin model)
 async def get_current_admin(
     token: str = Depends(oauth2_scheme_admin), # Use the admin-specific scheme
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> models.Admin:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -99,10 +211,21 @@ async def get_current_admin(
     # if token_data.get("type") != "admin":
     #     raise credentials_exception
 
-    user = db.query(models.Admin).filter(models.Admin.username == token_data.username).first()
+    if is_token_revoked(PRINCIPAL_ADMIN, token_data.username, token_data.issued_at):
+        raise credentials_exception
 
+    # Served from the principal cache when possible, so most requests don't query the DB here.
+    # Changes through the admin API invalidate it; see services/principal_cache.py.
+    user = get_cached_principal(PRINCIPAL_ADMIN, token_data.username, token_data.jti)
     if user is None:
-        raise credentials_exception
+        loaded_at = time.time()
+        result = await db.execute(select(models.Admin).where(models.Admin.username == token_data.username))
+        user = result.scalars().first()
+        if user is None:
+            raise credentials_exception
+        db.expunge(user) # Cached objects must not be tied to this request's session
+        cache_principal(PRINCIPAL_ADMIN, token_data.username, token_data.jti, user, loaded_at)
+
     if not user.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive admin user")
     return user
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import lease_service, outbox_service
+
+load_dotenv()
+
+# Deactivates users whose plan expired or whose data limit is used up, and disables them in
+# Marzban (through the outbox, so the change survives Marzban being down).
+# One worker across all hosts runs each sweep (lease in the scheduler_leases table).
+ENFORCEMENT_INTERVAL_SECONDS = int(os.getenv("ENFORCEMENT_INTERVAL_SECONDS", "60")) # 0 disables the sweeps
+ENFORCEMENT_BATCH_SIZE = int(os.getenv("ENFORCEMENT_BATCH_SIZE", "500")) # Users per UPDATE
+ENFORCEMENT_LEASE_SECONDS = int(os.getenv("ENFORCEMENT_LEASE_SECONDS", "300")) # Longer than a sweep takes
+# Over-quota users are looked for among snapshots synced since the last sweep, minus this margin
+# (a usage sync that started before the sweep may commit its rows after it)
+ENFORCEMENT_WATERMARK_OVERLAP_SECONDS = int(os.getenv("ENFORCEMENT_WATERMARK_OVERLAP_SECONDS", "600"))
+
+ENFORCEMENT_LEASE = "enforcement_sweep"
+# What the panel sets in Marzban for a user it deactivated, and for one it activates again
+DISABLE_MODIFICATIONS = {"status": "disabled"}
+ENABLE_MODIFICATIONS = {"status": "active"}
+
+REASON_EXPIRED = "expired"
+REASON_OVER_QUOTA = "over_quota"
+
+_sweep_task: Optional[asyncio.Task] = None
+_last_sweep: Dict[str, Any] = {}
+
+
+def _enforceable():
+    """Active users that exist in Marzban (pending/deleting users are handled by the outbox)."""
+    user = models.VpnUser
+    return and_(user.is_active.is_(True), user.provisioning_status == "provisioned")
+
+def _over_quota():
+    user = models.VpnUser
+    return or_(
+        and_(user.data_limit > 0, user.used_traffic >= user.data_limit),
+        user.status_from_marzban.in_(("limited", "expired")),
+    )
+
+async def _deactivate(rows: List[Any], reason: str) -> int:
+    """
+    Deactivates one batch in a single UPDATE and queues disabling each user in Marzban,
+    in the same transaction. Returns the number of users deactivated.
+    """
+    user = models.VpnUser
+    async with AsyncSessionLocal() as db:
+        # Re-checked and locked: users changed since they were selected are left alone
+        result = await db.execute(
+            select(user.id, user.marzban_username, user.admin_id, user.marzban_node)
+            .where(user.id.in_([row.id for row in rows]), _enforceable())
+            .with_for_update(skip_locked=True)
+        )
+        deactivated = result.all()
+        if not deactivated:
+            return 0
+        await db.execute(
+            update(user)
+            .where(user.id.in_([row.id for row in deactivated]))
+            .values(is_active=False, disabled_reason=reason, updated_at=datetime.utcnow())
+        )
+        for row in deactivated:
+            payload = {"modifications": DISABLE_MODIFICATIONS, "reason": reason}
+            if row.marzban_node:
+                payload["node"] = row.marzban_node
+            outbox_service.enqueue(db, outbox_service.OP_MODIFY_USER, row.marzban_username, row.admin_id, payload)
+        await db.commit()
+    outbox_service.notify_outbox()
+    return len(deactivated)
+
+async def reactivate_after_reset(db: AsyncSession, user_ids: List[int]) -> int:
+    """
+    Activates again, in the caller's transaction, the users among `user_ids` that the sweep
+    deactivated for their quota and that haven't expired since, and queues enabling them in
+    Marzban. Called after their traffic was reset; commit, then call outbox_service.notify_outbox().
+    Returns the number of users activated.
+    """
+    user = models.VpnUser
+    now = datetime.utcnow()
+    result = await db.execute(
+        select(user.id, user.marzban_username, user.admin_id, user.marzban_node)
+        .where(
+            user.id.in_(user_ids), user.is_active.is_(False), user.disabled_reason == REASON_OVER_QUOTA,
+            user.provisioning_status == "provisioned", or_(user.expires_at.is_(None), user.expires_at > now),
+        )
+        .with_for_update()
+    )
+    rows = result.all()
+    if not rows:
+        return 0
+    # The snapshot still says 'limited'; cleared so the next sweep doesn't deactivate the user again
+    await db.execute(
+        update(user).where(user.id.in_([row.id for row in rows]))
+        .values(is_active=True, disabled_reason=None, status_from_marzban=None, used_traffic=0,
+                usage_fingerprint=None, updated_at=now)
+    )
+    for row in rows:
+        payload = {"modifications": ENABLE_MODIFICATIONS, "reason": "traffic_reset"}
+        if row.marzban_node:
+            payload["node"] = row.marzban_node
+        outbox_service.enqueue(db, outbox_service.OP_MODIFY_USER, row.marzban_username, row.admin_id, payload)
+    return len(rows)
+
+async def _sweep_expired(now: datetime, stats: Dict[str, Any]) -> None:
+    # Range scan on (is_active, expires_at): only users that expired and are still active are read
+    user = models.VpnUser
+    after = None
+    while True:
+        query = select(user.id, user.expires_at).where(_enforceable(), user.expires_at <= now)
+        if after is not None:
+            # Keyset: rows skipped in the previous batch (locked by a request) are not read again
+            expires_at, row_id = after
+            query = query.where(or_(user.expires_at > expires_at, and_(user.expires_at == expires_at, user.id > row_id)))
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(query.order_by(user.expires_at, user.id).limit(ENFORCEMENT_BATCH_SIZE))
+            rows = result.all()
+        if not rows:
+            return
+        after = (rows[-1].expires_at, rows[-1].id)
+        stats["expired"] += await _deactivate(rows, REASON_EXPIRED)
+        stats["batches"] += 1
+        if len(rows) < ENFORCEMENT_BATCH_SIZE:
+            return
+
+async def _sweep_over_quota(since: Optional[datetime], stats: Dict[str, Any]) -> None:
+    # Range scan on (is_active, usage_synced_at): the usage sync only writes rows whose usage
+    # changed, so this reads the users that changed since the last sweep, in keyset order
+    user = models.VpnUser
+    after = None
+    while True:
+        query = select(user.id, user.usage_synced_at).where(_enforceable(), user.usage_synced_at.is_not(None))
+        if since is not None:
+            query = query.where(user.usage_synced_at >= since)
+        if after is not None:
+            synced_at, row_id = after
+            query = query.where(or_(user.usage_synced_at > synced_at, and_(user.usage_synced_at == synced_at, user.id > row_id)))
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(query.order_by(user.usage_synced_at, user.id).limit(ENFORCEMENT_BATCH_SIZE))
+            scanned = result.all()
+        if not scanned:
+            return
+        stats["scanned_changed"] += len(scanned)
+        after = (scanned[-1].usage_synced_at, scanned[-1].id)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(user.id).where(user.id.in_([row.id for row in scanned]), _over_quota()))
+            over_quota = result.all()
+        if over_quota:
+            stats["over_quota"] += await _deactivate(over_quota, REASON_OVER_QUOTA)
+            stats["batches"] += 1
+        if len(scanned) < ENFORCEMENT_BATCH_SIZE:
+            return
+
+async def sweep_once() -> Optional[Dict[str, Any]]:
+    """
+    Runs one enforcement sweep if this worker gets the lease; returns its statistics,
+    or None if another worker holds the lease.
+    """
+    global _last_sweep
+    lease = await lease_service.acquire_lease(ENFORCEMENT_LEASE, ENFORCEMENT_LEASE_SECONDS)
+    if lease is None:
+        return None
+    started = time.monotonic()
+    now = datetime.utcnow()
+    stats = {"expired": 0, "over_quota": 0, "scanned_changed": 0, "batches": 0}
+    try:
+        since = None
+        if lease.watermark is not None:
+            since = lease.watermark.replace(tzinfo=None) - timedelta(seconds=ENFORCEMENT_WATERMARK_OVERLAP_SECONDS)
+        await _sweep_expired(now, stats)
+        await _sweep_over_quota(since, stats)
+    except BaseException:
+        # Keep the old watermark so the next sweep covers this one's range again
+        await lease_service.release_lease(ENFORCEMENT_LEASE)
+        raise
+    await lease_service.release_lease(ENFORCEMENT_LEASE, last_run_at=datetime.utcnow(), watermark=now)
+    stats["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    _last_sweep = {**stats, "finished_at": datetime.utcnow().isoformat()}
+    return stats
+
+async def get_enforcement_stats() -> Dict[str, Any]:
+    lease = await lease_service.get_lease(ENFORCEMENT_LEASE)
+    return {
+        "last_sweep_in_this_worker": _last_sweep or None,
+        "last_run_at": lease.last_run_at if lease else None,
+        "watermark": lease.watermark if lease else None,
+        "lease_holder": lease.holder if lease else None,
+        "running": _sweep_task is not None and not _sweep_task.done(),
+    }
+
+async def _sweep_loop() -> None:
+    while True:
+        try:
+            stats = await sweep_once()
+            if stats and (stats["expired"] or stats["over_quota"]):
+                print(f"Enforcement sweep: {stats}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Never let a failed sweep kill the loop; the next one covers the same users
+            print(f"Enforcement sweep failed: {e}")
+        await asyncio.sleep(ENFORCEMENT_INTERVAL_SECONDS)
+
+def start_enforcement() -> None:
+    """Starts the background enforcement sweeps. Called on app startup."""
+    global _sweep_task
+    if ENFORCEMENT_INTERVAL_SECONDS <= 0 or (_sweep_task and not _sweep_task.done()):
+        return
+    _sweep_task = asyncio.create_task(_sweep_loop())
+
+async def stop_enforcement() -> None:
+    """Cancels the background enforcement sweeps. Called on app shutdown."""
+    global _sweep_task
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+        try:
+            await _sweep_task
+        except asyncio.CancelledError:
+            pass
+        _sweep_task = None
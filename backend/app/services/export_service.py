@@ -0,0 +1,95 @@
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Sequence
+from dotenv import load_dotenv
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from .. import models
+from ..database import AsyncSessionLocal
+
+load_dotenv()
+
+# Rows fetched per round trip from the server-side cursor. Memory use is bounded by this,
+# not by the size of the export.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+EXPORT_FORMATS = ("csv", "ndjson")
+# Exported columns, in file order
+VPN_USER_EXPORT_COLUMNS = [
+    "id", "marzban_username", "admin_id", "plan_id", "is_active", "created_at", "expires_at",
+    "status_from_marzban", "used_traffic", "data_limit", "usage_synced_at", "notes",
+]
+PAYMENT_LOG_EXPORT_COLUMNS = ["id", "admin_id", "amount", "status", "authority", "ref_id", "created_at", "verified_at"]
+_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class ExportError(Exception):
+    """Raised for an unsupported export request (e.g. an unknown format)."""
+    pass
+
+
+def vpn_users_export_select():
+    """Select of the exported VpnUser columns in primary-key order; add filters with .where()."""
+    return select(*[getattr(models.VpnUser, column) for column in VPN_USER_EXPORT_COLUMNS]).order_by(models.VpnUser.id)
+
+def payment_logs_export_select():
+    """Select of the exported PaymentLog columns in primary-key order; add filters with .where()."""
+    return select(*[getattr(models.PaymentLog, column) for column in PAYMENT_LOG_EXPORT_COLUMNS]).order_by(models.PaymentLog.id)
+
+def _json_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _csv_line(values: Sequence[Any]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(["" if value is None else _json_value(value) for value in values])
+    return buffer.getvalue()
+
+async def stream_rows(statement, columns: List[str], fmt: str) -> AsyncIterator[str]:
+    """
+    Runs `statement` (a Select of plain columns, labelled as `columns`) on a server-side
+    cursor and yields it as CSV (with a header line) or NDJSON, EXPORT_BATCH_SIZE rows at a time.
+    Uses its own session, since the response body is produced after the endpoint returns.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        if fmt == "csv":
+            yield _csv_line(columns)
+        async for rows in result.partitions(EXPORT_BATCH_SIZE):
+            if fmt == "csv":
+                yield "".join(_csv_line(row) for row in rows)
+            else:
+                yield "".join(
+                    json.dumps({column: _json_value(value) for column, value in zip(columns, row)}) + "\n"
+                    for row in rows
+                )
+
+async def _gzip(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_response(statement, columns: List[str], fmt: str, filename: str, compress: bool = False) -> StreamingResponse:
+    """
+    Streams an export as a file download. With `compress` the file is gzipped on the fly
+    (served as <filename>.gz), which shrinks CSV exports roughly tenfold.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unsupported export format '{fmt}'. Use one of: {', '.join(EXPORT_FORMATS)}.")
+    body = stream_rows(statement, columns, fmt)
+    filename = f"{filename}.{fmt}"
+    media_type = _MEDIA_TYPES[fmt]
+    if compress:
+        body = _gzip(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import models, schemas
+from ..database import AsyncSessionLocal
+from . import marzban_service, node_service
+from .usage_sync_service import snapshot_from_marzban, usage_fingerprint
+
+load_dotenv()
+
+MARZBAN_IMPORT_PAGE_SIZE = int(os.getenv("MARZBAN_IMPORT_PAGE_SIZE", "1000")) # Marzban users per page
+MARZBAN_IMPORT_MAX_UNMAPPED_REPORTED = 100 # Usernames listed in the summary when no plan matched
+
+GB = 1024 ** 3
+
+
+class MarzbanImportError(Exception):
+    """Raised when an import request is invalid (unknown admin or plan)."""
+    pass
+
+
+async def insert_vpn_users_ignoring_duplicates(db: AsyncSession, rows: List[Dict[str, Any]]) -> Set[str]:
+    """
+    Inserts models.VpnUser rows in the caller's transaction, skipping usernames that already
+    exist, and returns the usernames that were inserted. Other errors are raised as usual.
+    """
+    if not rows:
+        return set()
+    dialect_name = db.bind.dialect.name
+    if dialect_name in ("postgresql", "sqlite"):
+        if dialect_name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(models.VpnUser).on_conflict_do_nothing(index_elements=["marzban_username"])
+        result = await db.execute(statement.returning(models.VpnUser.marzban_username), rows)
+        return set(result.scalars().all())
+    if dialect_name in ("mysql", "mariadb"):
+        # No RETURNING, and rowcount can't tell inserted rows from duplicates (SQLAlchemy connects
+        # with FOUND_ROWS). The locking read also locks the gaps of the missing usernames, so
+        # they can't be inserted by someone else before this transaction ends.
+        usernames = [row["marzban_username"] for row in rows]
+        result = await db.execute(
+            select(models.VpnUser.marzban_username).where(models.VpnUser.marzban_username.in_(usernames)).with_for_update()
+        )
+        existing = set(result.scalars().all())
+        new_rows = [row for row in rows if row["marzban_username"] not in existing]
+        if new_rows:
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            await db.execute(mysql_insert(models.VpnUser).on_duplicate_key_update(id=models.VpnUser.id), new_rows) # A no-op for duplicates
+        return {row["marzban_username"] for row in new_rows}
+    raise MarzbanImportError(f"Bulk insert does not support the '{dialect_name}' database")
+
+def _user_duration_days(marzban_user: Dict[str, Any]) -> Optional[float]:
+    expire, created_at = marzban_user.get("expire"), marzban_user.get("created_at")
+    if not expire or not created_at:
+        return None
+    try:
+        created = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc) # Marzban reports UTC, usually without an offset
+    return (expire - created.timestamp()) / 86400
+
+
+class PlanMatcher:
+    """Maps a Marzban user to a plan id: explicit mapping, then data-limit heuristic, then default."""
+
+    def __init__(self, plans: List[models.Plan], request: schemas.MarzbanImportRequest):
+        self.mapping = request.plan_mapping
+        self.default_plan_id = request.default_plan_id
+        self.by_limit: Dict[int, List[models.Plan]] = {}
+        if request.match_plans_by_limits:
+            for plan in plans:
+                self.by_limit.setdefault(int(plan.data_limit_gb * GB), []).append(plan)
+
+    def match(self, marzban_user: Dict[str, Any]) -> Optional[int]:
+        username = marzban_user["username"]
+        if username in self.mapping:
+            return self.mapping[username]
+        candidates = self.by_limit.get(marzban_user.get("data_limit") or 0)
+        if candidates:
+            duration = _user_duration_days(marzban_user)
+            if duration is None or len(candidates) == 1:
+                return candidates[0].id
+            # Several plans with this data limit: take the one whose duration is closest
+            return min(candidates, key=lambda plan: abs(plan.duration_days - duration)).id
+        return self.default_plan_id
+
+
+def _vpn_user_row(marzban_user: Dict[str, Any], admin_id: int, plan_id: int, node: str, synced_at: datetime) -> Dict[str, Any]:
+    snapshot = snapshot_from_marzban(marzban_user)
+    expire = marzban_user.get("expire")
+    return {
+        "marzban_username": marzban_user["username"],
+        "admin_id": admin_id,
+        "plan_id": plan_id,
+        "marzban_node": node,
+        "is_active": marzban_user.get("status") != "disabled",
+        "expires_at": datetime.utcfromtimestamp(expire) if expire else None,
+        "notes": "Imported from Marzban",
+        "usage_synced_at": synced_at,
+        "usage_fingerprint": usage_fingerprint(snapshot),
+        **snapshot,
+    }
+
+async def validate_import_request(request: schemas.MarzbanImportRequest) -> List[models.Plan]:
+    """Checks the target admin, node and referenced plans exist. Returns all plans for the matcher."""
+    if request.node and request.node not in marzban_service.node_names():
+        raise MarzbanImportError(f"Unknown Marzban node '{request.node}'")
+    async with AsyncSessionLocal() as db:
+        if await db.get(models.Admin, request.admin_id) is None:
+            raise MarzbanImportError(f"Admin {request.admin_id} not found")
+        plans = (await db.execute(select(models.Plan))).scalars().all()
+    plan_ids = {plan.id for plan in plans}
+    referenced = set(request.plan_mapping.values()) | ({request.default_plan_id} if request.default_plan_id else set())
+    unknown = referenced - plan_ids
+    if unknown:
+        raise MarzbanImportError(f"Unknown plan id(s): {', '.join(str(plan_id) for plan_id in sorted(unknown))}")
+    return plans
+
+async def _store_page(rows: List[Dict[str, Any]], dry_run: bool) -> Dict[str, int]:
+    """
+    Inserts one page of rows, skipping existing usernames. Returns inserted / already present
+    counts; in a dry run, "inserted" is the number of rows that would be inserted.
+    """
+    if not rows:
+        return {"inserted": 0, "already_present": 0}
+    async with AsyncSessionLocal() as db:
+        if dry_run:
+            result = await db.execute(
+                select(models.VpnUser.marzban_username)
+                .where(models.VpnUser.marzban_username.in_([row["marzban_username"] for row in rows]))
+            )
+            existing = len(result.all())
+            return {"inserted": len(rows) - existing, "already_present": existing}
+        inserted = len(await insert_vpn_users_ignoring_duplicates(db, rows))
+        await db.commit()
+    if inserted:
+        node_service.reset_node_loads() # Placement counts users per node; count the adopted ones too
+    return {"inserted": inserted, "already_present": len(rows) - inserted}
+
+async def import_marzban_users(request: schemas.MarzbanImportRequest, plans: List[models.Plan]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Adopts existing users of one Marzban node into models.VpnUser for one admin
+    (`plans` as returned by validate_import_request()).
+
+    Pages through get_all_marzban_users (the next page is fetched while the current one
+    is written), maps every user to a plan and inserts each page with one multi-row
+    INSERT that ignores usernames already in the panel. Only about two pages are held
+    in memory at a time, so 50k+ users are fine. Yields a progress dict per page and a final summary.
+    """
+    matcher = PlanMatcher(plans, request)
+    node = request.node or marzban_service.MARZBAN_DEFAULT_NODE
+    limit = request.page_size or MARZBAN_IMPORT_PAGE_SIZE
+    started = time.monotonic()
+    synced_at = datetime.utcnow()
+    totals = {"scanned": 0, "matched_prefix": 0, "mapped": 0, "unmapped": 0, "inserted": 0, "already_present": 0, "pages": 0}
+    plan_counts: Dict[int, int] = {}
+    unmapped_usernames: List[str] = []
+
+    offset = 0
+    next_page = asyncio.create_task(marzban_service.get_all_marzban_users(offset=offset, limit=limit, node=node))
+    try:
+        while next_page is not None:
+            page = await next_page
+            users = page.get("users", [])
+            offset += len(users)
+            total = page.get("total")
+            # Marzban may cap the page size, so prefer its total over a short page as the end marker
+            has_more = bool(users) and (offset < total if total is not None else len(users) == limit)
+            next_page = asyncio.create_task(marzban_service.get_all_marzban_users(offset=offset, limit=limit, node=node)) if has_more else None
+
+            rows = []
+            for marzban_user in users:
+                username = marzban_user.get("username")
+                if not username:
+                    continue
+                totals["scanned"] += 1
+                if request.username_prefix and not username.startswith(request.username_prefix):
+                    continue
+                totals["matched_prefix"] += 1
+                plan_id = matcher.match(marzban_user)
+                if plan_id is None:
+                    totals["unmapped"] += 1
+                    if len(unmapped_usernames) < MARZBAN_IMPORT_MAX_UNMAPPED_REPORTED:
+                        unmapped_usernames.append(username)
+                    continue
+                totals["mapped"] += 1
+                plan_counts[plan_id] = plan_counts.get(plan_id, 0) + 1
+                rows.append(_vpn_user_row(marzban_user, request.admin_id, plan_id, node, synced_at))
+
+            stored = await _store_page(rows, request.dry_run)
+            totals["inserted"] += stored["inserted"]
+            totals["already_present"] += stored["already_present"]
+            totals["pages"] += 1
+            yield {"page": totals["pages"], "offset": offset, "total": total, "mapped": len(rows), **stored}
+    finally:
+        # On errors or when the client goes away, don't leave the prefetch running
+        if next_page is not None and not next_page.done():
+            next_page.cancel()
+
+    yield {
+        "done": True,
+        "dry_run": request.dry_run,
+        **totals,
+        "by_plan": {str(plan_id): count for plan_id, count in plan_counts.items()},
+        "unmapped_usernames": unmapped_usernames,
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,56 @@
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Any, Optional
+from sqlalchemy import select, update, or_
+from sqlalchemy.exc import IntegrityError
+
+from .. import models
+from ..database import AsyncSessionLocal
+
+# Leases in the database make sure a periodic job runs in one worker at a time across all hosts
+# (the shared store only coordinates the workers of one host). A lease expires on its own,
+# so the job is picked up elsewhere if its holder dies.
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def acquire_lease(name: str, seconds: float) -> Optional[models.SchedulerLease]:
+    """
+    Takes the lease `name` for `seconds` if nobody else holds it. Returns the lease row
+    (with the job's last_run_at and watermark) or None if another worker holds it.
+    """
+    lease = models.SchedulerLease
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        if await db.get(lease, name) is None:
+            db.add(lease(name=name))
+            try:
+                await db.commit()
+            except IntegrityError:
+                await db.rollback() # Another worker created it first
+        # Conditional update: of several workers trying at once, exactly one gets it
+        result = await db.execute(
+            update(lease)
+            .where(lease.name == name, or_(lease.locked_until.is_(None), lease.locked_until < now, lease.holder == WORKER_ID))
+            .values(holder=WORKER_ID, locked_until=now + timedelta(seconds=seconds))
+        )
+        await db.commit()
+        if result.rowcount != 1:
+            return None
+        result = await db.execute(select(lease).where(lease.name == name).execution_options(populate_existing=True))
+        return result.scalars().first()
+
+async def release_lease(name: str, **values: Any) -> None:
+    """Gives the lease up, storing `values` (e.g. last_run_at, watermark) on the row."""
+    lease = models.SchedulerLease
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(lease).where(lease.name == name, lease.holder == WORKER_ID)
+            .values(holder=None, locked_until=None, **values)
+        )
+        await db.commit()
+
+async def get_lease(name: str) -> Optional[models.SchedulerLease]:
+    async with AsyncSessionLocal() as db:
+        return await db.get(models.SchedulerLease, name)
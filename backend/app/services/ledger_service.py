@@ -0,0 +1,345 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import select, update, insert, func, exists, and_, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import lease_service
+
+load_dotenv()
+
+# Admin balances are an append-only ledger (models.BalanceLedgerEntry) in integer minor units.
+# Every change is an INSERT, so concurrent credits and debits of one admin don't wait on each
+# other. A balance is its snapshot (models.BalanceSnapshot) plus the entries after it; a leased
+# background job folds new entries into the snapshots so that delta stays short.
+# Charge plan prices to the admin's balance when VPN users are created (a purchase needs enough available balance)
+BILLING_ENABLED = os.getenv("BILLING_ENABLED", "false").lower() in ("1", "true", "yes")
+LEDGER_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL_SECONDS", "60")) # 0 disables the folding
+# Entries younger than this are not folded yet. Entry ids are assigned when a transaction inserts
+# them but become visible when it commits, so this must exceed the longest transaction writing entries.
+LEDGER_SNAPSHOT_SETTLE_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_SETTLE_SECONDS", "300"))
+LEDGER_SNAPSHOT_LEASE_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_LEASE_SECONDS", "300"))
+# A purchase first reserves its price with a hold, so the slow Marzban call runs without any lock.
+# Holds neither committed nor released within this time (e.g. the worker died) are released by the
+# snapshot job; keep it longer than the outbox keeps retrying a user creation.
+BALANCE_HOLD_TTL_SECONDS = int(os.getenv("BALANCE_HOLD_TTL_SECONDS", "3600"))
+BALANCE_HOLD_SWEEP_BATCH_SIZE = int(os.getenv("BALANCE_HOLD_SWEEP_BATCH_SIZE", "500")) # Expired holds released per run
+
+SNAPSHOT_LEASE = "ledger_snapshots"
+
+KIND_OPENING = "opening" # Balance carried over when the admin's ledger was opened
+KIND_PAYMENT = "payment"
+KIND_PURCHASE = "purchase"
+KIND_ADJUSTMENT = "adjustment" # Made by a SuperAdmin
+
+HOLD_HELD = "held"
+HOLD_COMMITTED = "committed"
+HOLD_RELEASED = "released"
+HOLD_EXPIRED = "expired"
+
+_refresh_task: Optional[asyncio.Task] = None
+_last_refresh: Dict[str, Any] = {}
+
+
+class InsufficientBalanceError(Exception):
+    """Raised when an admin's available balance doesn't cover a purchase."""
+    def __init__(self, available_minor: int, required_minor: int):
+        self.available_minor = available_minor
+        self.required_minor = required_minor
+        super().__init__(f"Insufficient balance: {to_units(available_minor)} available, {to_units(required_minor)} required.")
+
+
+def to_minor(amount: float) -> int:
+    """Currency units (as in plan prices and payments) to minor units, rounded half up."""
+    return int((Decimal(str(amount)) * models.BALANCE_MINOR_UNITS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_units(amount_minor: int) -> float:
+    return amount_minor / models.BALANCE_MINOR_UNITS
+
+def ledger_entry(admin_id: int, amount_minor: int, kind: str, reference: Optional[str] = None,
+                 note: Optional[str] = None, created_by_super_admin_id: Optional[int] = None) -> models.BalanceLedgerEntry:
+    """A new ledger entry; add it to the session of the change it belongs to."""
+    return models.BalanceLedgerEntry(
+        admin_id=admin_id, amount_minor=amount_minor, kind=kind, reference=reference,
+        note=note, created_by_super_admin_id=created_by_super_admin_id
+    )
+
+def payment_credit(payment_id: int, admin_id: int, amount: float) -> models.BalanceLedgerEntry:
+    # The reference is unique per kind, so a payment can only ever be credited once
+    return ledger_entry(admin_id, to_minor(amount), KIND_PAYMENT, reference=f"payment:{payment_id}")
+
+def purchase_debit(admin_id: int, plan: models.Plan, marzban_username: str) -> models.BalanceLedgerEntry:
+    return ledger_entry(admin_id, -to_minor(plan.price), KIND_PURCHASE, note=purchase_note(plan, marzban_username))
+
+def purchase_note(plan: models.Plan, marzban_username: str) -> str:
+    return f"VPN user '{marzban_username}' on plan '{plan.name}'"
+
+def open_ledger(db: Session, admin: models.Admin, opening_balance: float = 0.0) -> None:
+    """Adds the snapshot row (and the opening entry, if any) of a new admin. `admin` must be flushed."""
+    db.add(models.BalanceSnapshot(admin_id=admin.id, balance_minor=0, last_entry_id=0))
+    if opening_balance:
+        db.add(ledger_entry(admin.id, to_minor(opening_balance), KIND_OPENING, reference=f"admin:{admin.id}"))
+
+def open_ledgers(db: Session) -> None:
+    """
+    Opens the ledger of every admin that has none yet, carrying over the balance kept on the
+    admin row before the ledger existed. Called on app startup.
+    """
+    snapshot = models.BalanceSnapshot
+    missing = (
+        db.query(models.Admin.id, models.Admin.legacy_balance)
+        .outerjoin(snapshot, snapshot.admin_id == models.Admin.id)
+        .filter(snapshot.admin_id.is_(None))
+        .all()
+    )
+    if not missing:
+        return
+    for admin_id, legacy_balance in missing:
+        db.add(snapshot(admin_id=admin_id, balance_minor=0, last_entry_id=0))
+        if legacy_balance:
+            db.add(ledger_entry(admin_id, to_minor(legacy_balance), KIND_OPENING, reference=f"admin:{admin_id}"))
+    try:
+        db.commit()
+        print(f"Opened the balance ledger of {len(missing)} admin(s).")
+    except IntegrityError:
+        db.rollback() # Another worker opened them first
+
+def get_balance_minor(db: Session, admin_id: int) -> int:
+    return db.execute(select(models.balance_minor_expression(admin_id))).scalar() or 0
+
+def lock_balance(db: Session, admin_id: int) -> int:
+    """
+    Locks the admin's snapshot row until the caller's transaction ends and returns the balance in
+    minor units as of then. Holds (and so purchases) wait for the lock, so a change computed from
+    the returned balance can't interleave with them or with another such change.
+    """
+    snapshot, entry = models.BalanceSnapshot, models.BalanceLedgerEntry
+    delta = (
+        select(func.coalesce(func.sum(entry.amount_minor), 0))
+        .where(entry.admin_id == snapshot.admin_id, entry.id > snapshot.last_entry_id)
+        .scalar_subquery()
+    )
+    # Summed by the locking read itself: it sees the latest committed entries even where plain
+    # reads of the transaction would use an older snapshot (MySQL's REPEATABLE READ)
+    lock = select(snapshot.balance_minor + delta).where(snapshot.admin_id == admin_id).with_for_update()
+    balance = db.execute(lock).scalar()
+    if balance is None:
+        try:
+            with db.begin_nested():
+                db.add(snapshot(admin_id=admin_id, balance_minor=0, last_entry_id=0, held_minor=0))
+        except IntegrityError:
+            pass # Created concurrently
+        balance = db.execute(lock).scalar()
+    return balance
+
+async def get_balance_minor_async(db: AsyncSession, admin_id: int) -> int:
+    return (await db.execute(select(models.balance_minor_expression(admin_id)))).scalar() or 0
+
+async def place_hold(db: AsyncSession, admin_id: int, amount_minor: int, note: Optional[str] = None) -> models.BalanceHold:
+    """
+    Reserves `amount_minor` of the admin's available balance in the caller's transaction and
+    returns the (flushed) hold. Raises InsufficientBalanceError. Commit soon after: the admin's
+    snapshot row stays locked until then, so concurrent purchases of the admin queue up briefly
+    instead of overselling.
+    """
+    return (await place_holds(db, admin_id, amount_minor, [note]))[0]
+
+async def place_holds(db: AsyncSession, admin_id: int, amount_minor: int, notes: List[Optional[str]]) -> List[models.BalanceHold]:
+    """
+    Like place_hold(), for several purchases of `amount_minor` each (one hold per entry of `notes`,
+    in order): the balance is checked once for all of them, so either every hold is placed or none.
+    """
+    total_minor = amount_minor * len(notes)
+    snapshot, entry = models.BalanceSnapshot, models.BalanceLedgerEntry
+    # Locking first makes the check below see every debit committed before the lock was granted;
+    # the UPDATE alone would re-check the locked row but not the ledger sum
+    lock = select(snapshot.admin_id).where(snapshot.admin_id == admin_id).with_for_update()
+    if (await db.execute(lock)).first() is None:
+        try:
+            async with db.begin_nested():
+                db.add(snapshot(admin_id=admin_id, balance_minor=0, last_entry_id=0, held_minor=0))
+        except IntegrityError:
+            pass # A concurrent purchase created it first
+        await db.execute(lock)
+    delta = (
+        select(func.coalesce(func.sum(entry.amount_minor), 0))
+        .where(entry.admin_id == snapshot.admin_id, entry.id > snapshot.last_entry_id)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(snapshot)
+        .where(snapshot.admin_id == admin_id, snapshot.balance_minor + delta - snapshot.held_minor >= total_minor)
+        .values(held_minor=snapshot.held_minor + total_minor)
+    )
+    if result.rowcount != 1:
+        held = (await db.execute(select(snapshot.held_minor).where(snapshot.admin_id == admin_id))).scalar() or 0
+        raise InsufficientBalanceError(await get_balance_minor_async(db, admin_id) - held, total_minor)
+    expires_at = datetime.utcnow() + timedelta(seconds=BALANCE_HOLD_TTL_SECONDS)
+    holds = [
+        models.BalanceHold(admin_id=admin_id, amount_minor=amount_minor, status=HOLD_HELD, note=note, expires_at=expires_at)
+        for note in notes
+    ]
+    db.add_all(holds)
+    await db.flush()
+    return holds
+
+async def settle_hold(db: AsyncSession, hold_id: int, debits: Optional[List[models.BalanceLedgerEntry]] = None) -> str:
+    """
+    Ends a hold in the caller's transaction: books `debits` (by default one debit of the whole
+    held amount) and frees the held amount; with an empty list the hold is just released.
+    A hold the sweeper already expired still books its debits, as the purchase went through.
+    Settling a hold twice does nothing. Returns the hold's status.
+    """
+    hold = (await db.execute(select(models.BalanceHold).where(models.BalanceHold.id == hold_id).with_for_update())).scalars().first()
+    if hold is None:
+        return HOLD_RELEASED
+    if hold.status not in (HOLD_HELD, HOLD_EXPIRED):
+        return hold.status
+    if debits is None:
+        debits = [ledger_entry(hold.admin_id, -hold.amount_minor, KIND_PURCHASE, note=hold.note)]
+    if hold.status == HOLD_HELD:
+        snapshot = models.BalanceSnapshot
+        await db.execute(
+            update(snapshot).where(snapshot.admin_id == hold.admin_id)
+            .values(held_minor=snapshot.held_minor - hold.amount_minor)
+        )
+    elif not debits:
+        return hold.status # Expired, and nothing to book
+    db.add_all(debits)
+    hold.status = HOLD_COMMITTED if debits else HOLD_RELEASED
+    hold.settled_at = datetime.utcnow()
+    return hold.status
+
+async def _expire_holds(db: AsyncSession) -> int:
+    """Releases up to BALANCE_HOLD_SWEEP_BATCH_SIZE holds past their expiry. Returns how many."""
+    hold, snapshot = models.BalanceHold, models.BalanceSnapshot
+    result = await db.execute(
+        select(hold.id, hold.admin_id, hold.amount_minor)
+        .where(hold.status == HOLD_HELD, hold.expires_at <= datetime.utcnow())
+        .order_by(hold.expires_at).limit(BALANCE_HOLD_SWEEP_BATCH_SIZE)
+    )
+    expired = 0
+    for row in result.all():
+        # Conditional: a hold settled meanwhile is left alone
+        claimed = await db.execute(
+            update(hold).where(hold.id == row.id, hold.status == HOLD_HELD)
+            .values(status=HOLD_EXPIRED, settled_at=datetime.utcnow())
+        )
+        if claimed.rowcount == 1:
+            await db.execute(
+                update(snapshot).where(snapshot.admin_id == row.admin_id)
+                .values(held_minor=snapshot.held_minor - row.amount_minor)
+            )
+            expired += 1
+    await db.commit()
+    return expired
+
+async def refresh_snapshots() -> Optional[Dict[str, Any]]:
+    """
+    Folds settled ledger entries into the balance snapshots and releases expired holds if this
+    worker gets the lease; returns its statistics, or None if another worker holds the lease.
+    """
+    global _last_refresh
+    lease = await lease_service.acquire_lease(SNAPSHOT_LEASE, LEDGER_SNAPSHOT_LEASE_SECONDS)
+    if lease is None:
+        return None
+    started = time.monotonic()
+    entry, snapshot = models.BalanceLedgerEntry, models.BalanceSnapshot
+    stats = {"upto_entry_id": None, "snapshots_created": 0, "snapshots_refreshed": 0, "holds_expired": 0}
+    try:
+        async with AsyncSessionLocal() as db:
+            cutoff = datetime.utcnow() - timedelta(seconds=LEDGER_SNAPSHOT_SETTLE_SECONDS)
+            upto = (await db.execute(select(func.max(entry.id)).where(entry.created_at <= cutoff))).scalar()
+            if upto is not None:
+                stats["upto_entry_id"] = upto
+                # Admins whose ledger was started without a snapshot row (e.g. created outside the API)
+                created = await db.execute(
+                    insert(snapshot).from_select(
+                        ["admin_id", "balance_minor", "last_entry_id"],
+                        select(entry.admin_id, literal(0), literal(0)).where(
+                            entry.id <= upto, ~exists().where(snapshot.admin_id == entry.admin_id)
+                        ).distinct()
+                    )
+                )
+                stats["snapshots_created"] = created.rowcount
+                # Only snapshots of admins with new settled entries are written
+                in_range = and_(entry.admin_id == snapshot.admin_id, entry.id > snapshot.last_entry_id, entry.id <= upto)
+                refreshed = await db.execute(
+                    update(snapshot)
+                    .where(snapshot.last_entry_id < upto, exists().where(in_range))
+                    .values(
+                        balance_minor=snapshot.balance_minor
+                        + select(func.coalesce(func.sum(entry.amount_minor), 0)).where(in_range).scalar_subquery(),
+                        last_entry_id=upto,
+                    )
+                )
+                stats["snapshots_refreshed"] = refreshed.rowcount
+                await db.commit()
+            stats["holds_expired"] = await _expire_holds(db)
+    finally:
+        await lease_service.release_lease(SNAPSHOT_LEASE, last_run_at=datetime.utcnow())
+    stats["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    _last_refresh = {**stats, "finished_at": datetime.utcnow().isoformat()}
+    return stats
+
+async def get_ledger_stats() -> Dict[str, Any]:
+    entry, snapshot = models.BalanceLedgerEntry, models.BalanceSnapshot
+    async with AsyncSessionLocal() as db:
+        # Entries balance reads still have to add up, across all admins
+        unfolded = (await db.execute(
+            select(func.count(entry.id)).select_from(entry)
+            .outerjoin(snapshot, snapshot.admin_id == entry.admin_id)
+            .where(entry.id > func.coalesce(snapshot.last_entry_id, 0))
+        )).scalar()
+        open_holds = (await db.execute(
+            select(func.count(models.BalanceHold.id), func.coalesce(func.sum(models.BalanceHold.amount_minor), 0))
+            .where(models.BalanceHold.status == HOLD_HELD)
+        )).one()
+    lease = await lease_service.get_lease(SNAPSHOT_LEASE)
+    return {
+        "billing_enabled": BILLING_ENABLED,
+        "entries_after_snapshots": unfolded,
+        "open_holds": open_holds[0],
+        "held": to_units(open_holds[1]),
+        "last_refresh_in_this_worker": _last_refresh or None,
+        "last_run_at": lease.last_run_at if lease else None,
+        "lease_holder": lease.holder if lease else None,
+        "running": _refresh_task is not None and not _refresh_task.done(),
+    }
+
+async def _refresh_loop() -> None:
+    while True:
+        try:
+            await refresh_snapshots()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Balances stay correct without a refresh, reads just add up more entries
+            print(f"Balance snapshot refresh failed: {e}")
+        await asyncio.sleep(LEDGER_SNAPSHOT_INTERVAL_SECONDS)
+
+def start_snapshot_refresh() -> None:
+    """Starts the background snapshot refresh. Called on app startup."""
+    global _refresh_task
+    if LEDGER_SNAPSHOT_INTERVAL_SECONDS <= 0 or (_refresh_task and not _refresh_task.done()):
+        return
+    _refresh_task = asyncio.create_task(_refresh_loop())
+
+async def stop_snapshot_refresh() -> None:
+    """Cancels the background snapshot refresh. Called on app shutdown."""
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
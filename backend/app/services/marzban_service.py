@@ -1,18 +1,81 @@
+import asyncio
 import httpx
+import json
 import os
+import re
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any, List
+from jose import JWTError, jwt
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 import time
 
+from .shared_state import get_shared_store, SharedStateError
+from ..metrics import observe_upstream
+from .resilience import CircuitBreaker, RetryBudget, Bulkhead, BulkheadFull, jittered_backoff
+
 load_dotenv()
 
+# The panel configured by MARZBAN_API_BASE_URL is the node named MARZBAN_DEFAULT_NODE. Users whose
+# marzban_node is empty (created before multi-node support) live on it.
 MARZBAN_API_BASE_URL = os.getenv("MARZBAN_API_BASE_URL")
 MARZBAN_SUDO_USERNAME = os.getenv("MARZBAN_SUDO_USERNAME")
 MARZBAN_SUDO_PASSWORD = os.getenv("MARZBAN_SUDO_PASSWORD")
+MARZBAN_DEFAULT_NODE = os.getenv("MARZBAN_DEFAULT_NODE", "default")
+# Further panels (nodes) as a JSON list: [{"name": "de-1", "url": "https://de.example.com", "username": "...", "password": "..."}]
+MARZBAN_NODES = os.getenv("MARZBAN_NODES", "")
+
+# Connection pool settings for each node's Marzban HTTP client (one client per node per worker process)
+MARZBAN_HTTP_MAX_CONNECTIONS = int(os.getenv("MARZBAN_HTTP_MAX_CONNECTIONS", "50"))
+MARZBAN_HTTP_MAX_KEEPALIVE = int(os.getenv("MARZBAN_HTTP_MAX_KEEPALIVE", "20"))
+MARZBAN_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MARZBAN_HTTP_KEEPALIVE_EXPIRY", "30"))
+MARZBAN_HTTP2 = os.getenv("MARZBAN_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Timeouts in seconds. The connect timeout is shared, read timeouts are per operation.
+MARZBAN_CONNECT_TIMEOUT = float(os.getenv("MARZBAN_CONNECT_TIMEOUT", "5"))
+MARZBAN_DEFAULT_TIMEOUT = float(os.getenv("MARZBAN_DEFAULT_TIMEOUT", "20"))
+MARZBAN_AUTH_TIMEOUT = float(os.getenv("MARZBAN_AUTH_TIMEOUT", "10"))
+MARZBAN_BULK_TIMEOUT = float(os.getenv("MARZBAN_BULK_TIMEOUT", "60")) # e.g. listing all users
+
+# Circuit breaker: opens when at least MIN_CALLS calls in the last WINDOW_SECONDS were made and
+# ERROR_RATE of them failed (5xx, timeout, connection error) or took SLOW_CALL_SECONDS or more.
+# While open, calls fail immediately with MarzbanUnavailableError; after OPEN_SECONDS one probe is let through.
+MARZBAN_BREAKER_WINDOW_SECONDS = float(os.getenv("MARZBAN_BREAKER_WINDOW_SECONDS", "30"))
+MARZBAN_BREAKER_MIN_CALLS = int(os.getenv("MARZBAN_BREAKER_MIN_CALLS", "10"))
+MARZBAN_BREAKER_ERROR_RATE = float(os.getenv("MARZBAN_BREAKER_ERROR_RATE", "0.5"))
+MARZBAN_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("MARZBAN_BREAKER_SLOW_CALL_SECONDS", "5"))
+MARZBAN_BREAKER_OPEN_SECONDS = float(os.getenv("MARZBAN_BREAKER_OPEN_SECONDS", "30"))
+# Retries of idempotent (GET) calls after a timeout, connection error or 502/503/504.
+# Retries are limited to RETRY_BUDGET_RATIO of recent calls so they can't pile onto an outage.
+MARZBAN_RETRY_ATTEMPTS = int(os.getenv("MARZBAN_RETRY_ATTEMPTS", "2"))
+MARZBAN_RETRY_BACKOFF_SECONDS = float(os.getenv("MARZBAN_RETRY_BACKOFF_SECONDS", "0.2")) # Base of the jittered backoff
+MARZBAN_RETRY_BUDGET_RATIO = float(os.getenv("MARZBAN_RETRY_BUDGET_RATIO", "0.1"))
+MARZBAN_RETRY_BUDGET_MIN = int(os.getenv("MARZBAN_RETRY_BUDGET_MIN", "3")) # Retries always allowed per window
+# Bulkhead: Marzban calls in progress per worker. Keep it below MARZBAN_HTTP_MAX_CONNECTIONS.
+MARZBAN_MAX_CONCURRENT_CALLS = int(os.getenv("MARZBAN_MAX_CONCURRENT_CALLS", "40"))
+MARZBAN_BULKHEAD_WAIT_SECONDS = float(os.getenv("MARZBAN_BULKHEAD_WAIT_SECONDS", "2"))
+
+_RETRYABLE_METHODS = ("GET", "HEAD") # Not DELETE: a retried delete that had gone through returns 404
+_RETRYABLE_STATUS_CODES = (502, 503, 504)
+
+# Refresh the token this many seconds before its 'exp' claim
+MARZBAN_TOKEN_REFRESH_MARGIN = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", "60"))
+# Key of the default node's token entry in the store shared by all workers (see shared_state.py);
+# other nodes use "<key>:<node name>"
+MARZBAN_TOKEN_STORE_KEY = "marzban_token"
 
-# This will store the token and its expiry time
-_auth_cache: Dict[str, Any] = {"token": None, "expires_at": 0}
+# Per-worker cache of GET /api/user/{username} responses. Pages that show one user tend to
+# ask for the same details several times within a second or two; a short TTL keeps those to
+# one upstream request. Changes made through this module (delete/reset/modify) invalidate the
+# entry of this worker; other workers may serve the old details for at most the TTL.
+MARZBAN_USER_CACHE_TTL_SECONDS = float(os.getenv("MARZBAN_USER_CACHE_TTL_SECONDS", "5")) # 0 disables the cache
+MARZBAN_USER_CACHE_MAX_ENTRIES = int(os.getenv("MARZBAN_USER_CACHE_MAX_ENTRIES", "10000"))
+
+# username -> (expires_at, details), oldest first
+_user_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+# username -> the request in flight, shared by concurrent lookups of that user
+_user_requests: Dict[str, "asyncio.Task"] = {}
+_user_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
 
 class MarzbanAPIError(Exception):
     """Custom exception for Marzban API errors."""
@@ -21,96 +84,351 @@ class MarzbanAPIError(Exception):
         self.detail = detail
         super().__init__(f"Marzban API Error {status_code}: {detail}")
 
-async def _get_marzban_auth_token() -> Optional[str]:
+class MarzbanUnavailableError(MarzbanAPIError):
+    """Raised without calling Marzban: the circuit breaker is open or all call slots are busy."""
+    def __init__(self, detail: Any, retry_after: int = 1):
+        self.retry_after = retry_after
+        super().__init__(503, detail)
+
+def _build_timeout(read_timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(read_timeout, connect=min(MARZBAN_CONNECT_TIMEOUT, read_timeout))
+
+
+class MarzbanNode:
+    """
+    One Marzban panel: its URL and credentials, and this worker's pooled client, token cache,
+    circuit breaker, retry budget and bulkhead for it. A slow node doesn't hold up the others.
     """
-    Authenticates with Marzban API and retrieves a token, caching it until it expires.
+
+    def __init__(self, name: str, base_url: Optional[str], username: Optional[str], password: Optional[str]):
+        self.name = name
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.token_store_key = MARZBAN_TOKEN_STORE_KEY if name == MARZBAN_DEFAULT_NODE else f"{MARZBAN_TOKEN_STORE_KEY}:{name}"
+        # The pooled client, created on app startup by init_marzban_clients() or on first use
+        self.client: Optional[httpx.AsyncClient] = None
+        # This worker's copy of the token and its expiry time
+        self.auth_cache: Dict[str, Any] = {"token": None, "expires_at": 0}
+        # Single-flight guard so concurrent coroutines in this worker trigger at most one refresh
+        self.auth_lock = asyncio.Lock()
+        self.breaker = CircuitBreaker(
+            window_seconds=MARZBAN_BREAKER_WINDOW_SECONDS,
+            min_calls=MARZBAN_BREAKER_MIN_CALLS,
+            failure_rate=MARZBAN_BREAKER_ERROR_RATE,
+            slow_call_seconds=MARZBAN_BREAKER_SLOW_CALL_SECONDS,
+            open_seconds=MARZBAN_BREAKER_OPEN_SECONDS,
+        )
+        self.retry_budget = RetryBudget(MARZBAN_RETRY_BUDGET_RATIO, MARZBAN_RETRY_BUDGET_MIN, MARZBAN_BREAKER_WINDOW_SECONDS)
+        self.bulkhead = Bulkhead(MARZBAN_MAX_CONCURRENT_CALLS, MARZBAN_BULKHEAD_WAIT_SECONDS)
+
+    async def get_client(self) -> httpx.AsyncClient:
+        # Lazily create the client if the app startup hook did not run (e.g. scripts, tests)
+        if self.client is None or self.client.is_closed:
+            self.client = _new_client()
+        return self.client
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+def _load_nodes() -> Dict[str, MarzbanNode]:
+    nodes = {MARZBAN_DEFAULT_NODE: MarzbanNode(MARZBAN_DEFAULT_NODE, MARZBAN_API_BASE_URL, MARZBAN_SUDO_USERNAME, MARZBAN_SUDO_PASSWORD)}
+    if MARZBAN_NODES:
+        try:
+            for config in json.loads(MARZBAN_NODES):
+                nodes[config["name"]] = MarzbanNode(config["name"], config["url"], config.get("username"), config.get("password"))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring invalid MARZBAN_NODES configuration: {e}")
+    return nodes
+
+# Node name -> MarzbanNode
+_nodes: Dict[str, MarzbanNode] = _load_nodes()
+
+
+def get_node(name: Optional[str] = None) -> MarzbanNode:
+    """The node called `name`; None means the default node."""
+    node = _nodes.get(name or MARZBAN_DEFAULT_NODE)
+    if node is None:
+        raise MarzbanAPIError(500, f"Unknown Marzban node '{name}'.")
+    return node
+
+def node_names() -> List[str]:
+    """Names of the configured nodes (the default node only if it has a URL, unless it is the only one)."""
+    names = [name for name, node in _nodes.items() if node.base_url]
+    return names or [MARZBAN_DEFAULT_NODE]
+
+def _new_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=MARZBAN_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=MARZBAN_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=MARZBAN_HTTP_KEEPALIVE_EXPIRY,
+    )
+    http2 = MARZBAN_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401 -- HTTP/2 support in httpx needs the optional 'h2' package
+        except ImportError:
+            print("MARZBAN_HTTP2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            http2 = False
+
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=_build_timeout(MARZBAN_DEFAULT_TIMEOUT),
+        http2=http2,
+    )
+
+async def init_marzban_clients() -> None:
+    """
+    Creates the long-lived, pooled HTTP client of every configured node.
+    Called once per worker on app startup; calling it again is a no-op.
+    """
+    for name in node_names():
+        await get_node(name).get_client()
+
+async def close_marzban_clients() -> None:
+    """Closes the Marzban HTTP clients of all nodes. Called on app shutdown."""
+    for node in _nodes.values():
+        await node.close()
+
+def _token_expiry(access_token: str) -> float:
+    """
+    Returns the token's expiry as a unix timestamp, taken from the JWT 'exp' claim.
+    Falls back to MARZBAN_TOKEN_LIFETIME_MINUTES only if the token carries no 'exp'.
+    """
+    try:
+        exp = jwt.get_unverified_claims(access_token).get("exp")
+        if exp:
+            return float(exp)
+    except JWTError:
+        print("Marzban access token is not a decodable JWT, using the configured token lifetime.")
+    return time.time() + int(os.getenv("MARZBAN_TOKEN_LIFETIME_MINUTES", 1440)) * 60
+
+def _is_fresh(entry: Optional[Dict[str, Any]]) -> bool:
+    # Treat tokens within MARZBAN_TOKEN_REFRESH_MARGIN seconds of expiry as expired
+    return bool(entry and entry.get("token") and entry.get("expires_at", 0) > time.time() + MARZBAN_TOKEN_REFRESH_MARGIN)
+
+async def _login_to_marzban(node: MarzbanNode) -> Optional[Dict[str, Any]]:
+    """
+    Logs in to Marzban and returns a cache entry ({"token", "expires_at"}), or None when the login is refused.
+    Raises MarzbanAPIError when Marzban is unreachable or answers with a server error.
+    """
+    # Correct endpoint from openapi.json
+    auth_url = f"{node.base_url.rstrip('/')}/api/admin/token"
+
+    client = await node.get_client()
+    try:
+        response = await client.post(
+            auth_url,
+            data={"username": node.username, "password": node.password},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            timeout=_build_timeout(MARZBAN_AUTH_TIMEOUT)
+        )
+        response.raise_for_status()
+        token_data = response.json()
+
+        access_token = token_data.get("access_token")
+        if not access_token:
+            print("Failed to retrieve access_token from Marzban auth response.")
+            return None
+
+        print(f"Successfully authenticated with Marzban node '{node.name}' and obtained token.")
+        return {"token": access_token, "expires_at": _token_expiry(access_token)}
+    except httpx.HTTPStatusError as e:
+        print(f"Marzban authentication HTTP error: {e.response.status_code} - {e.response.text}")
+        if e.response.status_code >= 500:
+            # Marzban itself is failing, not the credentials; let the circuit breaker see it
+            raise MarzbanAPIError(e.response.status_code, "Marzban authentication failed: server error") from e
+        return None
+    except httpx.TransportError as e:
+        print(f"Marzban unreachable during authentication: {e}")
+        raise MarzbanAPIError(503, f"Marzban is unreachable: {e}") from e
+    except Exception as e:
+        print(f"Error during Marzban authentication: {e}")
+        return None
+
+async def _get_marzban_auth_token(node: MarzbanNode, stale_token: Optional[str] = None) -> Optional[str]:
+    """
+    Returns a valid Marzban token, logging in only when needed.
     The actual endpoint is /api/admin/token.
+
+    Lookup order: this worker's cache, then the token store shared by all workers, then a login.
+    Concurrent callers in one worker share a single refresh (asyncio lock), and workers
+    serialize their logins on the shared store's lock, so a token expiry causes one login per host.
+    Pass `stale_token` to force a refresh when Marzban rejected that token.
+    Each node has its own token.
     """
-    global _auth_cache
+    def _usable(entry: Optional[Dict[str, Any]]) -> bool:
+        return _is_fresh(entry) and entry["token"] != stale_token
 
-    # Check if token exists and is not expired (with a 60-second buffer)
-    if _auth_cache["token"] and _auth_cache["expires_at"] > time.time() + 60:
-        return _auth_cache["token"]
+    if _usable(node.auth_cache):
+        return node.auth_cache["token"]
 
-    if not MARZBAN_API_BASE_URL or not MARZBAN_SUDO_USERNAME or not MARZBAN_SUDO_PASSWORD:
-        print("Marzban API credentials or URL not configured.")
+    if not node.base_url or not node.username or not node.password:
+        print(f"Marzban API credentials or URL not configured for node '{node.name}'.")
         return None
 
-    # Correct endpoint from openapi.json
-    auth_url = f"{MARZBAN_API_BASE_URL.rstrip('/')}/api/admin/token"
+    async with node.auth_lock:
+        # Another coroutine may have refreshed the token while we waited for the lock
+        if _usable(node.auth_cache):
+            return node.auth_cache["token"]
 
-    async with httpx.AsyncClient() as client:
+        store = get_shared_store()
         try:
-            response = await client.post(
-                auth_url,
-                data={"username": MARZBAN_SUDO_USERNAME, "password": MARZBAN_SUDO_PASSWORD},
-                headers={"Content-Type": "application/x-www-form-urlencoded"}
-            )
-            response.raise_for_status()
-            token_data = response.json()
-
-            access_token = token_data.get("access_token")
-            if not access_token:
-                print("Failed to retrieve access_token from Marzban auth response.")
-                _auth_cache = {"token": None, "expires_at": 0}
-                return None
-
-            # Cache the token and set an expiry time.
-            # Marzban's JWT_ACCESS_TOKEN_EXPIRE_MINUTES defaults to 1440 (24 hours).
-            # Let's assume this and cache it.
-            # A more robust solution would decode the JWT to get the 'exp' claim.
-            token_lifetime_seconds = int(os.getenv("MARZBAN_TOKEN_LIFETIME_MINUTES", 1440)) * 60
-            _auth_cache["token"] = access_token
-            _auth_cache["expires_at"] = time.time() + token_lifetime_seconds
-
-            print("Successfully authenticated with Marzban and obtained token.")
-            return access_token
-        except httpx.HTTPStatusError as e:
-            print(f"Marzban authentication HTTP error: {e.response.status_code} - {e.response.text}")
-            _auth_cache = {"token": None, "expires_at": 0} # Clear cache on failure
-            return None
-        except Exception as e:
-            print(f"Error during Marzban authentication: {e}")
-            _auth_cache = {"token": None, "expires_at": 0}
-            return None
+            shared_entry = store.get(node.token_store_key)
+            if _usable(shared_entry):
+                node.auth_cache = shared_entry
+                return shared_entry["token"]
+
+            async with store.lock(node.token_store_key):
+                # Another worker may have logged in while we waited for the shared lock
+                shared_entry = store.get(node.token_store_key)
+                if _usable(shared_entry):
+                    node.auth_cache = shared_entry
+                    return shared_entry["token"]
+
+                entry = await _login_to_marzban(node)
+                if entry:
+                    store.set(node.token_store_key, entry)
+        except SharedStateError as e:
+            # The shared store is only an optimisation; fall back to a per-worker login
+            print(f"Marzban token store unavailable, logging in without it: {e}")
+            entry = await _login_to_marzban(node)
+
+        node.auth_cache = entry or {"token": None, "expires_at": 0} # Clear cache on failure
+        return node.auth_cache["token"]
+
+def _is_upstream_failure(error: MarzbanAPIError) -> bool:
+    """Errors that say Marzban is unhealthy, as opposed to answers like 404 or 409."""
+    return error.status_code >= 500 or isinstance(error.__cause__, httpx.TransportError)
+
+def _is_retryable(error: MarzbanAPIError) -> bool:
+    return error.status_code in _RETRYABLE_STATUS_CODES or isinstance(error.__cause__, httpx.TransportError)
+
+def _endpoint_template(endpoint: str) -> str:
+    """The endpoint without the username (user/alice/reset -> user/{username}/reset), for metric labels."""
+    return re.sub(r"^user/[^/]+", "user/{username}", endpoint.lstrip("/"))
 
 async def _make_marzban_request(
     method: str,
     endpoint: str,
     json_data: Optional[Dict[str, Any]] = None,
-    params: Optional[Dict[str, Any]] = None
+    params: Optional[Dict[str, Any]] = None,
+    timeout: Optional[float] = None,
+    node: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Helper function to make authenticated requests to Marzban API.
+    `timeout` overrides the default read timeout for slow operations (e.g. bulk listing).
+    `node` is the name of the Marzban node to call (None: the default node).
+
+    Calls go through the circuit breaker and the bulkhead, and idempotent calls are retried
+    with jittered backoff within the retry budget. Raises MarzbanUnavailableError (503)
+    without waiting when the breaker is open or no call slot frees up in time.
+    The whole call, retries included, is timed in the upstream_request_duration_seconds metric.
+    """
+    with observe_upstream("marzban", f"{method} {_endpoint_template(endpoint)}", node or MARZBAN_DEFAULT_NODE):
+        return await _call_marzban(method, endpoint, json_data, params, timeout, node)
+
+async def _call_marzban(
+    method: str,
+    endpoint: str,
+    json_data: Optional[Dict[str, Any]],
+    params: Optional[Dict[str, Any]],
+    timeout: Optional[float],
+    node: Optional[str]
+) -> Dict[str, Any]:
+    target = get_node(node)
+    breaker = target.breaker
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise MarzbanUnavailableError(f"Marzban node '{target.name}' is unavailable (circuit breaker open).", breaker.retry_after())
+        target.retry_budget.record_call()
+        started = time.monotonic()
+        try:
+            async with target.bulkhead:
+                result = await _send_marzban_request(target, method, endpoint, json_data, params, timeout)
+        except BulkheadFull as e:
+            breaker.cancel() # Marzban wasn't asked, so this says nothing about its health
+            raise MarzbanUnavailableError(f"Too many calls in progress to Marzban node '{target.name}': {e}") from e
+        except MarzbanAPIError as e:
+            breaker.record(failed=_is_upstream_failure(e), duration=time.monotonic() - started)
+            if (method in _RETRYABLE_METHODS and _is_retryable(e) and attempt < MARZBAN_RETRY_ATTEMPTS
+                    and target.retry_budget.try_retry()):
+                await asyncio.sleep(jittered_backoff(attempt, MARZBAN_RETRY_BACKOFF_SECONDS, MARZBAN_DEFAULT_TIMEOUT / 4))
+                attempt += 1
+                continue
+            raise
+        except BaseException:
+            breaker.cancel() # e.g. the request was cancelled because the client went away
+            raise
+        breaker.record(failed=False, duration=time.monotonic() - started)
+        return result
+
+def get_client_resilience_stats() -> Dict[str, Any]:
+    """Circuit breaker, retry budget and bulkhead state of every node."""
+    return {
+        name: {"circuit_breaker": node.breaker.stats(), "retry_budget": node.retry_budget.stats(), "bulkhead": node.bulkhead.stats()}
+        for name, node in _nodes.items()
+    }
+
+async def _send_marzban_request(
+    node: MarzbanNode,
+    method: str,
+    endpoint: str,
+    json_data: Optional[Dict[str, Any]],
+    params: Optional[Dict[str, Any]],
+    timeout: Optional[float]
 ) -> Dict[str, Any]:
-    """Helper function to make authenticated requests to Marzban API."""
-    token = await _get_marzban_auth_token()
+    """One authenticated request to the Marzban API (retrying once after a 401)."""
+    token = await _get_marzban_auth_token(node)
     if not token:
         raise MarzbanAPIError(401, "Not authenticated with Marzban or Marzban service not configured.")
 
-    if not MARZBAN_API_BASE_URL:
+    if not node.base_url:
          raise MarzbanAPIError(500, "Marzban API base URL not configured.")
 
     # Construct URL with /api/ prefix
-    url = f"{MARZBAN_API_BASE_URL.rstrip('/')}/api/{endpoint.lstrip('/')}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    url = f"{node.base_url.rstrip('/')}/api/{endpoint.lstrip('/')}"
 
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        try:
-            response = await client.request(method, url, json=json_data, params=params, headers=headers)
-            response.raise_for_status()
-            # For DELETE requests with no content
-            if response.status_code == 200 and not response.content:
-                return {"status": "success"}
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            print(f"Marzban API request error to {url}: {e.response.status_code} - {e.response.text}")
-            detail = e.response.json() if e.response.content else e.response.text
-            raise MarzbanAPIError(e.response.status_code, detail) from e
-        except Exception as e:
-            print(f"Generic error during Marzban API request to {url}: {e}")
-            raise MarzbanAPIError(500, str(e)) from e
+    client = await node.get_client()
+    try:
+        response = await client.request(
+            method, url, json=json_data, params=params,
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+            timeout=_build_timeout(timeout or MARZBAN_DEFAULT_TIMEOUT)
+        )
+        if response.status_code == 401:
+            # The token was revoked or expired early: refresh it once and retry
+            token = await _get_marzban_auth_token(node, stale_token=token)
+            if not token:
+                raise MarzbanAPIError(401, "Marzban rejected the token and re-authentication failed.")
+            response = await client.request(
+                method, url, json=json_data, params=params,
+                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+                timeout=_build_timeout(timeout or MARZBAN_DEFAULT_TIMEOUT)
+            )
+        response.raise_for_status()
+        # For DELETE requests with no content
+        if response.status_code == 200 and not response.content:
+            return {"status": "success"}
+        return response.json()
+    except httpx.HTTPStatusError as e:
+        print(f"Marzban API request error to {url}: {e.response.status_code} - {e.response.text}")
+        detail = e.response.json() if e.response.content else e.response.text
+        raise MarzbanAPIError(e.response.status_code, detail) from e
+    except MarzbanAPIError:
+        raise
+    except Exception as e:
+        print(f"Generic error during Marzban API request to {url}: {e}")
+        raise MarzbanAPIError(500, str(e)) from e
 
 # --- Implemented User Management Functions ---
 
-async def add_marzban_user(username: str, data_limit_gb: float, duration_days: int) -> Dict[str, Any]:
+async def add_marzban_user(username: str, data_limit_gb: float, duration_days: int, node: Optional[str] = None) -> Dict[str, Any]:
     """
     Add a new user to Marzban.
     Endpoint: POST /api/user
@@ -136,61 +454,118 @@ async def add_marzban_user(username: str, data_limit_gb: float, duration_days: i
         "data_limit": data_limit_bytes,
         "data_limit_reset_strategy": "no_reset"
     }
-    return await _make_marzban_request("POST", "user", json_data=payload)
+    try:
+        return await _make_marzban_request("POST", "user", json_data=payload, node=node)
+    finally:
+        invalidate_user_cache(username)
 
-async def get_marzban_user_details(username: str) -> Dict[str, Any]:
+async def _fetch_user_details(username: str, node: Optional[str]) -> Dict[str, Any]:
+    details = await _make_marzban_request("GET", f"user/{username}", node=node)
+    # Don't store the response if the user was changed (invalidated) while it was in flight
+    if _user_requests.get(username) is asyncio.current_task():
+        _user_cache[username] = (time.monotonic() + MARZBAN_USER_CACHE_TTL_SECONDS, details)
+        _user_cache.move_to_end(username)
+        while len(_user_cache) > MARZBAN_USER_CACHE_MAX_ENTRIES:
+            _user_cache.popitem(last=False)
+    return details
+
+def _forget_user_request(username: str, task: "asyncio.Task") -> None:
+    if _user_requests.get(username) is task:
+        del _user_requests[username]
+    if not task.cancelled():
+        task.exception() # Mark the error as retrieved even if every waiter went away
+
+async def get_marzban_user_details(username: str, node: Optional[str] = None, use_cache: bool = True) -> Dict[str, Any]:
     """
     Get details for a specific user from Marzban.
     Endpoint: GET /api/user/{username}
+
+    Served from a cache for MARZBAN_USER_CACHE_TTL_SECONDS. Concurrent lookups of the same
+    user share one upstream request; errors are not cached. Usernames are unique across nodes,
+    so the cache is keyed by username alone. With use_cache=False, Marzban is always asked
+    (for callers that need its current state, not one up to a few seconds old).
     """
-    return await _make_marzban_request("GET", f"user/{username}")
+    if MARZBAN_USER_CACHE_TTL_SECONDS <= 0 or not use_cache:
+        return await _make_marzban_request("GET", f"user/{username}", node=node)
+
+    entry = _user_cache.get(username)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            _user_cache_stats["hits"] += 1
+            return dict(entry[1])
+        del _user_cache[username]
+
+    task = _user_requests.get(username)
+    if task is not None:
+        _user_cache_stats["coalesced"] += 1
+    else:
+        _user_cache_stats["misses"] += 1
+        task = asyncio.ensure_future(_fetch_user_details(username, node))
+        _user_requests[username] = task
+        task.add_done_callback(lambda done: _forget_user_request(username, done))
+    # shield(): a caller that goes away must not cancel the request the others are waiting for
+    return dict(await asyncio.shield(task))
 
-async def delete_marzban_user(username: str) -> Dict[str, Any]:
+def invalidate_user_cache(username: str) -> None:
+    """Drops the cached details of a user; called by every function here that changes a user."""
+    _user_cache.pop(username, None)
+    # A lookup already in flight may return the old state; let it finish but don't cache it
+    _user_requests.pop(username, None)
+
+def clear_user_cache() -> None:
+    _user_cache.clear()
+    _user_requests.clear()
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    return {
+        "entries": len(_user_cache),
+        "in_flight": len(_user_requests),
+        **_user_cache_stats,
+        "ttl_seconds": MARZBAN_USER_CACHE_TTL_SECONDS,
+        "max_entries": MARZBAN_USER_CACHE_MAX_ENTRIES,
+    }
+
+async def delete_marzban_user(username: str, node: Optional[str] = None) -> Dict[str, Any]:
     """
     Delete a user from Marzban.
     Endpoint: DELETE /api/user/{username}
     """
-    return await _make_marzban_request("DELETE", f"user/{username}")
+    try:
+        return await _make_marzban_request("DELETE", f"user/{username}", node=node)
+    finally:
+        invalidate_user_cache(username)
 
-async def reset_marzban_user_traffic(username: str) -> Dict[str, Any]:
+async def reset_marzban_user_traffic(username: str, node: Optional[str] = None) -> Dict[str, Any]:
     """
     Reset a user's data usage in Marzban.
     Endpoint: POST /api/user/{username}/reset
     """
-    return await _make_marzban_request("POST", f"user/{username}/reset")
+    try:
+        return await _make_marzban_request("POST", f"user/{username}/reset", node=node)
+    finally:
+        invalidate_user_cache(username)
 
-async def get_all_marzban_users(offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+async def get_all_marzban_users(offset: int = 0, limit: int = 100, node: Optional[str] = None) -> Dict[str, Any]:
     """
     Get a list of all users from Marzban.
     Endpoint: GET /api/users
     """
-    return await _make_marzban_request("GET", "users", params={"offset": offset, "limit": limit})
+    return await _make_marzban_request(
+        "GET", "users", params={"offset": offset, "limit": limit}, timeout=MARZBAN_BULK_TIMEOUT, node=node
+    )
 
 # We don't need a separate subscription URL function, as it's part of the UserResponse schema
 # fetched by get_marzban_user_details.
 # The same goes for raw links.
 
-# The modify_marzban_user function can be implemented if needed, but it's more complex
-# as it requires sending the full UserModify payload. For now, reset is sufficient.
-async def modify_marzban_user(username: str, modifications: Dict[str, Any]) -> Dict[str, Any]:
+async def modify_marzban_user(username: str, modifications: Dict[str, Any], node: Optional[str] = None) -> Dict[str, Any]:
     """
     Modify a user in Marzban.
     Endpoint: PUT /api/user/{username}
-    NOTE: This is a full update. `modifications` should be a valid UserModify payload.
-    """
-    # This function is more complex than just sending the modifications,
-    # as the PUT endpoint might expect the full object.
-    # The current panel logic doesn't require a general modify endpoint yet.
-    # If it were to be implemented, it would look something like this:
-    #
-    # current_details = await get_marzban_user_details(username)
-    # # The UserModify schema has many nullable fields.
-    # # We can construct a payload with just the changes.
-    # payload = {
-    #     "status": modifications.get("status"),
-    #     "expire": modifications.get("expire"),
-    #     ...
-    # }
-    # payload = {k: v for k, v in payload.items() if v is not None} # remove None values
-    # return await _make_marzban_request("PUT", f"user/{username}", json_data=payload)
-    raise NotImplementedError("General user modification not implemented yet.")
+    Every field of the UserModify schema is optional, so `modifications` only needs the fields
+    to change, e.g. {"status": "disabled"}. Returns the updated user.
+    """
+    try:
+        return await _make_marzban_request("PUT", f"user/{username}", json_data=modifications, node=node)
+    finally:
+        invalidate_user_cache(username)
@@ -0,0 +1,105 @@
+import os
+import time
+from typing import Dict, List
+from dotenv import load_dotenv
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import models
+from . import marzban_service
+
+load_dotenv()
+
+# Which node new VPN users are created on:
+#   least_loaded - the active node with the fewest users that still has room (max_users)
+#   by_plan      - the plan's marzban_node, least_loaded for plans without one
+#   by_admin     - the admin's marzban_node, least_loaded for admins without one
+MARZBAN_PLACEMENT_POLICY = os.getenv("MARZBAN_PLACEMENT_POLICY", "least_loaded")
+# How long this worker reuses the per-node user counts before counting again
+MARZBAN_NODE_LOAD_CACHE_SECONDS = float(os.getenv("MARZBAN_NODE_LOAD_CACHE_SECONDS", "5"))
+
+POLICY_LEAST_LOADED = "least_loaded"
+POLICY_BY_PLAN = "by_plan"
+POLICY_BY_ADMIN = "by_admin"
+
+# This worker's per-node user counts, adjusted locally for the users it placed since counting
+_loads: Dict[str, int] = {}
+_loads_counted_at: float = 0.0
+
+
+class NodePlacementError(Exception):
+    """Raised when no node can take new users (all full or inactive), or a pinned node can't."""
+    pass
+
+
+def is_known_node(name: str) -> bool:
+    """Whether `name` is a configured Marzban node."""
+    return name in marzban_service.node_names()
+
+def _node_column():
+    # Users without a node live on the default node
+    return func.coalesce(models.VpnUser.marzban_node, marzban_service.MARZBAN_DEFAULT_NODE)
+
+def sync_node_registry(db: Session) -> None:
+    """Creates a registry row for every configured node that has none yet. Called on app startup."""
+    existing = {name for (name,) in db.query(models.MarzbanNode.name).all()}
+    for name in marzban_service.node_names():
+        if name not in existing:
+            db.add(models.MarzbanNode(name=name, is_active=True))
+            print(f"Registered Marzban node '{name}'.")
+    db.commit()
+
+def count_users_by_node(db: Session) -> Dict[str, int]:
+    rows = db.query(_node_column(), func.count(models.VpnUser.id)).group_by(_node_column()).all()
+    return {name: count for name, count in rows}
+
+async def _current_loads(db: AsyncSession) -> Dict[str, int]:
+    global _loads, _loads_counted_at
+    now = time.monotonic()
+    if now - _loads_counted_at >= MARZBAN_NODE_LOAD_CACHE_SECONDS:
+        result = await db.execute(select(_node_column(), func.count(models.VpnUser.id)).group_by(_node_column()))
+        _loads = {name: count for name, count in result.all()}
+        _loads_counted_at = now
+    return _loads
+
+def reset_node_loads() -> None:
+    """Forgets the cached user counts, e.g. after users were moved or imported."""
+    global _loads_counted_at
+    _loads.clear()
+    _loads_counted_at = 0.0
+
+async def choose_node(db: AsyncSession, admin: models.Admin, plan: models.Plan, count: int = 1) -> str:
+    """
+    Picks the node for `count` new users of `admin` on `plan` according to
+    MARZBAN_PLACEMENT_POLICY. Raises NodePlacementError if no suitable node has room.
+    """
+    result = await db.execute(select(models.MarzbanNode))
+    registry = {node.name: node for node in result.scalars().all()}
+    loads = await _current_loads(db)
+
+    def _has_room(name: str) -> bool:
+        node = registry.get(name)
+        if node is None:
+            return True # Configured but not registered yet: no limits set
+        return node.is_active and (node.max_users is None or loads.get(name, 0) + count <= node.max_users)
+
+    pinned = None
+    if MARZBAN_PLACEMENT_POLICY == POLICY_BY_PLAN:
+        pinned = plan.marzban_node
+    elif MARZBAN_PLACEMENT_POLICY == POLICY_BY_ADMIN:
+        pinned = admin.marzban_node
+
+    if pinned:
+        if not is_known_node(pinned) or not _has_room(pinned):
+            raise NodePlacementError(f"Marzban node '{pinned}' can't take new users.")
+        name = pinned
+    else:
+        candidates: List[str] = [name for name in marzban_service.node_names() if _has_room(name)]
+        if not candidates:
+            raise NodePlacementError("No Marzban node has room for new users.")
+        name = min(candidates, key=lambda candidate: (loads.get(candidate, 0), candidate))
+
+    # Count the placement right away, so this worker spreads users until the next recount
+    _loads[name] = loads.get(name, 0) + count
+    return name
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import marzban_service, ledger_service
+from .usage_sync_service import snapshot_from_marzban, usage_fingerprint
+
+load_dotenv()
+
+# Marzban mutations of single users are not applied inside the request. The endpoint writes the
+# local change and an outbox entry in one transaction and returns; a background worker in every
+# app worker applies due entries, retrying with backoff. Entries of one username run in order.
+MARZBAN_OUTBOX_POLL_SECONDS = float(os.getenv("MARZBAN_OUTBOX_POLL_SECONDS", "1")) # 0 disables the worker
+MARZBAN_OUTBOX_BATCH_SIZE = int(os.getenv("MARZBAN_OUTBOX_BATCH_SIZE", "50")) # Entries claimed per round
+MARZBAN_OUTBOX_CONCURRENCY = int(os.getenv("MARZBAN_OUTBOX_CONCURRENCY", "10")) # Entries applied in parallel
+MARZBAN_OUTBOX_MAX_ATTEMPTS = int(os.getenv("MARZBAN_OUTBOX_MAX_ATTEMPTS", "10"))
+MARZBAN_OUTBOX_BACKOFF_SECONDS = float(os.getenv("MARZBAN_OUTBOX_BACKOFF_SECONDS", "2")) # Doubles per attempt
+MARZBAN_OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("MARZBAN_OUTBOX_MAX_BACKOFF_SECONDS", "300"))
+# A claimed entry is left alone by other workers this long; a crashed worker's entries are retried after it
+MARZBAN_OUTBOX_LEASE_SECONDS = float(os.getenv("MARZBAN_OUTBOX_LEASE_SECONDS", "120"))
+
+OP_CREATE_USER = "create_user"
+OP_DELETE_USER = "delete_user"
+OP_MODIFY_USER = "modify_user" # payload: {"modifications": {...UserModify fields}}
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Marzban answers that won't change on a retry
+_PERMANENT_STATUS_CODES = (400, 403, 404, 409, 422)
+
+_worker_task: Optional[asyncio.Task] = None
+# Set when this worker enqueued something, so it is applied without waiting for the next poll
+_wakeup = asyncio.Event()
+
+
+def enqueue(db: AsyncSession, operation: str, marzban_username: str, admin_id: Optional[int] = None,
+            payload: Optional[Dict[str, Any]] = None, idempotency_key: Optional[str] = None) -> models.MarzbanOutbox:
+    """
+    Adds an outbox entry to the caller's transaction. Commit it together with the local
+    change, then call notify_outbox().
+    """
+    entry = models.MarzbanOutbox(
+        operation=operation,
+        marzban_username=marzban_username,
+        admin_id=admin_id,
+        payload=json.dumps(payload) if payload else None,
+        idempotency_key=idempotency_key or uuid.uuid4().hex,
+        status=STATUS_PENDING,
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+    )
+    db.add(entry)
+    return entry
+
+def notify_outbox() -> None:
+    _wakeup.set()
+
+async def get_entry_by_idempotency_key(db: AsyncSession, idempotency_key: str) -> Optional[models.MarzbanOutbox]:
+    result = await db.execute(select(models.MarzbanOutbox).where(models.MarzbanOutbox.idempotency_key == idempotency_key))
+    return result.scalars().first()
+
+async def get_latest_entry(db: AsyncSession, marzban_username: str) -> Optional[models.MarzbanOutbox]:
+    result = await db.execute(
+        select(models.MarzbanOutbox)
+        .where(models.MarzbanOutbox.marzban_username == marzban_username)
+        .order_by(models.MarzbanOutbox.id.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+def _backoff(attempts: int) -> float:
+    delay = min(MARZBAN_OUTBOX_MAX_BACKOFF_SECONDS, MARZBAN_OUTBOX_BACKOFF_SECONDS * (2 ** max(0, attempts - 1)))
+    return random.uniform(delay / 2, delay)
+
+async def _claim_due_entries() -> List[Dict[str, Any]]:
+    """Leases up to MARZBAN_OUTBOX_BATCH_SIZE due entries whose username has no older pending entry."""
+    outbox = models.MarzbanOutbox
+    older = aliased(models.MarzbanOutbox)
+    now = datetime.utcnow()
+    lease_free = or_(outbox.locked_until.is_(None), outbox.locked_until < now)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(outbox.id, outbox.operation, outbox.marzban_username, outbox.payload, outbox.attempts)
+            .where(
+                outbox.status == STATUS_PENDING,
+                outbox.next_attempt_at <= now,
+                lease_free,
+                ~select(older.id).where(
+                    older.marzban_username == outbox.marzban_username,
+                    older.id < outbox.id,
+                    older.status == STATUS_PENDING,
+                ).exists(),
+            )
+            .order_by(outbox.id)
+            .limit(MARZBAN_OUTBOX_BATCH_SIZE)
+        )
+        claimed = []
+        for row in result.all():
+            # Conditional update: of several workers seeing the same entry, exactly one gets it
+            lease = await db.execute(
+                update(outbox)
+                .where(outbox.id == row.id, outbox.status == STATUS_PENDING, lease_free)
+                .values(locked_until=now + timedelta(seconds=MARZBAN_OUTBOX_LEASE_SECONDS), attempts=outbox.attempts + 1)
+            )
+            if lease.rowcount == 1:
+                claimed.append({
+                    "id": row.id, "operation": row.operation, "marzban_username": row.marzban_username,
+                    "payload": json.loads(row.payload) if row.payload else {}, "attempt": row.attempts + 1,
+                })
+        await db.commit()
+    return claimed
+
+async def _apply(entry: Dict[str, Any]) -> None:
+    """Applies one entry to Marzban and, in one transaction, to the local row and the entry itself."""
+    username = entry["marzban_username"]
+    arguments = dict(entry["payload"])
+    node = arguments.pop("node", None) # Marzban node of the user (entries from before multi-node have none)
+    hold_id = arguments.pop("hold_id", None) # Balance hold of the purchase, committed once the user exists
+    vpn_user = models.VpnUser
+    if entry["operation"] == OP_CREATE_USER:
+        try:
+            marzban_user = await marzban_service.add_marzban_user(username=username, node=node, **arguments)
+        except marzban_service.MarzbanAPIError as e:
+            if e.status_code != 409 or entry["attempt"] == 1:
+                raise
+            # An earlier attempt went through but wasn't recorded (e.g. the worker died)
+            marzban_user = await marzban_service.get_marzban_user_details(username, node=node, use_cache=False)
+        snapshot = snapshot_from_marzban(marzban_user)
+        local_change = (
+            update(vpn_user)
+            .where(vpn_user.marzban_username == username, vpn_user.provisioning_status == "pending")
+            .values(provisioning_status="provisioned", usage_synced_at=datetime.utcnow(),
+                    usage_fingerprint=usage_fingerprint(snapshot), **snapshot)
+        )
+    elif entry["operation"] == OP_DELETE_USER:
+        try:
+            await marzban_service.delete_marzban_user(username, node=node)
+        except marzban_service.MarzbanAPIError as e:
+            if e.status_code != 404: # Already gone (or never created) is what we wanted
+                raise
+        local_change = delete(vpn_user).where(vpn_user.marzban_username == username, vpn_user.provisioning_status == "deleting")
+    elif entry["operation"] == OP_MODIFY_USER:
+        marzban_user = await marzban_service.modify_marzban_user(username, arguments["modifications"], node=node)
+        snapshot = snapshot_from_marzban(marzban_user)
+        local_change = (
+            update(vpn_user)
+            .where(vpn_user.marzban_username == username)
+            .values(usage_synced_at=datetime.utcnow(), usage_fingerprint=usage_fingerprint(snapshot), **snapshot)
+        )
+    else:
+        raise ValueError(f"Unknown outbox operation '{entry['operation']}'")
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(local_change)
+        if entry["operation"] == OP_CREATE_USER:
+            if result.rowcount == 1:
+                if hold_id:
+                    await ledger_service.settle_hold(db, hold_id)
+            else:
+                # The local row was deleted while the creation was queued: undo it in Marzban
+                # and don't charge for a user the admin no longer has
+                if hold_id:
+                    await ledger_service.settle_hold(db, hold_id, [])
+                enqueue(db, OP_DELETE_USER, username, payload={"node": node} if node else None)
+        await db.execute(
+            update(models.MarzbanOutbox).where(models.MarzbanOutbox.id == entry["id"])
+            .values(status=STATUS_DONE, processed_at=datetime.utcnow(), locked_until=None, last_error=None)
+        )
+        await db.commit()
+    if entry["operation"] == OP_CREATE_USER and result.rowcount != 1:
+        notify_outbox()
+
+async def _record_failure(entry: Dict[str, Any], error: Exception) -> str:
+    """Schedules a retry, or gives up on permanent errors and after MARZBAN_OUTBOX_MAX_ATTEMPTS."""
+    outbox = models.MarzbanOutbox
+    detail = str(getattr(error, "detail", error))[:500]
+    values: Dict[str, Any] = {"locked_until": None, "last_error": detail}
+    status_code = getattr(error, "status_code", None)
+
+    if isinstance(error, marzban_service.MarzbanUnavailableError):
+        # Refused locally (circuit open): Marzban wasn't asked, so it doesn't use up an attempt
+        values.update(next_attempt_at=datetime.utcnow() + timedelta(seconds=error.retry_after), attempts=outbox.attempts - 1)
+        outcome = STATUS_PENDING
+    elif status_code in _PERMANENT_STATUS_CODES or entry["attempt"] >= MARZBAN_OUTBOX_MAX_ATTEMPTS:
+        values.update(status=STATUS_FAILED, processed_at=datetime.utcnow())
+        outcome = STATUS_FAILED
+    else:
+        values.update(next_attempt_at=datetime.utcnow() + timedelta(seconds=_backoff(entry["attempt"])))
+        outcome = STATUS_PENDING
+
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(outbox).where(outbox.id == entry["id"]).values(**values))
+        if outcome == STATUS_FAILED:
+            vpn_user = models.VpnUser
+            if entry["operation"] == OP_CREATE_USER:
+                local_change = update(vpn_user).where(vpn_user.marzban_username == entry["marzban_username"],
+                                                      vpn_user.provisioning_status == "pending")
+                await db.execute(local_change.values(provisioning_status="failed"))
+                if entry["payload"].get("hold_id"):
+                    # The user was never created, so the purchase is not charged
+                    await ledger_service.settle_hold(db, entry["payload"]["hold_id"], [])
+            elif entry["operation"] == OP_DELETE_USER:
+                # The user still exists in Marzban; the admin can request the deletion again
+                local_change = update(vpn_user).where(vpn_user.marzban_username == entry["marzban_username"],
+                                                      vpn_user.provisioning_status == "deleting")
+                await db.execute(local_change.values(provisioning_status="provisioned"))
+            print(f"Marzban outbox entry {entry['id']} ({entry['operation']} {entry['marzban_username']}) failed: {detail}")
+        await db.commit()
+    return outcome
+
+async def _process(entry: Dict[str, Any]) -> str:
+    try:
+        await _apply(entry)
+        return STATUS_DONE
+    except Exception as e:
+        return await _record_failure(entry, e)
+
+async def process_outbox_once() -> Dict[str, int]:
+    """Claims and applies one round of due entries. Returns counts per outcome."""
+    entries = await _claim_due_entries()
+    semaphore = asyncio.Semaphore(MARZBAN_OUTBOX_CONCURRENCY)
+
+    async def _run(entry: Dict[str, Any]) -> str:
+        async with semaphore:
+            return await _process(entry)
+
+    outcomes = await asyncio.gather(*(_run(entry) for entry in entries))
+    return {
+        "claimed": len(entries),
+        "done": outcomes.count(STATUS_DONE),
+        "retrying": outcomes.count(STATUS_PENDING),
+        "failed": outcomes.count(STATUS_FAILED),
+    }
+
+async def get_outbox_stats() -> Dict[str, Any]:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(models.MarzbanOutbox.status, func.count(), func.min(models.MarzbanOutbox.next_attempt_at))
+            .group_by(models.MarzbanOutbox.status)
+        )
+        rows = result.all()
+    stats: Dict[str, Any] = {status: count for status, count, _ in rows}
+    oldest_due = next((oldest for status, _, oldest in rows if status == STATUS_PENDING), None)
+    stats["oldest_pending_next_attempt_at"] = oldest_due
+    stats["worker_running"] = _worker_task is not None and not _worker_task.done()
+    return stats
+
+async def _outbox_loop() -> None:
+    while True:
+        _wakeup.clear()
+        try:
+            stats = await process_outbox_once()
+            if stats["claimed"]:
+                print(f"Marzban outbox: {stats}")
+            if stats["claimed"] >= MARZBAN_OUTBOX_BATCH_SIZE:
+                continue # More may be due right away (e.g. after a burst)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Never let a failed round kill the loop; the entries stay pending
+            print(f"Marzban outbox round failed: {e}")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=MARZBAN_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+def start_outbox_worker() -> None:
+    """Starts the background outbox worker. Called on app startup."""
+    global _worker_task
+    if MARZBAN_OUTBOX_POLL_SECONDS <= 0 or (_worker_task and not _worker_task.done()):
+        return
+    _worker_task = asyncio.create_task(_outbox_loop())
+
+async def stop_outbox_worker() -> None:
+    """Cancels the background outbox worker. Called on app shutdown."""
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        try:
+            await _worker_task
+        except asyncio.CancelledError:
+            pass
+        _worker_task = None
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import select, update, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import zarinpal_service, ledger_service
+from .principal_cache import invalidate_principal, PRINCIPAL_ADMIN
+
+load_dotenv()
+
+# A Zarinpal callback can arrive more than once for the same payment (double clicks, page
+# refreshes, gateway retries). Each payment moves pending -> verifying -> completed / failed
+# through conditional UPDATEs, so exactly one callback verifies it and credits the balance ledger;
+# the others return the recorded outcome without calling Zarinpal.
+# A 'verifying' claim older than this is taken over (its worker died during the verify call).
+PAYMENT_VERIFY_LEASE_SECONDS = int(os.getenv("PAYMENT_VERIFY_LEASE_SECONDS", "120"))
+# Final outcomes are also kept per worker, so replays don't even need the DB
+PAYMENT_CALLBACK_CACHE_TTL_SECONDS = float(os.getenv("PAYMENT_CALLBACK_CACHE_TTL_SECONDS", "3600"))
+PAYMENT_CALLBACK_CACHE_MAX_ENTRIES = int(os.getenv("PAYMENT_CALLBACK_CACHE_MAX_ENTRIES", "10000"))
+
+STATUS_PENDING = "pending"
+STATUS_VERIFYING = "verifying"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+STATUS_EXPIRED = "expired" # Never paid; set by the reconciler (services/reconciliation_service.py)
+
+# Callback outcomes (see CallbackOutcome.error)
+ERROR_NOT_FOUND = "transaction_not_found"
+ERROR_CANCELLED = "payment_cancelled"
+ERROR_VERIFICATION_FAILED = "verification_failed"
+ERROR_IN_PROGRESS = "verification_in_progress"
+ERROR_EXPIRED = "payment_expired"
+ERROR_INTERNAL = "internal_error"
+
+_outcome_lock = threading.Lock()
+_outcomes: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_outcome_stats = {"replays_from_cache": 0, "replays_from_db": 0, "verified": 0}
+
+
+def _cached_outcome(authority: str) -> Optional[Dict[str, Any]]:
+    with _outcome_lock:
+        entry = _outcomes.get(authority)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > PAYMENT_CALLBACK_CACHE_TTL_SECONDS:
+            del _outcomes[authority]
+            return None
+        _outcomes.move_to_end(authority)
+        return entry[1]
+
+def _remember_outcome(authority: str, outcome: Dict[str, Any]) -> Dict[str, Any]:
+    """Caches final outcomes only; a payment still pending or verifying may change."""
+    if PAYMENT_CALLBACK_CACHE_TTL_SECONDS > 0 and outcome["status"] in (STATUS_COMPLETED, STATUS_FAILED):
+        with _outcome_lock:
+            _outcomes[authority] = (time.monotonic(), outcome)
+            _outcomes.move_to_end(authority)
+            while len(_outcomes) > PAYMENT_CALLBACK_CACHE_MAX_ENTRIES:
+                _outcomes.popitem(last=False)
+    return outcome
+
+def _outcome_of(payment_log: Optional[models.PaymentLog]) -> Dict[str, Any]:
+    """The outcome to report for a payment some other callback already handled (or is handling)."""
+    if payment_log is None:
+        return {"status": STATUS_FAILED, "error": ERROR_NOT_FOUND}
+    if payment_log.status == STATUS_COMPLETED:
+        return {"status": STATUS_COMPLETED, "ref_id": payment_log.ref_id}
+    if payment_log.status == STATUS_VERIFYING:
+        return {"status": STATUS_VERIFYING, "error": ERROR_IN_PROGRESS}
+    if payment_log.status == STATUS_FAILED:
+        return {"status": STATUS_FAILED, "error": ERROR_VERIFICATION_FAILED}
+    if payment_log.status == STATUS_EXPIRED:
+        return {"status": STATUS_FAILED, "error": ERROR_EXPIRED}
+    return {"status": payment_log.status, "error": ERROR_INTERNAL}
+
+# Zarinpal codes saying the authority has no paid transaction: -51 (not paid), -54 (unknown authority)
+NOT_PAID_CODES = (-51, -54)
+
+def is_transient(error: zarinpal_service.ZarinpalError) -> bool:
+    """Network errors, rate limiting and 5xx: the payment may well be fine, so it is left to be verified again."""
+    return error.code in (-1, 429) or (isinstance(error.code, int) and error.code >= 500)
+
+def is_not_paid(error: zarinpal_service.ZarinpalError) -> bool:
+    """Zarinpal answered that the payment wasn't made, as opposed to refusing the request (auth, merchant, amount)."""
+    return error.code in NOT_PAID_CODES
+
+def claimable(now: datetime):
+    """Payments a callback (or the reconciler) may claim: pending, or stuck in 'verifying' past the lease."""
+    payment = models.PaymentLog
+    return or_(
+        payment.status == STATUS_PENDING,
+        and_(payment.status == STATUS_VERIFYING,
+             payment.verifying_since < now - timedelta(seconds=PAYMENT_VERIFY_LEASE_SECONDS)),
+    )
+
+async def complete_payment(db: AsyncSession, payment_id: int, admin_id: int, amount: float, ref_id: Any) -> Optional[str]:
+    """
+    Completes a claimed payment and credits the admin's balance, without committing.
+    Returns the admin's username (for invalidating their cached principal), or None
+    if the payment is no longer claimed by the caller.
+    """
+    payment = models.PaymentLog
+    completed = await db.execute(
+        update(payment).where(payment.id == payment_id, payment.status == STATUS_VERIFYING)
+        .values(status=STATUS_COMPLETED, ref_id=str(ref_id), verified_at=datetime.utcnow(), verifying_since=None)
+    )
+    if completed.rowcount != 1:
+        return None
+    db.add(ledger_service.payment_credit(payment_id, admin_id, amount))
+    return (await db.execute(select(models.Admin.username).where(models.Admin.id == admin_id))).scalar() or ""
+
+async def release_payment(db: AsyncSession, payment_id: int, status: str) -> None:
+    """Ends a claim without a verified payment: back to 'pending' to retry, or a final status. Doesn't commit."""
+    payment = models.PaymentLog
+    await db.execute(
+        update(payment).where(payment.id == payment_id, payment.status == STATUS_VERIFYING)
+        .values(status=status, verifying_since=None)
+    )
+
+async def process_zarinpal_callback(authority: str, status_ok: bool) -> Dict[str, Any]:
+    """
+    Handles one Zarinpal callback for `authority`. Returns the outcome:
+    {"status": "completed", "ref_id": ...} or {"status": ..., "error": ERROR_*}.
+
+    The verify call runs outside any DB transaction; the balance is credited with a ledger
+    entry inserted in the same transaction that completes the payment.
+    """
+    cached = _cached_outcome(authority)
+    if cached is not None:
+        _outcome_stats["replays_from_cache"] += 1
+        return cached
+
+    payment = models.PaymentLog
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        if not status_ok:
+            # The payer cancelled at the gateway: nothing to verify
+            result = await db.execute(
+                update(payment).where(payment.authority == authority, payment.status == STATUS_PENDING)
+                .values(status=STATUS_FAILED)
+            )
+            await db.commit()
+            if result.rowcount == 1:
+                return _remember_outcome(authority, {"status": STATUS_FAILED, "error": ERROR_CANCELLED})
+        else:
+            # The claim: of concurrent callbacks, exactly one moves the payment to 'verifying'
+            result = await db.execute(
+                update(payment).where(payment.authority == authority, claimable(now))
+                .values(status=STATUS_VERIFYING, verifying_since=now)
+            )
+            await db.commit()
+
+        row = (await db.execute(
+            select(payment.id, payment.admin_id, payment.amount, payment.status, payment.ref_id)
+            .where(payment.authority == authority)
+        )).first()
+        if result.rowcount != 1 or row is None:
+            _outcome_stats["replays_from_db"] += 1
+            return _remember_outcome(authority, _outcome_of(row))
+    payment_id, admin_id, amount = row.id, row.admin_id, row.amount
+
+    try:
+        ref_id = await zarinpal_service.verify_payment(amount=int(amount), authority=authority)
+    except zarinpal_service.ZarinpalError as e:
+        print(f"Zarinpal verification error: {e.message}")
+        # A transient error hands the payment back for the next callback; a rejection is final
+        final = not is_transient(e)
+        async with AsyncSessionLocal() as db:
+            await release_payment(db, payment_id, STATUS_FAILED if final else STATUS_PENDING)
+            await db.commit()
+        outcome = {"status": STATUS_FAILED if final else STATUS_PENDING, "error": ERROR_VERIFICATION_FAILED, "code": e.code}
+        return _remember_outcome(authority, outcome)
+
+    async with AsyncSessionLocal() as db:
+        credited = await complete_payment(db, payment_id, admin_id, amount, ref_id)
+        if credited is None:
+            # Our claim expired and another callback took over; it credits the balance
+            await db.rollback()
+            return _outcome_of(await db.get(payment, payment_id))
+        await db.commit()
+    if credited:
+        invalidate_principal(PRINCIPAL_ADMIN, credited) # Cached principal carries the old balance
+    _outcome_stats["verified"] += 1
+    return _remember_outcome(authority, {"status": STATUS_COMPLETED, "ref_id": str(ref_id)})
+
+def clear_callback_cache() -> None:
+    with _outcome_lock:
+        _outcomes.clear()
+
+def get_callback_stats() -> Dict[str, Any]:
+    return {"cached_outcomes": len(_outcomes), **_outcome_stats}
@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import models, schemas
+from .shared_state import get_shared_store, SharedStateError
+
+load_dotenv()
+
+# The serialized active-plans response is cached per worker and rebuilt when the plans
+# version in the shared store changes. create/update/delete_plan bump the version, so other
+# workers notice within PLAN_CACHE_POLL_SECONDS.
+PLAN_CACHE_POLL_SECONDS = float(os.getenv("PLAN_CACHE_POLL_SECONDS", "1"))
+# Browser caching of /admin/plans. 0 means "revalidate every time" (answered with a cheap 304).
+PLAN_CACHE_MAX_AGE_SECONDS = int(os.getenv("PLAN_CACHE_MAX_AGE_SECONDS", "0"))
+
+PLANS_VERSION_KEY = "plans_version"
+
+_cached: Optional[Tuple[int, str, bytes]] = None # (version, etag, JSON body)
+_version: int = 0
+_version_polled_at: float = 0.0
+_rebuild_lock = asyncio.Lock()
+
+
+def _current_version() -> int:
+    global _version, _version_polled_at
+    now = time.time()
+    if now - _version_polled_at >= PLAN_CACHE_POLL_SECONDS:
+        try:
+            _version = get_shared_store().get(PLANS_VERSION_KEY) or 0
+        except SharedStateError as e:
+            print(f"Plan cache could not read the plans version: {e}")
+        _version_polled_at = now
+    return _version
+
+def bump_plans_version() -> int:
+    """Invalidates the cached plans on every worker. Call after committing a plan change."""
+    global _cached, _version, _version_polled_at
+    _cached = None
+    try:
+        _version = get_shared_store().update(PLANS_VERSION_KEY, lambda version: (version or 0) + 1)
+    except SharedStateError as e:
+        # Other workers will keep serving the old list until the store is reachable again
+        print(f"Plan cache could not bump the plans version: {e}")
+    _version_polled_at = time.time()
+    return _version
+
+def cache_control_header() -> str:
+    if PLAN_CACHE_MAX_AGE_SECONDS > 0:
+        return f"private, max-age={PLAN_CACHE_MAX_AGE_SECONDS}"
+    return "private, no-cache"
+
+async def get_active_plans(db: AsyncSession) -> Tuple[str, bytes]:
+    """
+    Returns (etag, JSON body) of the active plans, from the cache while the plans version is unchanged.
+    Concurrent misses share one rebuild.
+    """
+    global _cached
+    version = _current_version()
+    cached = _cached
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+
+    async with _rebuild_lock:
+        cached = _cached
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        result = await db.execute(select(models.Plan).where(models.Plan.is_active == True).order_by(models.Plan.id))
+        plans = [schemas.Plan.from_orm(plan) for plan in result.scalars().all()]
+        body = json.dumps(jsonable_encoder(plans)).encode()
+        etag = f'"plans-{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+        _cached = (version, etag, body)
+        return etag, body
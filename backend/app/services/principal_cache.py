@@ -0,0 +1,193 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+
+from .shared_state import get_shared_store, SharedStateError
+
+load_dotenv()
+
+# Authenticated principals (Admin / SuperAdmin rows) are cached per worker so that
+# authenticated requests don't need a SELECT each. Changes made through the API
+# invalidate entries on all workers within PRINCIPAL_CACHE_POLL_SECONDS; anything
+# else (e.g. manual DB edits) becomes visible after at most PRINCIPAL_CACHE_TTL_SECONDS.
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60")) # 0 disables the cache
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+PRINCIPAL_CACHE_POLL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_POLL_SECONDS", "1"))
+
+# Shared-store keys: "<kind>:<username>" -> unix time
+INVALIDATIONS_KEY = "principal_invalidations" # Cached entries older than this are dropped
+REVOCATIONS_KEY = "principal_revocations" # Tokens issued at or before this are rejected
+
+PRINCIPAL_ADMIN = "admin"
+PRINCIPAL_SUPER_ADMIN = "super_admin"
+
+
+class PrincipalCache:
+    """TTL + LRU cache of principals keyed by (kind, username, token id)."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Used from the event loop and from the threadpool running sync endpoints
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, Optional[str]], Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind: str, username: str, jti: Optional[str], not_before: float = 0) -> Optional[Any]:
+        key = (kind, username, jti)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                cached_at, principal = entry
+                if time.time() - cached_at <= self.ttl_seconds and cached_at > not_before:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return principal
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, kind: str, username: str, jti: Optional[str], principal: Any, loaded_at: float = None) -> None:
+        """`loaded_at` is when the principal was read from the DB (defaults to now)."""
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[(kind, username, jti)] = (loaded_at or time.time(), principal)
+            self._entries.move_to_end((kind, username, jti))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kind: str, username: str) -> None:
+        """Drops every cached token of one principal."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == kind and key[1] == username]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "ttl_seconds": self.ttl_seconds, "max_entries": self.max_entries}
+
+
+_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+# Local copies of the shared invalidation / revocation maps, refreshed every PRINCIPAL_CACHE_POLL_SECONDS
+_shared_lock = threading.Lock()
+_invalidations: Dict[str, float] = {}
+_revocations: Dict[str, float] = {}
+_polled_at: float = 0.0
+# Entries recorded by this worker that are still being written to the shared store (see _record_shared);
+# merged into every poll so this worker applies them right away
+_unwritten: Dict[str, Dict[str, float]] = {INVALIDATIONS_KEY: {}, REVOCATIONS_KEY: {}}
+_writes_in_progress: set = set()
+
+
+def _principal_key(kind: str, username: str) -> str:
+    return f"{kind}:{username}"
+
+def _poll_shared_state(force: bool = False) -> None:
+    global _invalidations, _revocations, _polled_at
+    now = time.time()
+    if not force and now - _polled_at < PRINCIPAL_CACHE_POLL_SECONDS:
+        return
+    try:
+        store = get_shared_store()
+        invalidations = store.get(INVALIDATIONS_KEY) or {}
+        revocations = store.get(REVOCATIONS_KEY) or {}
+    except SharedStateError as e:
+        # Keep the last known state; the TTL still bounds staleness
+        print(f"Principal cache could not read shared invalidations: {e}")
+        return
+    with _shared_lock:
+        invalidations = {**invalidations, **_unwritten[INVALIDATIONS_KEY]}
+        revocations = {**revocations, **_unwritten[REVOCATIONS_KEY]}
+        _invalidations, _revocations, _polled_at = invalidations, revocations, now
+
+def _record_shared(store_key: str, kind: str, username: str, keep_seconds: float) -> None:
+    """Adds `kind:username` -> now to a shared map, dropping entries older than `keep_seconds`."""
+    now = time.time()
+    key = _principal_key(kind, username)
+
+    def _add(entries: Optional[Dict[str, float]]) -> Dict[str, float]:
+        entries = {entry_key: at for entry_key, at in (entries or {}).items() if now - at <= keep_seconds}
+        entries[key] = now
+        return entries
+
+    def _write() -> None:
+        try:
+            get_shared_store().update(store_key, _add)
+        except SharedStateError as e:
+            print(f"Principal cache could not update '{store_key}' in the shared store: {e}")
+        finally:
+            with _shared_lock:
+                if _unwritten[store_key].get(key) == now:
+                    del _unwritten[store_key][key]
+
+    with _shared_lock:
+        _unwritten[store_key][key] = now
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write() # In a worker thread (sync endpoint), where waiting for the store's lock is fine
+        return
+    # The store's update may wait for a file lock, so on the event loop it runs in a thread
+    write = loop.run_in_executor(None, _write)
+    _writes_in_progress.add(write)
+    write.add_done_callback(_writes_in_progress.discard)
+
+def get_cached_principal(kind: str, username: str, jti: Optional[str]) -> Optional[Any]:
+    if PRINCIPAL_CACHE_TTL_SECONDS <= 0:
+        return None
+    _poll_shared_state()
+    with _shared_lock:
+        not_before = _invalidations.get(_principal_key(kind, username), 0)
+    return _cache.get(kind, username, jti, not_before=not_before)
+
+def cache_principal(kind: str, username: str, jti: Optional[str], principal: Any, loaded_at: float) -> None:
+    """
+    Caches a principal. It must be detached from its session (expunged) first.
+    `loaded_at` (time.time() taken before the DB read) makes an invalidation that
+    raced with the read win over the possibly outdated row.
+    """
+    _cache.put(kind, username, jti, principal, loaded_at=loaded_at)
+
+def invalidate_principal(kind: str, username: str) -> None:
+    """Drops a principal from the cache of this worker and, via the shared store, of all workers."""
+    _cache.invalidate(kind, username)
+    # An invalidation only matters while entries cached before it could still be alive
+    _record_shared(INVALIDATIONS_KEY, kind, username, keep_seconds=PRINCIPAL_CACHE_TTL_SECONDS)
+    _poll_shared_state(force=True)
+
+def revoke_principal(kind: str, username: str, token_lifetime_seconds: float) -> None:
+    """
+    Invalidates a principal and rejects every token issued to it so far.
+    The revocation is kept for `token_lifetime_seconds`, after which those tokens have expired anyway.
+    """
+    _cache.invalidate(kind, username)
+    _record_shared(INVALIDATIONS_KEY, kind, username, keep_seconds=PRINCIPAL_CACHE_TTL_SECONDS)
+    _record_shared(REVOCATIONS_KEY, kind, username, keep_seconds=token_lifetime_seconds)
+    _poll_shared_state(force=True)
+
+def is_token_revoked(kind: str, username: str, issued_at: Optional[int]) -> bool:
+    _poll_shared_state()
+    with _shared_lock:
+        revoked_at = _revocations.get(_principal_key(kind, username))
+    if revoked_at is None:
+        return False
+    # Tokens without "iat" predate revocation support and are treated as issued before it.
+    # "iat" has one-second resolution, so a login in the same second as the revocation is rejected too.
+    return issued_at is None or issued_at <= revoked_at
+
+def get_principal_cache_stats() -> Dict[str, Any]:
+    return _cache.stats()
+
+def clear_principal_cache() -> None:
+    _cache.clear()
@@ -0,0 +1,208 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import select, update, func, or_, and_
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import lease_service, payment_service, zarinpal_service
+from .principal_cache import invalidate_principal, PRINCIPAL_ADMIN
+from .resilience import RateLimiter
+
+load_dotenv()
+
+# Settles payments whose callback never arrived (the payer closed the tab after paying, or
+# before). Old pending payments are verified with Zarinpal: paid ones are completed and
+# credited like in the callback, unpaid ones are marked 'expired'.
+# One worker across all hosts runs each pass (lease in the scheduler_leases table).
+PAYMENT_RECONCILE_INTERVAL_SECONDS = int(os.getenv("PAYMENT_RECONCILE_INTERVAL_SECONDS", "300")) # 0 disables it
+# Younger pending payments are left to their callback (the payer may still be on the gateway)
+PAYMENT_RECONCILE_MIN_AGE_MINUTES = int(os.getenv("PAYMENT_RECONCILE_MIN_AGE_MINUTES", "30"))
+PAYMENT_RECONCILE_BATCH_SIZE = int(os.getenv("PAYMENT_RECONCILE_BATCH_SIZE", "100")) # Payments claimed and settled per transaction
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "4")) # Verify calls in flight
+PAYMENT_RECONCILE_RATE_PER_SECOND = float(os.getenv("PAYMENT_RECONCILE_RATE_PER_SECOND", "5")) # Verify calls started per second
+PAYMENT_RECONCILE_LEASE_SECONDS = int(os.getenv("PAYMENT_RECONCILE_LEASE_SECONDS", "900")) # Longer than a pass takes
+
+RECONCILE_LEASE = "payment_reconciliation"
+
+_reconcile_task: Optional[asyncio.Task] = None
+_last_pass: Dict[str, Any] = {}
+_totals = {"passes": 0, "settled": 0, "expired": 0, "retried": 0}
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _open_payments(cutoff: datetime):
+    # Range scan on (status, created_at)
+    payment = models.PaymentLog
+    return and_(
+        payment.status.in_((payment_service.STATUS_PENDING, payment_service.STATUS_VERIFYING)),
+        payment.created_at <= cutoff,
+    )
+
+async def _backlog(cutoff: datetime) -> Dict[str, Any]:
+    """Payments waiting for reconciliation, and the age of the oldest one."""
+    payment = models.PaymentLog
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(func.count(payment.id), func.min(payment.created_at)).where(_open_payments(cutoff)))
+        count, oldest = result.one()
+    age = (datetime.utcnow() - _naive_utc(oldest)).total_seconds() if oldest else 0.0
+    return {"backlog": count, "oldest_age_seconds": round(age, 1)}
+
+async def _claim(rows: List[Any], now: datetime) -> List[Any]:
+    """Claims the batch like a callback would; rows a callback is verifying right now are skipped."""
+    payment = models.PaymentLog
+    claimed = []
+    async with AsyncSessionLocal() as db:
+        for row in rows:
+            result = await db.execute(
+                update(payment).where(payment.id == row.id, payment_service.claimable(now))
+                .values(status=payment_service.STATUS_VERIFYING, verifying_since=now)
+            )
+            if result.rowcount == 1:
+                claimed.append(row)
+        await db.commit()
+    return claimed
+
+async def _verify(row: Any, semaphore: asyncio.Semaphore, limiter: RateLimiter, stats: Dict[str, Any]) -> Any:
+    """Returns the ref_id, or the ZarinpalError."""
+    async with semaphore:
+        await limiter.acquire()
+        started = time.monotonic()
+        try:
+            return await zarinpal_service.verify_payment(amount=int(row.amount), authority=row.authority)
+        except zarinpal_service.ZarinpalError as e:
+            return e
+        finally:
+            stats["verify_seconds"] += time.monotonic() - started
+
+async def _settle(claimed: List[Any], outcomes: List[Any], stats: Dict[str, Any]) -> None:
+    """Completes, expires or hands back the whole batch in one transaction."""
+    credited_admins = set()
+    latencies = []
+    async with AsyncSessionLocal() as db:
+        for row, outcome in zip(claimed, outcomes):
+            if not isinstance(outcome, zarinpal_service.ZarinpalError):
+                credited = await payment_service.complete_payment(db, row.id, row.admin_id, row.amount, outcome)
+                if credited is not None:
+                    stats["settled"] += 1
+                    latencies.append((datetime.utcnow() - _naive_utc(row.created_at)).total_seconds())
+                    if credited:
+                        credited_admins.add(credited)
+            elif payment_service.is_not_paid(outcome):
+                # Zarinpal has no successful payment for this authority (-51, -54): it never will
+                await payment_service.release_payment(db, row.id, payment_service.STATUS_EXPIRED)
+                stats["expired"] += 1
+            else:
+                # Outages, rate limits and refused requests (merchant settings, amount) say nothing
+                # about whether the payer paid, so the next pass tries again
+                await payment_service.release_payment(db, row.id, payment_service.STATUS_PENDING)
+                stats["retried"] += 1
+        await db.commit()
+    for username in credited_admins:
+        invalidate_principal(PRINCIPAL_ADMIN, username) # Cached principal carries the old balance
+    if latencies:
+        stats["settle_latency_max_seconds"] = round(max(stats["settle_latency_max_seconds"], max(latencies)), 1)
+        stats["_latency_sum"] += sum(latencies)
+
+async def reconcile_once() -> Optional[Dict[str, Any]]:
+    """
+    Runs one reconciliation pass if this worker gets the lease; returns its statistics,
+    or None if another worker holds the lease.
+    """
+    global _last_pass
+    lease = await lease_service.acquire_lease(RECONCILE_LEASE, PAYMENT_RECONCILE_LEASE_SECONDS)
+    if lease is None:
+        return None
+    started = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(minutes=PAYMENT_RECONCILE_MIN_AGE_MINUTES)
+    stats = {"claimed": 0, "settled": 0, "expired": 0, "retried": 0, "batches": 0,
+             "verify_seconds": 0.0, "settle_latency_max_seconds": 0.0, "_latency_sum": 0.0}
+    semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+    limiter = RateLimiter(PAYMENT_RECONCILE_RATE_PER_SECOND)
+    payment = models.PaymentLog
+    try:
+        stats.update(await _backlog(cutoff))
+        after = None
+        while True:
+            query = select(payment.id, payment.admin_id, payment.amount, payment.authority, payment.created_at).where(_open_payments(cutoff))
+            if after is not None:
+                # Keyset: payments skipped in the previous batch (or handed back for a retry) are not read again
+                created_at, row_id = after
+                query = query.where(or_(payment.created_at > created_at, and_(payment.created_at == created_at, payment.id > row_id)))
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(query.order_by(payment.created_at, payment.id).limit(PAYMENT_RECONCILE_BATCH_SIZE))
+                rows = result.all()
+            if not rows:
+                break
+            after = (rows[-1].created_at, rows[-1].id)
+            claimed = await _claim(rows, datetime.utcnow())
+            if claimed:
+                stats["claimed"] += len(claimed)
+                outcomes = await asyncio.gather(*(_verify(row, semaphore, limiter, stats) for row in claimed))
+                await _settle(claimed, outcomes, stats)
+                stats["batches"] += 1
+            if len(rows) < PAYMENT_RECONCILE_BATCH_SIZE:
+                break
+    finally:
+        await lease_service.release_lease(RECONCILE_LEASE, last_run_at=datetime.utcnow())
+
+    latency_sum = stats.pop("_latency_sum")
+    stats["settle_latency_avg_seconds"] = round(latency_sum / stats["settled"], 1) if stats["settled"] else 0.0
+    stats["verify_seconds"] = round(stats["verify_seconds"], 3)
+    stats["rate_limited_seconds"] = round(limiter.waited_seconds, 3)
+    stats["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    for key in ("settled", "expired", "retried"):
+        _totals[key] += stats[key]
+    _totals["passes"] += 1
+    _last_pass = {**stats, "finished_at": datetime.utcnow().isoformat()}
+    return stats
+
+async def get_reconciliation_stats() -> Dict[str, Any]:
+    lease = await lease_service.get_lease(RECONCILE_LEASE)
+    cutoff = datetime.utcnow() - timedelta(minutes=PAYMENT_RECONCILE_MIN_AGE_MINUTES)
+    return {
+        **await _backlog(cutoff),
+        "last_pass_in_this_worker": _last_pass or None,
+        "totals_in_this_worker": dict(_totals),
+        "last_run_at": lease.last_run_at if lease else None,
+        "lease_holder": lease.holder if lease else None,
+        "running": _reconcile_task is not None and not _reconcile_task.done(),
+    }
+
+async def _reconcile_loop() -> None:
+    while True:
+        try:
+            stats = await reconcile_once()
+            if stats and stats["claimed"]:
+                print(f"Payment reconciliation: {stats}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Never let a failed pass kill the loop; claimed payments are taken over after the verify lease
+            print(f"Payment reconciliation failed: {e}")
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL_SECONDS)
+
+def start_reconciliation() -> None:
+    """Starts the background payment reconciliation. Called on app startup."""
+    global _reconcile_task
+    if PAYMENT_RECONCILE_INTERVAL_SECONDS <= 0 or (_reconcile_task and not _reconcile_task.done()):
+        return
+    _reconcile_task = asyncio.create_task(_reconcile_loop())
+
+async def stop_reconciliation() -> None:
+    """Cancels the background payment reconciliation. Called on app shutdown."""
+    global _reconcile_task
+    if _reconcile_task is not None:
+        _reconcile_task.cancel()
+        try:
+            await _reconcile_task
+        except asyncio.CancelledError:
+            pass
+        _reconcile_task = None
@@ -0,0 +1,190 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+# Building blocks that keep a slow or failing upstream (Marzban) from tying up the panel.
+# All state is per worker process and only touched from the event loop.
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Closed: calls pass and their outcomes are recorded over a sliding window. When at least
+    `min_calls` were made in the window and the share of failed or slow calls reaches
+    `failure_rate`, the breaker opens.
+    Open: calls are refused for `open_seconds`, then the breaker goes half-open.
+    Half-open: up to `half_open_calls` probes pass; a good probe closes the breaker,
+    a bad one opens it again.
+    """
+
+    def __init__(self, window_seconds: float, min_calls: int, failure_rate: float,
+                 slow_call_seconds: float, open_seconds: float, half_open_calls: int = 1):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = STATE_CLOSED
+        self.opened_at = 0.0
+        self._probes = 0
+        self._outcomes: Deque[Tuple[float, bool]] = deque() # (time, failed)
+        self.rejected = 0
+        self.times_opened = 0
+
+    def _trim(self, now: float) -> None:
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now. Every allowed call must be followed by record() or cancel()."""
+        now = time.monotonic()
+        if self.state == STATE_OPEN and now - self.opened_at >= self.open_seconds:
+            self.state, self._probes = STATE_HALF_OPEN, 0
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_HALF_OPEN and self._probes < self.half_open_calls:
+            self._probes += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, failed: bool, duration: float) -> None:
+        now = time.monotonic()
+        failed = failed or duration >= self.slow_call_seconds
+        if self.state == STATE_HALF_OPEN:
+            if failed:
+                self._open(now)
+            else:
+                self.state = STATE_CLOSED
+                self._outcomes.clear()
+            return
+        if self.state == STATE_OPEN:
+            return # A call that started before the breaker opened
+        self._outcomes.append((now, failed))
+        self._trim(now)
+        calls = len(self._outcomes)
+        if calls >= self.min_calls and sum(1 for _, f in self._outcomes if f) / calls >= self.failure_rate:
+            self._open(now)
+
+    def cancel(self) -> None:
+        """For an allowed call that ended without a verdict on the upstream's health."""
+        if self.state == STATE_HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _open(self, now: float) -> None:
+        self.state, self.opened_at = STATE_OPEN, now
+        self._outcomes.clear()
+        self.times_opened += 1
+        print(f"Circuit breaker opened; refusing calls for {self.open_seconds}s")
+
+    def retry_after(self) -> int:
+        """Seconds until the breaker lets a probe through."""
+        if self.state != STATE_OPEN:
+            return 0
+        return max(1, int(self.opened_at + self.open_seconds - time.monotonic() + 0.999))
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim(time.monotonic())
+        calls = len(self._outcomes)
+        failures = sum(1 for _, failed in self._outcomes if failed)
+        return {
+            "state": self.state, "window_calls": calls, "window_failures": failures,
+            "rejected": self.rejected, "times_opened": self.times_opened, "retry_after": self.retry_after(),
+        }
+
+
+class RetryBudget:
+    """
+    Caps retries at `ratio` of the calls made in the last `window_seconds` (but always allows
+    `min_retries`), so retries can't multiply the load on an upstream that is already struggling.
+    """
+
+    def __init__(self, ratio: float, min_retries: int, window_seconds: float):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_seconds = window_seconds
+        self._calls: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self.denied = 0
+
+    def _trim(self, now: float) -> None:
+        for events in (self._calls, self._retries):
+            while events and now - events[0] > self.window_seconds:
+                events.popleft()
+
+    def record_call(self) -> None:
+        self._calls.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        """Takes one retry from the budget; False when it is used up."""
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= max(self.min_retries, self.ratio * len(self._calls)):
+            self.denied += 1
+            return False
+        self._retries.append(now)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim(time.monotonic())
+        return {"window_calls": len(self._calls), "window_retries": len(self._retries), "denied": self.denied}
+
+
+class BulkheadFull(Exception):
+    """Raised when no slot became free within the bulkhead's wait time."""
+    pass
+
+
+class Bulkhead:
+    """At most `max_concurrent` calls at a time; callers wait up to `max_wait_seconds` for a slot."""
+
+    def __init__(self, max_concurrent: int, max_wait_seconds: float):
+        self.max_concurrent = max_concurrent
+        self.max_wait_seconds = max_wait_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_use = 0
+        self.rejected = 0
+
+    async def __aenter__(self):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise BulkheadFull(f"All {self.max_concurrent} slots busy for {self.max_wait_seconds}s")
+        self.in_use += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_use -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_use": self.in_use, "max_concurrent": self.max_concurrent, "rejected": self.rejected}
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / `rate_per_second` apart; acquire() waits for the next free slot."""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self.waited_seconds = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval # Taken before sleeping, so concurrent callers queue up
+        if slot > now:
+            self.waited_seconds += slot - now
+            await asyncio.sleep(slot - now)
+
+
+def jittered_backoff(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    """'Full jitter' exponential backoff: uniform in [0, min(max, base * 2^attempt)]."""
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** attempt)))
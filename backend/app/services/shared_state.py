@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional
+from dotenv import load_dotenv
+
+try:
+    import fcntl  # POSIX only; gunicorn workers on the server always have it
+except ImportError:  # pragma: no cover - e.g. local development on Windows
+    fcntl = None
+
+load_dotenv()
+
+# Small key/value store shared between the gunicorn workers of one host.
+# "file" keeps one JSON file per key in SHARED_STATE_DIR, "memory" is a per-process stand-in for tests.
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "file")
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", os.path.join(tempfile.gettempdir(), "vpnpanel-shared"))
+SHARED_STATE_LOCK_TIMEOUT = float(os.getenv("SHARED_STATE_LOCK_TIMEOUT", "30"))
+
+
+class SharedStateError(Exception):
+    """Raised when the shared store cannot be read, written or locked."""
+    pass
+
+
+class SharedLockTimeout(SharedStateError):
+    """Raised when a shared lock is still held by someone else after the timeout."""
+    pass
+
+
+class MemorySharedStore:
+    """In-process store. Only shares state between coroutines of a single worker."""
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._update_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._data.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        self._data[key] = value
+
+    def update(self, key: str, func: Callable[[Optional[Any]], Any]) -> Any:
+        """Atomically replaces the value of `key` with func(current value) and returns it."""
+        with self._update_lock:
+            self._data[key] = func(self._data.get(key))
+            return self._data[key]
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    @asynccontextmanager
+    async def lock(self, key: str, timeout: Optional[float] = None):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        if timeout is not None and timeout <= 0:
+            if lock.locked():
+                raise SharedLockTimeout(f"Shared lock '{key}' is held")
+            await lock.acquire()
+        else:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise SharedLockTimeout(f"Timed out waiting for shared lock '{key}'")
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+class FileSharedStore:
+    """
+    Stores each key as a JSON file in a directory shared by all workers.
+    Writes are atomic (write to a temp file, then rename), and lock() takes an
+    exclusive flock on a per-key lock file so only one process runs the guarded section.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(self.directory, mode=0o700, exist_ok=True) # Holds credentials such as the Marzban token
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Could not read shared state '{key}': {e}")
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{key}.")
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            raise SharedStateError(f"Could not write shared state '{key}': {e}") from e
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def update(self, key: str, func: Callable[[Optional[Any]], Any]) -> Any:
+        """
+        Atomically replaces the value of `key` with func(current value) and returns it.
+        Blocks on the key's flock, so it is only meant for quick read-modify-write of small values.
+        """
+        if fcntl is None:
+            value = func(self.get(key))
+            self.set(key, value)
+            return value
+        try:
+            lock_file = open(os.path.join(self.directory, f"{key}.update.lock"), "w")
+        except OSError as e:
+            raise SharedStateError(f"Could not lock shared state '{key}': {e}") from e
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                value = func(self.get(key))
+                self.set(key, value)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @asynccontextmanager
+    async def lock(self, key: str, timeout: Optional[float] = None):
+        """`timeout` defaults to SHARED_STATE_LOCK_TIMEOUT; pass 0 to fail immediately if the lock is held."""
+        if fcntl is None:
+            yield
+            return
+
+        lock_file = open(os.path.join(self.directory, f"{key}.lock"), "w")
+        try:
+            # Poll with a non-blocking flock so waiting never blocks the event loop
+            deadline = time.monotonic() + (SHARED_STATE_LOCK_TIMEOUT if timeout is None else timeout)
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise SharedLockTimeout(f"Timed out waiting for shared lock '{key}'")
+                    await asyncio.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+
+_store = None
+
+def get_shared_store():
+    """Returns the process-wide shared store configured by SHARED_STATE_BACKEND."""
+    global _store
+    if _store is None:
+        if SHARED_STATE_BACKEND == "memory":
+            _store = MemorySharedStore()
+        else:
+            _store = FileSharedStore(SHARED_STATE_DIR)
+    return _store
+
+def set_shared_store(store) -> None:
+    """Replaces the shared store, e.g. with a MemorySharedStore in tests."""
+    global _store
+    _store = store
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import os
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+from sqlalchemy import select, update, func
+
+from .. import models
+from ..database import AsyncSessionLocal
+from . import marzban_service
+from .shared_state import get_shared_store, SharedStateError, SharedLockTimeout
+
+load_dotenv()
+
+# How often the background task pulls usage from Marzban. 0 disables the background sync.
+MARZBAN_SYNC_INTERVAL_SECONDS = int(os.getenv("MARZBAN_SYNC_INTERVAL_SECONDS", "30"))
+# Page size adapts between MIN and MAX so that one page takes roughly MARZBAN_SYNC_TARGET_PAGE_SECONDS
+MARZBAN_SYNC_PAGE_SIZE = int(os.getenv("MARZBAN_SYNC_PAGE_SIZE", "500")) # Initial page size
+MARZBAN_SYNC_MIN_PAGE_SIZE = int(os.getenv("MARZBAN_SYNC_MIN_PAGE_SIZE", "100"))
+MARZBAN_SYNC_MAX_PAGE_SIZE = int(os.getenv("MARZBAN_SYNC_MAX_PAGE_SIZE", "2000"))
+MARZBAN_SYNC_TARGET_PAGE_SECONDS = float(os.getenv("MARZBAN_SYNC_TARGET_PAGE_SECONDS", "2"))
+MARZBAN_SYNC_CONCURRENCY = int(os.getenv("MARZBAN_SYNC_CONCURRENCY", "4")) # Pages fetched in parallel per node
+# Endpoints serve the local snapshot while it is younger than this; older snapshots trigger a live lookup
+MARZBAN_USAGE_MAX_STALENESS_SECONDS = int(os.getenv("MARZBAN_USAGE_MAX_STALENESS_SECONDS", "120"))
+
+# Shared-store keys used to run one sync per interval across all workers of the host
+SYNC_LOCK_KEY = "usage_sync"
+SYNC_LAST_RUN_KEY = "usage_sync_last_run"
+
+_sync_task: Optional[asyncio.Task] = None
+# Adapted page size per Marzban node, since nodes differ in size and latency
+_page_sizes: Dict[str, int] = {}
+
+
+def snapshot_from_marzban(marzban_user: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Maps a Marzban UserResponse to the usage snapshot columns of models.VpnUser
+    (without usage_fingerprint, see usage_fingerprint()).
+    """
+    return {
+        "status_from_marzban": marzban_user.get("status"),
+        "used_traffic": marzban_user.get("used_traffic") or 0,
+        "data_limit": marzban_user.get("data_limit") or 0,
+        "marzban_expire": marzban_user.get("expire"),
+        "subscription_url": marzban_user.get("subscription_url"),
+    }
+
+def usage_fingerprint(snapshot: Dict[str, Any]) -> str:
+    """Stable hash of the snapshot fields; equal fingerprints mean there is nothing to write."""
+    raw = "|".join(str(snapshot.get(field)) for field in sorted(snapshot))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _as_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+def is_snapshot_fresh(db_user: models.VpnUser, max_age_seconds: int = None) -> bool:
+    """
+    True if the user's usage snapshot is recent enough to be served instead of a live Marzban call.
+    Unchanged rows are not rewritten by the sync, only marked as checked, so a snapshot also counts
+    as fresh when a recent sync saw the user in Marzban (usage_checked_at).
+    """
+    if db_user.usage_synced_at is None:
+        return False
+    if max_age_seconds is None:
+        max_age_seconds = MARZBAN_USAGE_MAX_STALENESS_SECONDS
+    last_seen = max(filter(None, (_as_naive_utc(db_user.usage_synced_at), _as_naive_utc(db_user.usage_checked_at))))
+    return (datetime.utcnow() - last_seen).total_seconds() <= max_age_seconds
+
+async def _apply_changes(snapshots: Dict[str, Dict[str, Any]], synced_at: datetime, node: str) -> Dict[str, int]:
+    """
+    Compares one page against the fingerprints stored in the DB, writes the snapshots that
+    changed and marks the unchanged ones as checked.
+    `snapshots` maps username -> snapshot dict including its "usage_fingerprint".
+    Users that exist in Marzban but not in our panel (or not on this node) are ignored.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(models.VpnUser.id, models.VpnUser.marzban_username, models.VpnUser.usage_fingerprint)
+            .where(
+                models.VpnUser.marzban_username.in_(list(snapshots)),
+                func.coalesce(models.VpnUser.marzban_node, marzban_service.MARZBAN_DEFAULT_NODE) == node,
+            )
+        )
+        rows = result.all()
+        changed, unchanged = [], []
+        for row in rows:
+            if row.usage_fingerprint != snapshots[row.marzban_username]["usage_fingerprint"]:
+                changed.append(row)
+            else:
+                unchanged.append(row.id)
+        if changed:
+            # One executemany UPDATE keyed by primary key for all changed rows of the page
+            await db.execute(
+                update(models.VpnUser),
+                [{"id": row.id, "usage_synced_at": synced_at, "usage_checked_at": synced_at, **snapshots[row.marzban_username]}
+                 for row in changed]
+            )
+        if unchanged:
+            # Users that disappeared from Marzban (or that paging skipped) keep their old check time
+            await db.execute(
+                update(models.VpnUser)
+                .where(models.VpnUser.id.in_(unchanged))
+                .values(usage_checked_at=synced_at)
+                .execution_options(synchronize_session=False)
+            )
+        await db.commit()
+        return {"known": len(rows), "written": len(changed)}
+
+async def _process_page(marzban_users: List[Dict[str, Any]], synced_at: datetime, node: str, stats: Dict[str, Any]) -> None:
+    stats["scanned"] += len(marzban_users)
+
+    snapshots = {}
+    for marzban_user in marzban_users:
+        username = marzban_user.get("username")
+        if not username:
+            continue
+        snapshot = snapshot_from_marzban(marzban_user)
+        snapshots[username] = {**snapshot, "usage_fingerprint": usage_fingerprint(snapshot)}
+    if not snapshots:
+        return
+
+    result = await _apply_changes(snapshots, synced_at, node)
+    stats["written"] += result["written"]
+
+async def _fetch_page(offset: int, limit: int, node: str, stats: Dict[str, Any]) -> Dict[str, Any]:
+    started = time.monotonic()
+    page = await marzban_service.get_all_marzban_users(offset=offset, limit=limit, node=node)
+    stats["page_seconds"].append(time.monotonic() - started)
+    return page
+
+def _adapt_page_size(node: str, page_seconds: List[float]) -> None:
+    """Grows the node's page size while pages are fast and shrinks it when they approach the target latency."""
+    if not page_seconds:
+        return
+    page_size = _page_sizes.get(node, MARZBAN_SYNC_PAGE_SIZE)
+    average = sum(page_seconds) / len(page_seconds)
+    if average < MARZBAN_SYNC_TARGET_PAGE_SECONDS / 2:
+        page_size = min(page_size * 2, MARZBAN_SYNC_MAX_PAGE_SIZE)
+    elif average > MARZBAN_SYNC_TARGET_PAGE_SECONDS:
+        page_size = max(page_size // 2, MARZBAN_SYNC_MIN_PAGE_SIZE)
+    _page_sizes[node] = page_size
+
+async def sync_marzban_usage(page_size: int = None) -> Dict[str, Any]:
+    """
+    Pages through the users of every Marzban node and refreshes the local usage snapshot.
+    One Marzban call per page replaces one call per user per page view.
+
+    Nodes are synced in parallel, each with its own page size. Returns the totals (rows
+    scanned and written, pages) and a per-node breakdown; a node that failed is
+    reported with its error and doesn't stop the others. Raises only if every node failed.
+    """
+    started = time.monotonic()
+    synced_at = datetime.utcnow()
+    nodes = marzban_service.node_names()
+    results = await asyncio.gather(
+        *(_sync_node(node, page_size, synced_at) for node in nodes), return_exceptions=True
+    )
+
+    totals = {"scanned": 0, "written": 0, "pages": 0, "nodes": {}}
+    errors = []
+    for node, result in zip(nodes, results):
+        if isinstance(result, BaseException):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            errors.append(result)
+            totals["nodes"][node] = {"error": str(result)}
+            continue
+        for key in ("scanned", "written", "pages"):
+            totals[key] += result[key]
+        totals["nodes"][node] = result
+    if len(errors) == len(nodes):
+        raise errors[0]
+    totals["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    return totals
+
+async def _sync_node(node: str, page_size: Optional[int], synced_at: datetime) -> Dict[str, Any]:
+    """
+    Syncs one node. The first page tells us the total; the remaining pages are fetched
+    concurrently (at most MARZBAN_SYNC_CONCURRENCY at a time). Only rows whose fingerprint
+    changed are written.
+    """
+    limit = page_size or _page_sizes.get(node, MARZBAN_SYNC_PAGE_SIZE)
+    started = time.monotonic()
+    stats = {"scanned": 0, "written": 0, "pages": 0, "page_size": limit, "page_seconds": []}
+
+    first_page = await _fetch_page(0, limit, node, stats)
+    users = first_page.get("users", [])
+    await _process_page(users, synced_at, node, stats)
+    stats["pages"] += 1
+
+    total = first_page.get("total")
+    if total is not None:
+        semaphore = asyncio.Semaphore(MARZBAN_SYNC_CONCURRENCY)
+
+        async def _sync_page(offset: int) -> None:
+            async with semaphore:
+                page = await _fetch_page(offset, limit, node, stats)
+            await _process_page(page.get("users", []), synced_at, node, stats)
+
+        offsets = list(range(len(users), total, limit)) if users else []
+        await asyncio.gather(*(_sync_page(offset) for offset in offsets))
+        stats["pages"] += len(offsets)
+    else:
+        # Marzban did not report a total, fall back to sequential paging
+        offset = len(users)
+        while len(users) == limit:
+            page = await _fetch_page(offset, limit, node, stats)
+            users = page.get("users", [])
+            await _process_page(users, synced_at, node, stats)
+            stats["pages"] += 1
+            offset += len(users)
+
+    if page_size is None:
+        _adapt_page_size(node, stats["page_seconds"])
+    page_seconds = stats.pop("page_seconds")
+    stats["avg_page_seconds"] = round(sum(page_seconds) / len(page_seconds), 3) if page_seconds else 0
+    stats["elapsed_seconds"] = round(time.monotonic() - started, 3)
+    return stats
+
+async def _run_sync_if_due() -> Optional[Dict[str, Any]]:
+    """Runs a sync unless another worker on this host already did within the interval."""
+    store = get_shared_store()
+    try:
+        # Don't wait for the lock: if another worker is syncing right now, this cycle has nothing to do
+        async with store.lock(SYNC_LOCK_KEY, timeout=0):
+            last_run = store.get(SYNC_LAST_RUN_KEY) or 0
+            if time.time() - last_run < MARZBAN_SYNC_INTERVAL_SECONDS:
+                return None
+            stats = await sync_marzban_usage()
+            store.set(SYNC_LAST_RUN_KEY, time.time())
+            return stats
+    except SharedLockTimeout:
+        return None
+    except SharedStateError as e:
+        print(f"Usage sync skipped, shared store unavailable: {e}")
+        return None
+
+async def _sync_loop() -> None:
+    while True:
+        try:
+            stats = await _run_sync_if_due()
+            if stats:
+                print(f"Marzban usage sync: {stats}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Never let a failed cycle kill the loop; the next cycle will retry
+            print(f"Marzban usage sync failed: {e}")
+        await asyncio.sleep(MARZBAN_SYNC_INTERVAL_SECONDS)
+
+def start_usage_sync() -> None:
+    """Starts the background sync task. Called on app startup."""
+    global _sync_task
+    if MARZBAN_SYNC_INTERVAL_SECONDS <= 0 or (_sync_task and not _sync_task.done()):
+        return
+    _sync_task = asyncio.create_task(_sync_loop())
+
+async def stop_usage_sync() -> None:
+    """Cancels the background sync task. Called on app shutdown."""
+    global _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        try:
+            await _sync_task
+        except asyncio.CancelledError:
+            pass
+        _sync_task = None
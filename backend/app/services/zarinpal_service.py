@@ -2,15 +2,20 @@ import httpx
 import os
 from dotenv import load_dotenv
 
+from ..metrics import observed_upstream
+
 load_dotenv()
 
 ZARINPAL_MERCHANT_ID = os.getenv("ZARINPAL_MERCHANT_ID")
 ZARINPAL_CALLBACK_URL = os.getenv("ZARINPAL_CALLBACK_URL")
 
-# Zarinpal API URLs (as per general documentation)
-ZARINPAL_API_REQUEST = "https://api.zarinpal.com/pg/v4/payment/request.json"
-ZARINPAL_API_VERIFY = "https://api.zarinpal.com/pg/v4/payment/verify.json"
-ZARINPAL_API_STARTPAY = "https://www.zarinpal.com/pg/StartPay/"
+# Zarinpal API URLs (as per general documentation). For local development, point both at the
+# stand-in in tests/fake_zarinpal.py, e.g. ZARINPAL_API_BASE_URL=ZARINPAL_STARTPAY_BASE_URL=http://localhost:9000
+ZARINPAL_API_BASE_URL = os.getenv("ZARINPAL_API_BASE_URL", "https://api.zarinpal.com").rstrip("/")
+ZARINPAL_STARTPAY_BASE_URL = os.getenv("ZARINPAL_STARTPAY_BASE_URL", "https://www.zarinpal.com").rstrip("/")
+ZARINPAL_API_REQUEST = f"{ZARINPAL_API_BASE_URL}/pg/v4/payment/request.json"
+ZARINPAL_API_VERIFY = f"{ZARINPAL_API_BASE_URL}/pg/v4/payment/verify.json"
+ZARINPAL_API_STARTPAY = f"{ZARINPAL_STARTPAY_BASE_URL}/pg/StartPay/"
 
 class ZarinpalError(Exception):
     """Custom exception for Zarinpal service errors."""
@@ -19,6 +24,7 @@ class ZarinpalError(Exception):
         self.code = code
         super().__init__(f"Zarinpal Error {code}: {message}")
 
+@observed_upstream("zarinpal", "request")
 async def request_payment(amount: int, description: str, email: str = None, mobile: str = None) -> str:
     """
     Requests a new payment from Zarinpal.
@@ -54,10 +60,13 @@ async def request_payment(amount: int, description: str, email: str = None, mobi
 
         except httpx.HTTPStatusError as e:
             raise ZarinpalError(f"HTTP error during payment request: {e.response.status_code}", e.response.status_code) from e
+        except ZarinpalError:
+            raise # Zarinpal's own error code, e.g. -51 for a payment that was never paid
         except Exception as e:
             raise ZarinpalError(f"An unexpected error occurred during payment request: {str(e)}", -1) from e
 
 
+@observed_upstream("zarinpal", "verify")
 async def verify_payment(amount: int, authority: str) -> str:
     """
     Verifies a payment with Zarinpal after the user returns from the gateway.
@@ -99,6 +108,8 @@ async def verify_payment(amount: int, authority: str) -> str:
 
         except httpx.HTTPStatusError as e:
             raise ZarinpalError(f"HTTP error during payment verification: {e.response.status_code}", e.response.status_code) from e
+        except ZarinpalError:
+            raise # Zarinpal's own error code, e.g. -51 for a payment that was never paid
         except Exception as e:
             raise ZarinpalError(f"An unexpected error occurred during payment verification: {str(e)}", -1) from e
 
@@ -0,0 +1,109 @@
+"""
+A stand-in for Zarinpal's payment gateway, for tests and local development.
+
+In tests, FakeZarinpal().install(respx_router) answers the panel's calls to the configured
+Zarinpal URLs. To try the payment flow locally, run it as a server:
+
+    uvicorn tests.fake_zarinpal:app --port 9000
+
+with ZARINPAL_API_BASE_URL and ZARINPAL_STARTPAY_BASE_URL set to http://localhost:9000.
+Opening the StartPay page pays (with ?cancel=1 cancels) and redirects to the callback URL.
+"""
+import itertools
+import json
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, RedirectResponse
+from httpx import Response
+
+from app.services import zarinpal_service
+
+CODE_OK = 100
+CODE_ALREADY_VERIFIED = 101
+CODE_NOT_PAID = -51 # Zarinpal: "Session is not active, paid try is not found"
+CODE_AMOUNT_MISMATCH = -50
+CODE_UNKNOWN_AUTHORITY = -54
+
+
+class FakeZarinpal:
+    def __init__(self):
+        self.payments: Dict[str, Dict[str, Any]] = {} # authority -> amount, callback_url, paid, verified, ref_id
+        self.verify_calls = 0
+        self.unavailable_calls = 0 # The next N verify calls answer 503
+        self.verify_errors = [] # (HTTP status, Zarinpal code) answered by the next verify calls, in order
+        self._ids = itertools.count(1)
+
+    def create_payment(self, amount: int, callback_url: Optional[str] = None, paid: bool = False) -> str:
+        number = next(self._ids)
+        authority = f"A{number:035d}"
+        self.payments[authority] = {
+            "amount": amount, "callback_url": callback_url, "paid": paid, "verified": False, "ref_id": 100000 + number,
+        }
+        return authority
+
+    def pay(self, authority: str) -> None:
+        self.payments[authority]["paid"] = True
+
+    def handle_request(self, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        authority = self.create_payment(int(payload["amount"]), payload.get("callback_url"))
+        return 200, {"data": {"code": CODE_OK, "message": "Success", "authority": authority, "fee_type": "Merchant", "fee": 0}, "errors": []}
+
+    def handle_verify(self, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        self.verify_calls += 1
+        if self.unavailable_calls > 0:
+            self.unavailable_calls -= 1
+            return 503, {"data": [], "errors": {"code": -1, "message": "Service unavailable"}}
+        if self.verify_errors:
+            status_code, code = self.verify_errors.pop(0)
+            return status_code, _error(code, "Request refused")
+        payment = self.payments.get(payload.get("authority"))
+        if payment is None:
+            return 200, _error(CODE_UNKNOWN_AUTHORITY, "Invalid authority")
+        if int(payload.get("amount", 0)) != payment["amount"]:
+            return 200, _error(CODE_AMOUNT_MISMATCH, "Amount mismatch")
+        if not payment["paid"]:
+            return 200, _error(CODE_NOT_PAID, "Session is not active, paid try is not found")
+        code = CODE_ALREADY_VERIFIED if payment["verified"] else CODE_OK
+        payment["verified"] = True
+        return 200, {"data": {"code": code, "message": "Verified", "ref_id": payment["ref_id"], "fee_type": "Merchant", "fee": 0}, "errors": []}
+
+    def install(self, router) -> None:
+        """Routes the Zarinpal API calls of a respx router (or the respx module) to this fake."""
+        def _respond(handler):
+            def side_effect(request):
+                status_code, body = handler(json.loads(request.content))
+                return Response(status_code, json=body)
+            return side_effect
+        router.post(zarinpal_service.ZARINPAL_API_REQUEST).mock(side_effect=_respond(self.handle_request))
+        router.post(zarinpal_service.ZARINPAL_API_VERIFY).mock(side_effect=_respond(self.handle_verify))
+
+
+def _error(code: int, message: str) -> Dict[str, Any]:
+    return {"data": [], "errors": {"code": code, "message": message}}
+
+
+def create_app(fake: FakeZarinpal) -> FastAPI:
+    fake_app = FastAPI(title="Fake Zarinpal")
+
+    @fake_app.post("/pg/v4/payment/request.json")
+    async def request_payment(request: Request):
+        status_code, body = fake.handle_request(await request.json())
+        return JSONResponse(body, status_code=status_code)
+
+    @fake_app.post("/pg/v4/payment/verify.json")
+    async def verify_payment(request: Request):
+        status_code, body = fake.handle_verify(await request.json())
+        return JSONResponse(body, status_code=status_code)
+
+    @fake_app.get("/pg/StartPay/{authority}")
+    async def start_pay(authority: str, cancel: bool = False):
+        payment = fake.payments[authority]
+        if not cancel:
+            fake.pay(authority)
+        return RedirectResponse(f"{payment['callback_url']}?Authority={authority}&Status={'NOK' if cancel else 'OK'}")
+
+    return fake_app
+
+
+app = create_app(FakeZarinpal())
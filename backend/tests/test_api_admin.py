@@ -1,5 +1,9 @@
+import asyncio
+import json
 import pytest
-from httpx import AsyncClient
+import respx
+from httpx import AsyncClient, Response
+from unittest.mock import patch
 
 # Add the parent directory to the path to allow imports from 'app'
 import sys
@@ -8,7 +12,10 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from app.main import app
 from app.security import get_current_admin
-from app.models import Admin
+from app.models import Admin, Plan, VpnUser, MarzbanNode, MarzbanOutbox, PaymentLog, BalanceLedgerEntry, BalanceSnapshot, BalanceHold
+from app.database import SessionLocal
+from app.services import marzban_service, plan_cache, outbox_service, node_service, payment_service, zarinpal_service, ledger_service
+from app import security
 
 # Mark all tests in this file as async
 pytestmark = pytest.mark.asyncio
@@ -18,7 +25,7 @@ mock_admin_user = Admin(
     id=1,
     username="testadmin",
     email="test@admin.com",
-    balance=100.0,
+    balance_minor=10000,
     is_active=True
 )
 
@@ -30,6 +37,13 @@ async def override_get_current_admin():
 app.dependency_overrides[get_current_admin] = override_get_current_admin
 
 
+def _fake_marzban_node(name: str = None, url: str = "https://marzban.test") -> marzban_service.MarzbanNode:
+    """A Marzban node pointing at a fake panel, already holding a token."""
+    node = marzban_service.MarzbanNode(name or marzban_service.MARZBAN_DEFAULT_NODE, url, "sudo", "secret")
+    node.auth_cache = {"token": "tok", "expires_at": 2**40}
+    return node
+
+
 async def test_get_admin_me(async_client: AsyncClient):
     """
     Tests the /api/admin/me endpoint with a mocked authenticated admin.
@@ -43,6 +57,357 @@ async def test_get_admin_me(async_client: AsyncClient):
     assert response_data["id"] == mock_admin_user.id
     assert response_data["is_active"] is True
 
+@respx.mock
+async def test_create_vpn_users_batch(async_client: AsyncClient):
+    """
+    Tests batch creation from a username pattern: existing users are reported per user, the
+    rest are stored as pending and created in Marzban by the outbox, where rejections mark
+    the single user as failed.
+    """
+    db = SessionLocal()
+    plan = Plan(name="batch-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    db.add(VpnUser(marzban_username="batch-002", admin_id=mock_admin_user.id, plan_id=plan.id))
+    db.commit()
+
+    def marzban_add_user(request):
+        username = json.loads(request.content)["username"]
+        if username == "batch-003":
+            return Response(422, json={"detail": "Invalid username"})
+        return Response(200, json={"username": username})
+
+    add_route = respx.post("https://marzban.test/api/user").mock(side_effect=marzban_add_user)
+    with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+        response = await async_client.post(
+            "/api/v1/admin/vpnusers/batch",
+            json={"plan_id": plan.id, "username_prefix": "batch-", "count": 4}
+        )
+        assert response.status_code == 202
+        data = response.json()
+        assert (data["requested"], data["created"], data["failed"]) == (4, 3, 1)
+        assert [r["success"] for r in data["results"]] == [True, False, True, True]
+        assert not add_route.called # Marzban is only called by the outbox
+
+        assert (await outbox_service.process_outbox_once())["done"] == 2
+
+    statuses = dict(db.query(VpnUser.marzban_username, VpnUser.provisioning_status).filter(VpnUser.plan_id == plan.id))
+    assert statuses == {"batch-001": "provisioned", "batch-002": "provisioned", "batch-003": "failed", "batch-004": "provisioned"}
+
+    db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+@respx.mock
+async def test_bulk_delete_vpn_users_streams_progress(async_client: AsyncClient):
+    """
+    Tests that bulk delete reports one NDJSON line per user plus a summary,
+    and only removes the users Marzban deleted (or no longer knows).
+    """
+    db = SessionLocal()
+    plan = Plan(name="bulk-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    for username in ("bulk-1", "bulk-2", "bulk-3"):
+        db.add(VpnUser(marzban_username=username, admin_id=mock_admin_user.id, plan_id=plan.id))
+    db.commit()
+
+    respx.delete("https://marzban.test/api/user/bulk-1").mock(return_value=Response(200))
+    respx.delete("https://marzban.test/api/user/bulk-2").mock(return_value=Response(404, json={"detail": "User not found"}))
+    respx.delete("https://marzban.test/api/user/bulk-3").mock(return_value=Response(500, json={"detail": "boom"}))
+    with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+        response = await async_client.post(
+            "/api/v1/admin/vpnusers/bulk/delete",
+            json={"usernames": ["bulk-1", "bulk-2", "bulk-3", "not-mine"]}
+        )
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[-1] == {"done": True, "action": "delete", "requested": 4, "succeeded": 2, "failed": 2}
+    assert {line["marzban_username"] for line in lines[:-1]} == {"bulk-1", "bulk-2", "bulk-3", "not-mine"}
+    remaining = [u.marzban_username for u in db.query(VpnUser).filter(VpnUser.plan_id == plan.id).all()]
+    assert remaining == ["bulk-3"]
+
+    db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+@respx.mock
+async def test_bulk_delete_finishes_when_the_client_goes_away():
+    """
+    Tests that the local deletion still happens for users deleted in Marzban
+    when the client stops reading the progress stream early.
+    """
+    from app import schemas
+    from app.api.v1.endpoints import vpn_users as vpn_users_endpoint
+    from app.database import AsyncSessionLocal
+
+    db = SessionLocal()
+    plan = Plan(name="gone-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    for username in ("gone-1", "gone-2"):
+        db.add(VpnUser(marzban_username=username, admin_id=mock_admin_user.id, plan_id=plan.id))
+    db.commit()
+
+    respx.delete(url__regex=r"https://marzban\.test/api/user/gone-.").mock(return_value=Response(200))
+    try:
+        with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+            async with AsyncSessionLocal() as session:
+                response = await vpn_users_endpoint.bulk_delete_vpn_users(
+                    schemas.VpnUserBulkAction(usernames=["gone-1", "gone-2"]), db=session, current_admin=mock_admin_user
+                )
+            stream = response.body_iterator
+            assert json.loads(await stream.__anext__())["success"] is True
+            await stream.aclose() # The client disconnected
+            await asyncio.gather(*vpn_users_endpoint._bulk_jobs)
+
+        assert db.query(VpnUser).filter(VpnUser.plan_id == plan.id).count() == 0
+    finally:
+        db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+        db.delete(plan)
+        db.commit()
+        db.close()
+
+async def test_list_vpn_users_cursor_pagination(async_client: AsyncClient):
+    """
+    Tests that following X-Next-Cursor visits every user exactly once, in (created_at, id) order,
+    even when users share a creation timestamp.
+    """
+    db = SessionLocal()
+    plan = Plan(name="page-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    names = [f"page-{i}" for i in range(5)]
+    db.add_all([VpnUser(marzban_username=name, admin_id=mock_admin_user.id, plan_id=plan.id) for name in names])
+    db.commit()
+
+    seen, cursor = [], None
+    for _ in range(20):
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = await async_client.get("/api/v1/admin/vpnusers/", params=params)
+        assert response.status_code == 200
+        seen += [user["marzban_username"] for user in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert [name for name in seen if name.startswith("page-")] == names
+    assert len(seen) == len(set(seen))
+
+    response = await async_client.get("/api/v1/admin/vpnusers/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+    db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+async def test_list_vpn_users_filters_sort_and_total(async_client: AsyncClient):
+    """
+    Tests server-side filtering by plan, state and username, username sorting with cursors,
+    and the optional total count header.
+    """
+    from datetime import datetime, timedelta
+    db = SessionLocal()
+    plan_a = Plan(name="filter-plan-a", price=1000, duration_days=30, data_limit_gb=10)
+    plan_b = Plan(name="filter-plan-b", price=2000, duration_days=30, data_limit_gb=20)
+    db.add_all([plan_a, plan_b])
+    db.commit()
+    now = datetime.utcnow()
+    db.add_all([
+        VpnUser(marzban_username="flt-alpha", admin_id=mock_admin_user.id, plan_id=plan_a.id, expires_at=now + timedelta(days=5)),
+        VpnUser(marzban_username="flt-beta", admin_id=mock_admin_user.id, plan_id=plan_a.id, expires_at=now - timedelta(days=1)),
+        VpnUser(marzban_username="flt-gamma", admin_id=mock_admin_user.id, plan_id=plan_b.id, expires_at=now + timedelta(days=40)),
+        VpnUser(marzban_username="flt_delta", admin_id=mock_admin_user.id, plan_id=plan_b.id, expires_at=now + timedelta(days=40)),
+    ])
+    db.commit()
+
+    async def usernames(**params):
+        response = await async_client.get("/api/v1/admin/vpnusers/", params=params)
+        assert response.status_code == 200, response.text
+        return [user["marzban_username"] for user in response.json()], response.headers
+
+    assert (await usernames(plan_id=plan_a.id))[0] == ["flt-alpha", "flt-beta"]
+    assert (await usernames(username_prefix="flt-", state="expired"))[0] == ["flt-beta"]
+    assert (await usernames(username_prefix="flt-", state="active", expires_before=(now + timedelta(days=10)).isoformat()))[0] == ["flt-alpha"]
+    # '_' is matched literally, not as a LIKE wildcard
+    assert (await usernames(username_prefix="flt_"))[0] == ["flt_delta"]
+    assert (await usernames(search="amm"))[0] == ["flt-gamma"]
+
+    names, headers = await usernames(username_prefix="flt-", sort="-username", limit=2, with_total=True)
+    assert names == ["flt-gamma", "flt-beta"]
+    assert (headers["X-Total-Count"], headers["X-Total-Count-Exact"]) == ("3", "true")
+    assert (await usernames(username_prefix="flt-", sort="-username", limit=2, cursor=headers["X-Next-Cursor"]))[0] == ["flt-alpha"]
+
+    response = await async_client.get("/api/v1/admin/vpnusers/", params={"sort": "password"})
+    assert response.status_code == 400
+
+    db.query(VpnUser).filter(VpnUser.plan_id.in_([plan_a.id, plan_b.id])).delete()
+    db.delete(plan_a)
+    db.delete(plan_b)
+    db.commit()
+    db.close()
+
+async def test_export_vpn_users_csv_and_gzipped_ndjson(async_client: AsyncClient):
+    """
+    Tests that the export streams the admin's filtered users as CSV, and as gzipped NDJSON on request.
+    """
+    import csv
+    import gzip
+    db = SessionLocal()
+    plan = Plan(name="export-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    db.add_all([VpnUser(marzban_username=f"exp-{i}", admin_id=mock_admin_user.id, plan_id=plan.id, notes="a,b") for i in range(3)])
+    db.commit()
+
+    response = await async_client.get("/api/v1/admin/vpnusers/export", params={"plan_id": plan.id})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(response.text.splitlines()))
+    assert [row["marzban_username"] for row in rows] == ["exp-0", "exp-1", "exp-2"]
+    assert rows[0]["notes"] == "a,b"
+
+    response = await async_client.get(
+        "/api/v1/admin/vpnusers/export", params={"plan_id": plan.id, "format": "ndjson", "gzip": "true"}
+    )
+    assert response.status_code == 200
+    assert 'filename="vpn-users.ndjson.gz"' in response.headers["content-disposition"]
+    lines = [json.loads(line) for line in gzip.decompress(response.content).decode().splitlines()]
+    assert [line["marzban_username"] for line in lines] == ["exp-0", "exp-1", "exp-2"]
+
+    response = await async_client.get("/api/v1/admin/vpnusers/export", params={"format": "xlsx"})
+    assert response.status_code == 400
+
+    db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+async def test_active_plans_etag_and_invalidation(async_client: AsyncClient):
+    """
+    Tests that the cached active plans answer If-None-Match with 304 and that a plans
+    version bump (as done by the plan CRUD endpoints) serves the changed list with a new ETag.
+    """
+    db = SessionLocal()
+    plan = Plan(name="etag-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+    plan_cache.bump_plans_version()
+
+    response = await async_client.get("/api/v1/admin/plans")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert "etag-plan" in [p["name"] for p in response.json()]
+
+    response = await async_client.get("/api/v1/admin/plans", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    plan.is_active = False
+    db.commit()
+    plan_cache.bump_plans_version()
+    response = await async_client.get("/api/v1/admin/plans", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "etag-plan" not in [p["name"] for p in response.json()]
+
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+@respx.mock
+async def test_create_and_delete_vpn_user_through_outbox(async_client: AsyncClient):
+    """
+    Tests that create/delete return once the intent is stored, that the outbox worker applies
+    them to Marzban, and that a retried create with the same Idempotency-Key is not queued twice.
+    """
+    db = SessionLocal()
+    plan = Plan(name="outbox-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.commit()
+
+    create_route = respx.post("https://marzban.test/api/user").mock(
+        return_value=Response(200, json={"username": "outbox-1", "status": "active", "subscription_url": "https://sub/outbox-1"})
+    )
+    delete_route = respx.delete("https://marzban.test/api/user/outbox-1").mock(return_value=Response(200))
+    with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+        for _ in range(2):
+            response = await async_client.post(
+                "/api/v1/admin/vpnusers/", json={"marzban_username": "outbox-1", "plan_id": plan.id},
+                headers={"Idempotency-Key": "create-outbox-1"}
+            )
+            assert response.status_code == 202
+            assert response.json()["provisioning_status"] == "pending"
+        assert create_route.call_count == 0
+
+        assert (await outbox_service.process_outbox_once())["done"] == 1
+        assert create_route.call_count == 1
+        response = await async_client.get("/api/v1/admin/vpnusers/outbox-1/provisioning")
+        assert response.json()["provisioning_status"] == "provisioned"
+        assert response.json()["outbox"]["attempts"] == 1
+
+        response = await async_client.delete("/api/v1/admin/vpnusers/outbox-1")
+        assert response.status_code == 202
+        assert db.query(VpnUser).filter(VpnUser.marzban_username == "outbox-1").one().provisioning_status == "deleting"
+
+        assert (await outbox_service.process_outbox_once())["done"] == 1
+        assert delete_route.call_count == 1
+        response = await async_client.get("/api/v1/admin/vpnusers/outbox-1/provisioning")
+        assert response.json()["provisioning_status"] == "deleted"
+
+    db.expire_all()
+    assert db.query(VpnUser).filter(VpnUser.marzban_username == "outbox-1").count() == 0
+    db.delete(plan)
+    db.commit()
+    db.close()
+
+@respx.mock
+async def test_vpn_users_are_placed_on_least_loaded_node_and_routed_to_it(async_client: AsyncClient):
+    """
+    Tests that new users go to the node with the fewest users that has room, that the node is
+    recorded on the user, and that later calls for the user (outbox, bulk actions) go to that node.
+    """
+    db = SessionLocal()
+    plan = Plan(name="placement-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add_all([plan, MarzbanNode(name="node-b", max_users=1, is_active=True)])
+    db.commit()
+    db.add(VpnUser(marzban_username="place-0", admin_id=mock_admin_user.id, plan_id=plan.id,
+                   marzban_node=marzban_service.MARZBAN_DEFAULT_NODE))
+    db.commit()
+    node_service.reset_node_loads()
+
+    nodes = {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node(), "node-b": _fake_marzban_node("node-b", "https://marzban-b.test")}
+    create_a = respx.post("https://marzban.test/api/user").mock(return_value=Response(200, json={"username": "place-2", "status": "active"}))
+    create_b = respx.post("https://marzban-b.test/api/user").mock(return_value=Response(200, json={"username": "place-1", "status": "active"}))
+    reset_a = respx.post("https://marzban.test/api/user/place-2/reset").mock(return_value=Response(200, json={}))
+    reset_b = respx.post("https://marzban-b.test/api/user/place-1/reset").mock(return_value=Response(200, json={}))
+    with patch.dict(marzban_service._nodes, nodes):
+        for username in ("place-1", "place-2"):
+            response = await async_client.post("/api/v1/admin/vpnusers/", json={"marzban_username": username, "plan_id": plan.id})
+            assert response.status_code == 202
+        # node-b had no users; then it is full (max_users=1) and the default node takes the next one
+        assert [u["marzban_node"] for u in (await async_client.get(
+            "/api/v1/admin/vpnusers/", params={"username_prefix": "place-", "sort": "username"})).json()] == \
+            [marzban_service.MARZBAN_DEFAULT_NODE, "node-b", marzban_service.MARZBAN_DEFAULT_NODE]
+
+        assert (await outbox_service.process_outbox_once())["done"] == 2
+        assert (create_a.call_count, create_b.call_count) == (1, 1)
+
+        response = await async_client.post("/api/v1/admin/vpnusers/bulk/reset-traffic", json={"usernames": ["place-1", "place-2"]})
+        assert json.loads(response.text.splitlines()[-1])["succeeded"] == 2
+        assert (reset_a.call_count, reset_b.call_count) == (1, 1)
+
+    db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+    db.query(MarzbanNode).filter(MarzbanNode.name == "node-b").delete()
+    db.delete(plan)
+    db.commit()
+    db.close()
+    node_service.reset_node_loads()
+
 # It's good practice to clean up the override after the tests in this module are done.
 # A more robust way is to use pytest fixtures to apply and clean up the override.
 # For this example, this direct override is sufficient to demonstrate the concept.
@@ -56,3 +421,244 @@ def cleanup_dependency_override():
     yield
     # Teardown: clean up the dependency override
     app.dependency_overrides.pop(get_current_admin, None)
+
+
+async def test_admin_login_rehashes_outdated_password_hash(async_client: AsyncClient, monkeypatch):
+    """
+    Tests that a login with a hash made at a lower bcrypt cost succeeds and upgrades the stored hash.
+    """
+    monkeypatch.setattr(security, "pwd_context", security.CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=5))
+    old_hash = security.CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("s3cret-pass")
+
+    db = SessionLocal()
+    admin = Admin(username="rehash-admin", email="rehash@admin.com", hashed_password=old_hash)
+    db.add(admin)
+    db.commit()
+    try:
+        response = await async_client.post(
+            "/api/v1/admin/login/token", data={"username": "rehash-admin", "password": "s3cret-pass"}
+        )
+        assert response.status_code == 200
+        assert response.json()["access_token"]
+
+        db.refresh(admin)
+        assert admin.hashed_password.startswith("$2b$05$")
+        assert security.get_password_hashing_stats()["rehashed"] >= 1
+
+        response = await async_client.post(
+            "/api/v1/admin/login/token", data={"username": "rehash-admin", "password": "wrong"}
+        )
+        assert response.status_code == 401
+    finally:
+        db.delete(admin)
+        db.commit()
+        db.close()
+
+
+@respx.mock
+async def test_zarinpal_callback_is_idempotent(async_client: AsyncClient, monkeypatch):
+    """
+    Tests that concurrent and repeated callbacks for one payment verify it once and credit the balance once.
+    """
+    monkeypatch.setattr(zarinpal_service, "ZARINPAL_MERCHANT_ID", "TEST_MERCHANT_ID")
+    payment_service.clear_callback_cache()
+    verify_route = respx.post(zarinpal_service.ZARINPAL_API_VERIFY).mock(
+        return_value=Response(200, json={"data": {"code": 100, "message": "Verified", "ref_id": 987654}, "errors": []})
+    )
+
+    db = SessionLocal()
+    admin = Admin(username="payer-admin", email="payer@admin.com", hashed_password="x")
+    db.add(admin)
+    db.commit()
+    db.add(PaymentLog(admin_id=admin.id, amount=50000, authority="A-IDEMPOTENT", status="pending"))
+    db.commit()
+    try:
+        url = "/api/v1/payments/zarinpal/callback?Status=OK&Authority=A-IDEMPOTENT"
+        responses = await asyncio.gather(*(async_client.get(url) for _ in range(3)))
+        locations = [response.headers["location"] for response in responses]
+        assert sum("/payment/success?ref_id=987654" in location for location in locations) >= 1
+        assert all("success" in location or "verification_in_progress" in location for location in locations)
+
+        # A replay after the fact is answered from the recorded outcome
+        response = await async_client.get(url)
+        assert response.headers["location"].endswith("/payment/success?ref_id=987654")
+        payment_service.clear_callback_cache()
+        response = await async_client.get(url)
+        assert response.headers["location"].endswith("/payment/success?ref_id=987654")
+
+        assert verify_route.call_count == 1
+        db.refresh(admin)
+        assert admin.balance == 50000.0
+        payment_log = db.query(PaymentLog).filter(PaymentLog.authority == "A-IDEMPOTENT").one()
+        assert payment_log.status == "completed" and payment_log.ref_id == "987654"
+
+        response = await async_client.get("/api/v1/payments/zarinpal/callback?Status=OK&Authority=A-UNKNOWN")
+        assert response.headers["location"].endswith("error=transaction_not_found")
+    finally:
+        db.query(PaymentLog).filter(PaymentLog.admin_id == admin.id).delete()
+        db.query(BalanceLedgerEntry).filter(BalanceLedgerEntry.admin_id == admin.id).delete()
+        db.delete(admin)
+        db.commit()
+        db.close()
+
+
+@respx.mock
+async def test_purchases_hold_balance_and_never_oversell(async_client: AsyncClient, monkeypatch):
+    """
+    Tests that with billing on, concurrent purchases only succeed while the available balance
+    covers them, and that the outbox commits the hold of a created user and releases a failed one.
+    """
+    monkeypatch.setattr(ledger_service, "BILLING_ENABLED", True)
+    db = SessionLocal()
+    plan = Plan(name="billed-plan", price=400, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.add(BalanceLedgerEntry(admin_id=mock_admin_user.id, amount_minor=100000, kind="adjustment")) # 1000
+    db.commit()
+
+    def marzban_add_user(request):
+        username = json.loads(request.content)["username"]
+        if username == "billed-1":
+            return Response(400, json={"detail": "Rejected"}) # Permanent: the outbox gives up
+        return Response(200, json={"username": username, "status": "active"})
+
+    respx.post("https://marzban.test/api/user").mock(side_effect=marzban_add_user)
+    try:
+        with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+            responses = await asyncio.gather(*(
+                async_client.post("/api/v1/admin/vpnusers/", json={"marzban_username": f"billed-{n}", "plan_id": plan.id})
+                for n in range(3)
+            ))
+            assert sorted(response.status_code for response in responses) == [202, 202, 402]
+            snapshot = db.get(BalanceSnapshot, mock_admin_user.id)
+            assert snapshot.held_minor == 80000
+
+            await outbox_service.process_outbox_once()
+            db.expire_all()
+            assert db.get(BalanceSnapshot, mock_admin_user.id).held_minor == 0
+            statuses = sorted(hold.status for hold in db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id))
+            created = [response for response in responses if response.status_code == 202]
+            failed = [response for response in created if response.json()["marzban_username"] == "billed-1"]
+            assert statuses == sorted(["released"] * len(failed) + ["committed"] * (2 - len(failed)))
+            assert ledger_service.get_balance_minor(db, mock_admin_user.id) == 100000 - 40000 * (2 - len(failed))
+    finally:
+        db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+        db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceLedgerEntry).filter(BalanceLedgerEntry.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceSnapshot).filter(BalanceSnapshot.admin_id == mock_admin_user.id).delete()
+        db.delete(plan)
+        db.commit()
+        db.close()
+
+@respx.mock
+async def test_queued_create_of_a_removed_user_is_undone_and_not_charged(async_client: AsyncClient, monkeypatch):
+    """
+    Tests that bulk delete leaves users that are still being created alone, and that a queued
+    creation whose local row is gone deletes the user from Marzban again and releases the hold.
+    """
+    monkeypatch.setattr(ledger_service, "BILLING_ENABLED", True)
+    db = SessionLocal()
+    plan = Plan(name="orphan-plan", price=100, duration_days=30, data_limit_gb=10)
+    db.add(plan)
+    db.add(BalanceLedgerEntry(admin_id=mock_admin_user.id, amount_minor=10000, kind="adjustment"))
+    db.commit()
+
+    create_route = respx.post("https://marzban.test/api/user").mock(return_value=Response(200, json={"username": "orphan-1", "status": "active"}))
+    delete_route = respx.delete("https://marzban.test/api/user/orphan-1").mock(return_value=Response(200))
+    try:
+        with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+            response = await async_client.post("/api/v1/admin/vpnusers/", json={"marzban_username": "orphan-1", "plan_id": plan.id})
+            assert response.status_code == 202
+
+            response = await async_client.post("/api/v1/admin/vpnusers/bulk/delete", json={"usernames": ["orphan-1"]})
+            lines = [json.loads(line) for line in response.text.splitlines()]
+            assert lines[-1]["succeeded"] == 0
+            assert delete_route.call_count == 0
+            assert db.query(VpnUser).filter(VpnUser.marzban_username == "orphan-1").count() == 1
+
+            # The row goes away while the creation is still queued
+            db.query(VpnUser).filter(VpnUser.marzban_username == "orphan-1").delete()
+            db.commit()
+            await outbox_service.process_outbox_once()
+            assert create_route.call_count == 1
+            await outbox_service.process_outbox_once()
+            assert delete_route.call_count == 1
+
+        db.expire_all()
+        assert [hold.status for hold in db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id)] == ["released"]
+        assert ledger_service.get_balance_minor(db, mock_admin_user.id) == 10000
+    finally:
+        db.query(VpnUser).filter(VpnUser.plan_id == plan.id).delete()
+        db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceLedgerEntry).filter(BalanceLedgerEntry.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceSnapshot).filter(BalanceSnapshot.admin_id == mock_admin_user.id).delete()
+        db.delete(plan)
+        db.commit()
+        db.close()
+
+@respx.mock
+async def test_batch_stores_users_and_holds_before_marzban(async_client: AsyncClient, monkeypatch):
+    """
+    Tests that a batch stores its users as pending with one hold and one outbox entry each before
+    anything is created in Marzban, that a username taken meanwhile is reported per user and not
+    charged, and that a batch the balance can't cover stores nothing.
+    """
+    monkeypatch.setattr(ledger_service, "BILLING_ENABLED", True)
+    db = SessionLocal()
+    plan = Plan(name="race-plan", price=1, duration_days=30, data_limit_gb=10)
+    expensive_plan = Plan(name="race-plan-expensive", price=60, duration_days=30, data_limit_gb=10)
+    db.add_all([plan, expensive_plan])
+    db.add(BalanceLedgerEntry(admin_id=mock_admin_user.id, amount_minor=10000, kind="adjustment"))
+    db.commit()
+
+    choose_node = node_service.choose_node
+    async def choose_node_while_another_request_stores_race_2(*args, **kwargs):
+        # A concurrent single create stores the same username after the uniqueness check
+        other = SessionLocal()
+        if not other.query(VpnUser).filter(VpnUser.marzban_username == "race-2").count():
+            other.add(VpnUser(marzban_username="race-2", admin_id=mock_admin_user.id, plan_id=plan.id, provisioning_status="pending"))
+            other.commit()
+        other.close()
+        return await choose_node(*args, **kwargs)
+    monkeypatch.setattr(node_service, "choose_node", choose_node_while_another_request_stores_race_2)
+
+    add_route = respx.post("https://marzban.test/api/user").mock(
+        side_effect=lambda request: Response(200, json={"username": json.loads(request.content)["username"]})
+    )
+    try:
+        with patch.dict(marzban_service._nodes, {marzban_service.MARZBAN_DEFAULT_NODE: _fake_marzban_node()}):
+            response = await async_client.post("/api/v1/admin/vpnusers/batch", json={"plan_id": plan.id, "usernames": ["race-1", "race-2"]})
+            assert response.status_code == 202
+            data = response.json()
+            assert (data["created"], data["failed"]) == (1, 1)
+            assert data["results"][1] == {"marzban_username": "race-2", "success": False, "detail": "Username already exists in our panel."}
+
+            # Everything a crash would need to finish or undo the creation is stored already
+            assert not add_route.called
+            assert db.query(VpnUser).filter(VpnUser.marzban_username == "race-1").one().provisioning_status == "pending"
+            hold = db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id).one()
+            assert (hold.status, hold.amount_minor) == ("held", 100)
+            entry = db.query(MarzbanOutbox).filter(MarzbanOutbox.marzban_username == "race-1").one()
+            assert json.loads(entry.payload)["hold_id"] == hold.id
+
+            await outbox_service.process_outbox_once()
+            assert [json.loads(call.request.content)["username"] for call in add_route.calls] == ["race-1"]
+
+            response = await async_client.post("/api/v1/admin/vpnusers/batch", json={"plan_id": expensive_plan.id, "usernames": ["race-3", "race-4"]})
+            assert response.status_code == 402
+            assert db.query(VpnUser).filter(VpnUser.marzban_username.in_(["race-3", "race-4"])).count() == 0
+            assert db.query(MarzbanOutbox).filter(MarzbanOutbox.marzban_username.in_(["race-3", "race-4"])).count() == 0
+
+        db.expire_all()
+        assert db.query(VpnUser).filter(VpnUser.marzban_username == "race-1").one().provisioning_status == "provisioned"
+        assert [hold.status for hold in db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id)] == ["committed"]
+        assert ledger_service.get_balance_minor(db, mock_admin_user.id) == 10000 - 100
+    finally:
+        db.query(MarzbanOutbox).filter(MarzbanOutbox.marzban_username.like("race-%")).delete(synchronize_session=False)
+        db.query(VpnUser).filter(VpnUser.plan_id.in_([plan.id, expensive_plan.id])).delete(synchronize_session=False)
+        db.query(BalanceHold).filter(BalanceHold.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceLedgerEntry).filter(BalanceLedgerEntry.admin_id == mock_admin_user.id).delete()
+        db.query(BalanceSnapshot).filter(BalanceSnapshot.admin_id == mock_admin_user.id).delete()
+        db.delete(plan)
+        db.delete(expensive_plan)
+        db.commit()
+        db.close()
@@ -0,0 +1,127 @@
+import pytest
+
+# Add the parent directory to the path to allow imports from 'app'
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine, select, text, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from app import models
+from app.database import to_async_database_url, AsyncSessionLocal, Base
+from app.schema_upgrade import upgrade_schema
+from app.pool_metrics import instrumented_pool_class, get_pool_stats
+
+# Mark all tests in this file as async
+pytestmark = pytest.mark.asyncio
+
+
+async def test_to_async_database_url():
+    """
+    Tests that sync DATABASE_URLs are mapped to their async drivers.
+    """
+    assert to_async_database_url("mysql+pymysql://u:p@db:3306/panel") == "mysql+aiomysql://u:p@db:3306/panel"
+    assert to_async_database_url("postgresql://u:p@db/panel") == "postgresql+asyncpg://u:p@db/panel"
+    assert to_async_database_url("sqlite:///./test.db") == "sqlite+aiosqlite:///./test.db"
+    # Already-async URLs are left alone
+    assert to_async_database_url("mysql+aiomysql://u:p@db/panel") == "mysql+aiomysql://u:p@db/panel"
+
+
+async def test_async_session_reads_tables():
+    """
+    Tests that the async session works against the configured database.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(models.Plan).limit(1))
+        assert isinstance(result.scalars().all(), list)
+
+
+async def test_instrumented_pool_records_checkouts_and_timeouts(tmp_path):
+    """
+    Tests that the instrumented pool reports occupancy, checkout waits and timeouts.
+    """
+    pool_engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=instrumented_pool_class(QueuePool, "test-pool"),
+        pool_size=1, max_overflow=0, pool_timeout=0.05,
+    )
+    connection = pool_engine.connect()
+    stats = get_pool_stats(pool_engine, "test-pool")
+    assert stats["pool_class"] == "InstrumentedQueuePool"
+    assert stats["size"] == 1
+    assert stats["checkedout"] == 1
+    assert stats["checkouts"] == 1
+
+    # The only connection is checked out, so the next checkout waits pool_timeout and fails
+    with pytest.raises(PoolTimeoutError):
+        pool_engine.connect()
+    connection.close()
+
+    stats = get_pool_stats(pool_engine, "test-pool")
+    assert stats["checkedout"] == 0
+    assert stats["timeouts"] == 1
+    assert stats["wait_ms_max"] >= 50
+    assert stats["wait_ms_buckets"]["+Inf"] == 2 # Cumulative histogram covers every observation
+    pool_engine.dispose()
+
+
+# Tables as created by the first release, before any column was added to them
+BASELINE_SCHEMA = [
+    "CREATE TABLE super_admins (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE, hashed_password VARCHAR NOT NULL,"
+    " email VARCHAR NOT NULL UNIQUE, created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE admins (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE, hashed_password VARCHAR NOT NULL,"
+    " email VARCHAR NOT NULL UNIQUE, balance FLOAT, is_active BOOLEAN, created_by_super_admin_id INTEGER REFERENCES super_admins (id),"
+    " created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE plans (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE, price FLOAT NOT NULL, duration_days INTEGER NOT NULL,"
+    " data_limit_gb FLOAT NOT NULL, is_active BOOLEAN, created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE vpn_users (id INTEGER PRIMARY KEY, marzban_username VARCHAR NOT NULL UNIQUE, admin_id INTEGER NOT NULL REFERENCES admins (id),"
+    " plan_id INTEGER NOT NULL REFERENCES plans (id), abresani_user_id VARCHAR UNIQUE, is_active BOOLEAN, created_at DATETIME,"
+    " updated_at DATETIME, expires_at DATETIME, notes VARCHAR)",
+    "CREATE TABLE payment_logs (id INTEGER PRIMARY KEY, admin_id INTEGER NOT NULL REFERENCES admins (id), amount FLOAT NOT NULL,"
+    " authority VARCHAR NOT NULL UNIQUE, ref_id VARCHAR UNIQUE, status VARCHAR NOT NULL, created_at DATETIME, verified_at DATETIME)",
+]
+
+
+async def test_upgrade_schema_adds_new_columns_to_baseline_tables(tmp_path):
+    """
+    Tests that starting on a database from the first release adds the columns and indexes
+    added since, keeps the existing rows, and is a no-op on the next start.
+    """
+    upgrade_engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with upgrade_engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text(
+            "INSERT INTO admins (id, username, hashed_password, email, balance, is_active) VALUES (1, 'old', 'x', 'old@example.com', 12.5, 1)"
+        ))
+        connection.execute(text(
+            "INSERT INTO plans (id, name, price, duration_days, data_limit_gb, is_active) VALUES (1, 'old-plan', 10, 30, 50, 1)"
+        ))
+        connection.execute(text("INSERT INTO vpn_users (marzban_username, admin_id, plan_id, is_active) VALUES ('old-user', 1, 1, 1)"))
+        # A balance snapshot table from before holds existed
+        connection.execute(text(
+            "CREATE TABLE balance_snapshots (admin_id INTEGER PRIMARY KEY REFERENCES admins (id),"
+            " balance_minor BIGINT NOT NULL, last_entry_id INTEGER NOT NULL, updated_at DATETIME)"
+        ))
+
+    Base.metadata.create_all(bind=upgrade_engine)
+    added = upgrade_schema(upgrade_engine, Base.metadata)
+    for column in ("vpn_users.used_traffic", "vpn_users.provisioning_status", "vpn_users.marzban_node",
+                   "vpn_users.disabled_reason", "admins.marzban_node", "plans.marzban_node",
+                   "payment_logs.verifying_since", "balance_snapshots.held_minor"):
+        assert column in added
+    assert "ix_vpn_users_admin_created_id" in {index["name"] for index in inspect(upgrade_engine).get_indexes("vpn_users")}
+
+    with Session(upgrade_engine) as db:
+        vpn_user = db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "old-user").one()
+        assert vpn_user.provisioning_status == "provisioned" # Existing users count as created in Marzban
+        assert vpn_user.used_traffic is None
+        admin = db.get(models.Admin, 1)
+        assert admin.legacy_balance == 12.5
+        assert admin.held_minor == 0
+
+    assert upgrade_schema(upgrade_engine, Base.metadata) == []
+    upgrade_engine.dispose()
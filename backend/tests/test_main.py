@@ -1,6 +1,10 @@
+import os
+
 import pytest
 from httpx import AsyncClient
 
+from app import metrics
+
 # Mark all tests in this file as async
 pytestmark = pytest.mark.asyncio
 
@@ -19,3 +23,42 @@ async def test_root(async_client: AsyncClient):
     response = await async_client.get("/")
     assert response.status_code == 200
     assert "message" in response.json()
+
+async def test_metrics_record_route_template_status_and_db_queries(async_client: AsyncClient):
+    """
+    Tests that /metrics reports request latency under the route template (not the raw path),
+    with the status and the database queries the request ran.
+    """
+    metrics.reset_metrics()
+    await async_client.post("/api/v1/superadmin/login/token", data={"username": "nobody", "password": "wrong"})
+    await async_client.get("/no/such/path/42")
+
+    response = await async_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="POST",route="/api/v1/superadmin/login/token",status="401"} 1' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="<unmatched>",status="404"} 1' in body
+    assert "/no/such/path/42" not in body
+    # The login looked the super admin up through the async engine
+    assert 'http_request_db_queries_bucket{method="POST",route="/api/v1/superadmin/login/token",le="0"} 0' in body
+    assert 'db_query_duration_seconds_count{engine="async"}' in body
+
+async def test_metrics_sum_workers_in_multiprocess_mode(monkeypatch, tmp_path):
+    """
+    Tests that in multiprocess mode /metrics adds up the counts every worker wrote.
+    """
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", str(tmp_path))
+    metrics.reset_metrics()
+    metrics.UPSTREAM_REQUEST_DURATION.observe(0.2, "marzban", "GET user/{username}", "default", "ok")
+    metrics.flush_metrics()
+    # Another worker's file (it observed the same series twice)
+    own_file = tmp_path / f"worker-{os.getpid()}.json"
+    (tmp_path / "worker-1.json").write_text(own_file.read_text().replace("[0, 0, 0, 0, 0, 1,", "[0, 0, 0, 0, 0, 2,").replace("0.2]", "0.5]"))
+    metrics.UPSTREAM_REQUEST_DURATION.observe(3, "marzban", "GET user/{username}", "default", "ok")
+
+    body = metrics.render_metrics()
+    assert 'upstream_request_duration_seconds_count{upstream="marzban",operation="GET user/{username}",node="default",outcome="ok"} 4' in body
+    assert 'upstream_request_duration_seconds_bucket{upstream="marzban",operation="GET user/{username}",node="default",outcome="ok",le="0.25"} 3' in body
+    assert 'upstream_request_duration_seconds_sum{upstream="marzban",operation="GET user/{username}",node="default",outcome="ok"} 3.7' in body
+    metrics.reset_metrics()
@@ -83,3 +83,502 @@ async def test_request_payment_failure_no_config():
 
     with pytest.raises(zarinpal_service.ZarinpalError, match="Zarinpal service is not configured"):
         await zarinpal_service.request_payment(amount=50000, description="Test")
+
+
+# --------------- Marzban service ---------------
+from app.services import marzban_service, shared_state, resilience
+from jose import jwt as jose_jwt
+import asyncio
+import time
+
+MARZBAN_TEST_URL = "https://marzban.test"
+
+@pytest.fixture
+def marzban_config(monkeypatch):
+    """Point the default Marzban node at a fake panel and start from a clean client and token cache."""
+    node = marzban_service.MarzbanNode(marzban_service.MARZBAN_DEFAULT_NODE, MARZBAN_TEST_URL, "sudo", "secret")
+    node.breaker = resilience.CircuitBreaker(
+        window_seconds=30, min_calls=4, failure_rate=0.5, slow_call_seconds=5, open_seconds=30)
+    node.retry_budget = resilience.RetryBudget(0.1, 3, 30)
+    node.bulkhead = resilience.Bulkhead(40, 2)
+    monkeypatch.setitem(marzban_service._nodes, marzban_service.MARZBAN_DEFAULT_NODE, node)
+    marzban_service.clear_user_cache()
+    monkeypatch.setattr(marzban_service, "MARZBAN_RETRY_BACKOFF_SECONDS", 0)
+    shared_state.set_shared_store(shared_state.MemorySharedStore())
+
+@respx.mock
+async def test_marzban_requests_reuse_shared_client(marzban_config, monkeypatch):
+    """
+    Tests that consecutive Marzban calls go through the same pooled client
+    instead of opening a new one per request.
+    """
+    monkeypatch.setattr(marzban_service, "MARZBAN_USER_CACHE_TTL_SECONDS", 0) # Both calls must reach Marzban
+    respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        return_value=Response(200, json={"access_token": "tok", "token_type": "bearer"})
+    )
+    user_route = respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        return_value=Response(200, json={"username": "alice", "status": "active"})
+    )
+
+    await marzban_service.init_marzban_clients()
+    node = marzban_service.get_node()
+    client = node.client
+    await marzban_service.get_marzban_user_details("alice")
+    await marzban_service.get_marzban_user_details("alice")
+
+    assert user_route.call_count == 2
+    assert await node.get_client() is client
+
+    await marzban_service.close_marzban_clients()
+    assert node.client is None
+
+@respx.mock
+async def test_marzban_user_details_cache_coalesces_and_invalidates(marzban_config):
+    """
+    Tests that concurrent lookups of one user share a single Marzban request, that the
+    result is then served from the cache, and that a traffic reset invalidates it.
+    """
+    respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        return_value=Response(200, json={"access_token": "tok", "token_type": "bearer"})
+    )
+    user_route = respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        return_value=Response(200, json={"username": "alice", "used_traffic": 10})
+    )
+    respx.post(f"{MARZBAN_TEST_URL}/api/user/alice/reset").mock(return_value=Response(200, json={"username": "alice"}))
+
+    before = marzban_service.get_user_cache_stats()
+    results = await asyncio.gather(*(marzban_service.get_marzban_user_details("alice") for _ in range(5)))
+    assert [r["used_traffic"] for r in results] == [10] * 5
+    assert user_route.call_count == 1
+
+    await marzban_service.get_marzban_user_details("alice")
+    assert user_route.call_count == 1
+
+    await marzban_service.reset_marzban_user_traffic("alice")
+    await marzban_service.get_marzban_user_details("alice")
+    assert user_route.call_count == 2
+
+    stats = marzban_service.get_user_cache_stats()
+    assert [stats[key] - before[key] for key in ("misses", "coalesced", "hits")] == [2, 4, 1]
+
+@respx.mock
+async def test_marzban_user_details_bypass_cache(marzban_config):
+    """
+    Tests that use_cache=False reaches Marzban even while the user's details are cached.
+    """
+    respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        return_value=Response(200, json={"access_token": "tok", "token_type": "bearer"})
+    )
+    user_route = respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        side_effect=[Response(200, json={"username": "alice", "used_traffic": 10}),
+                     Response(200, json={"username": "alice", "used_traffic": 20})]
+    )
+
+    assert (await marzban_service.get_marzban_user_details("alice"))["used_traffic"] == 10
+    assert (await marzban_service.get_marzban_user_details("alice", use_cache=False))["used_traffic"] == 20
+    assert user_route.call_count == 2
+
+@respx.mock
+async def test_marzban_circuit_breaker_retries_then_fails_fast(marzban_config):
+    """
+    Tests that GETs are retried after a 503, that repeated failures open the breaker,
+    and that calls then fail with MarzbanUnavailableError without reaching Marzban.
+    """
+    respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        return_value=Response(200, json={"access_token": "tok", "token_type": "bearer"})
+    )
+    user_route = respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        side_effect=[Response(503, json={"detail": "overloaded"}), Response(200, json={"username": "alice"})]
+    )
+    assert (await marzban_service.get_marzban_user_details("alice"))["username"] == "alice"
+    assert user_route.call_count == 2
+
+    reset_route = respx.post(f"{MARZBAN_TEST_URL}/api/user/alice/reset").mock(return_value=Response(500, json={"detail": "boom"}))
+    # With the 503 above, 3 of the 4 calls in the window have failed after this
+    for _ in range(2):
+        with pytest.raises(marzban_service.MarzbanAPIError) as error:
+            await marzban_service.reset_marzban_user_traffic("alice")
+        assert error.value.status_code == 500
+    assert reset_route.call_count == 2 # POSTs are not retried
+
+    with pytest.raises(marzban_service.MarzbanUnavailableError) as error:
+        await marzban_service.reset_marzban_user_traffic("alice")
+    assert error.value.status_code == 503 and error.value.retry_after > 0
+    assert reset_route.call_count == 2
+    assert marzban_service.get_client_resilience_stats()[marzban_service.MARZBAN_DEFAULT_NODE]["circuit_breaker"]["state"] == "open"
+
+def _marzban_jwt(expires_in: int) -> str:
+    return jose_jwt.encode({"sub": "sudo", "exp": int(time.time()) + expires_in}, "k", algorithm="HS256")
+
+@respx.mock
+async def test_marzban_token_refresh_is_single_flight(marzban_config):
+    """
+    Tests that concurrent requests share one login and that the token expiry
+    is taken from the JWT 'exp' claim.
+    """
+    token = _marzban_jwt(3600)
+    login_route = respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        return_value=Response(200, json={"access_token": token, "token_type": "bearer"})
+    )
+    respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        return_value=Response(200, json={"username": "alice"})
+    )
+
+    await asyncio.gather(*(marzban_service.get_marzban_user_details("alice") for _ in range(10)))
+
+    assert login_route.call_count == 1
+    assert marzban_service.get_node().auth_cache["expires_at"] == jose_jwt.get_unverified_claims(token)["exp"]
+    # The token is published for the other workers as well
+    assert shared_state.get_shared_store().get(marzban_service.MARZBAN_TOKEN_STORE_KEY)["token"] == token
+
+@respx.mock
+async def test_marzban_request_retries_once_after_401(marzban_config):
+    """
+    Tests that a 401 from Marzban refreshes the token and retries the request transparently.
+    """
+    old_token, new_token = _marzban_jwt(3600), _marzban_jwt(7200)
+    respx.post(f"{MARZBAN_TEST_URL}/api/admin/token").mock(
+        side_effect=[
+            Response(200, json={"access_token": old_token}),
+            Response(200, json={"access_token": new_token}),
+        ]
+    )
+    user_route = respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(
+        side_effect=[Response(401, json={"detail": "expired"}), Response(200, json={"username": "alice"})]
+    )
+
+    result = await marzban_service.get_marzban_user_details("alice")
+
+    assert result == {"username": "alice"}
+    assert user_route.call_count == 2
+    assert user_route.calls[1].request.headers["Authorization"] == f"Bearer {new_token}"
+
+
+# --------------- Principal cache ---------------
+from fastapi import HTTPException
+from app import models, security
+from app.database import SessionLocal, AsyncSessionLocal
+from app.services import principal_cache
+
+async def test_get_current_admin_is_cached_until_invalidated_or_revoked(monkeypatch):
+    """
+    Tests that repeated authentications with one token hit the principal cache,
+    that an invalidation forces a fresh DB read, and that a revocation rejects the token.
+    """
+    shared_state.set_shared_store(shared_state.MemorySharedStore())
+    principal_cache.clear_principal_cache()
+    monkeypatch.setattr(principal_cache, "_invalidations", {})
+    monkeypatch.setattr(principal_cache, "_revocations", {})
+
+    db = SessionLocal()
+    admin = models.Admin(username="cached-admin", email="cached@admin.com", hashed_password="x")
+    db.add(admin)
+    db.commit()
+    token = security.create_access_token({"sub": "cached-admin", "type": "admin"}, expires_delta=None)
+    try:
+        async with AsyncSessionLocal() as session:
+            first = await security.get_current_admin(token, session)
+            second = await security.get_current_admin(token, session)
+        assert second is first
+        assert principal_cache.get_principal_cache_stats()["hits"] == 1
+
+        principal_cache.invalidate_principal(principal_cache.PRINCIPAL_ADMIN, "cached-admin")
+        async with AsyncSessionLocal() as session:
+            third = await security.get_current_admin(token, session)
+        assert third is not first
+
+        principal_cache.revoke_principal(principal_cache.PRINCIPAL_ADMIN, "cached-admin", token_lifetime_seconds=60)
+        async with AsyncSessionLocal() as session:
+            with pytest.raises(HTTPException) as exc_info:
+                await security.get_current_admin(token, session)
+        assert exc_info.value.status_code == 401
+    finally:
+        db.delete(admin)
+        db.commit()
+        db.close()
+        principal_cache.clear_principal_cache()
+
+
+async def test_revocation_does_not_block_the_event_loop_on_the_shared_lock(tmp_path, monkeypatch):
+    """
+    Tests that recording a revocation from the event loop doesn't wait for another process
+    holding the file store's lock, applies on this worker right away and reaches the store later.
+    """
+    import fcntl
+    store = shared_state.FileSharedStore(str(tmp_path))
+    shared_state.set_shared_store(store)
+    monkeypatch.setattr(principal_cache, "_invalidations", {})
+    monkeypatch.setattr(principal_cache, "_revocations", {})
+
+    # Another worker is in the middle of an update (a separate open file conflicts like another process)
+    other_worker = open(tmp_path / f"{principal_cache.REVOCATIONS_KEY}.update.lock", "w")
+    fcntl.flock(other_worker, fcntl.LOCK_EX)
+    try:
+        started = time.monotonic()
+        principal_cache.revoke_principal(principal_cache.PRINCIPAL_ADMIN, "locked-admin", token_lifetime_seconds=60)
+        assert time.monotonic() - started < 0.5
+        assert principal_cache.is_token_revoked(principal_cache.PRINCIPAL_ADMIN, "locked-admin", issued_at=int(time.time()) - 1)
+        assert store.get(principal_cache.REVOCATIONS_KEY) is None
+    finally:
+        fcntl.flock(other_worker, fcntl.LOCK_UN)
+        other_worker.close()
+    await asyncio.gather(*principal_cache._writes_in_progress)
+    assert "admin:locked-admin" in store.get(principal_cache.REVOCATIONS_KEY)
+    shared_state.set_shared_store(shared_state.MemorySharedStore())
+
+
+# --------------- Payment reconciliation ---------------
+from datetime import datetime, timedelta
+from app.services import reconciliation_service
+from tests.fake_zarinpal import FakeZarinpal
+
+@respx.mock
+async def test_reconciler_settles_paid_and_expires_unpaid_payments(monkeypatch):
+    """
+    Tests that old pending payments are verified against the Zarinpal stand-in: paid ones are
+    completed and credited once, unpaid ones expired, transient failures retried on the next pass,
+    and recent ones left to their callback.
+    """
+    monkeypatch.setattr(zarinpal_service, "ZARINPAL_MERCHANT_ID", "TEST_MERCHANT_ID")
+    monkeypatch.setattr(reconciliation_service, "PAYMENT_RECONCILE_CONCURRENCY", 1)
+    monkeypatch.setattr(reconciliation_service, "PAYMENT_RECONCILE_RATE_PER_SECOND", 0)
+    zarinpal = FakeZarinpal()
+    zarinpal.install(respx)
+
+    db = SessionLocal()
+    admin = models.Admin(username="reconcile-admin", email="reconcile@admin.com", hashed_password="x")
+    db.add(admin)
+    db.commit()
+    old = datetime.utcnow() - timedelta(hours=2)
+    payments = {
+        "flaky": zarinpal.create_payment(30000, paid=True),
+        "paid": zarinpal.create_payment(20000, paid=True),
+        "unpaid": zarinpal.create_payment(10000),
+        "recent": zarinpal.create_payment(40000, paid=True),
+    }
+    for name, authority in payments.items():
+        created_at = datetime.utcnow() if name == "recent" else old + timedelta(seconds=len(db.new))
+        db.add(models.PaymentLog(admin_id=admin.id, amount=zarinpal.payments[authority]["amount"],
+                                 authority=authority, status="pending", created_at=created_at))
+    db.commit()
+    zarinpal.unavailable_calls = 1 # The first verify call (the oldest payment) hits an outage
+    try:
+        stats = await reconciliation_service.reconcile_once()
+        assert stats["backlog"] == 3
+        assert (stats["settled"], stats["expired"], stats["retried"]) == (1, 1, 1)
+
+        stats = await reconciliation_service.reconcile_once()
+        assert (stats["settled"], stats["expired"], stats["retried"]) == (1, 0, 0)
+        stats = await reconciliation_service.reconcile_once()
+        assert stats["claimed"] == 0 and stats["backlog"] == 0
+
+        statuses = {log.authority: log.status for log in db.query(models.PaymentLog).filter(models.PaymentLog.admin_id == admin.id)}
+        assert statuses == {payments["flaky"]: "completed", payments["paid"]: "completed",
+                            payments["unpaid"]: "expired", payments["recent"]: "pending"}
+        db.refresh(admin)
+        assert admin.balance == 50000.0
+        assert zarinpal.verify_calls == 4
+    finally:
+        db.query(models.PaymentLog).filter(models.PaymentLog.admin_id == admin.id).delete()
+        db.query(models.BalanceLedgerEntry).filter(models.BalanceLedgerEntry.admin_id == admin.id).delete()
+        db.delete(admin)
+        db.commit()
+        db.close()
+
+
+@respx.mock
+async def test_reconciler_keeps_paid_payment_pending_on_refused_verification(monkeypatch):
+    """
+    Tests that a rate-limited (429) or refused (-9, e.g. merchant settings) verify call leaves a
+    paid payment pending instead of expiring it, and that a later pass credits it.
+    """
+    monkeypatch.setattr(zarinpal_service, "ZARINPAL_MERCHANT_ID", "TEST_MERCHANT_ID")
+    monkeypatch.setattr(reconciliation_service, "PAYMENT_RECONCILE_RATE_PER_SECOND", 0)
+    zarinpal = FakeZarinpal()
+    zarinpal.install(respx)
+
+    db = SessionLocal()
+    admin = models.Admin(username="refused-admin", email="refused@admin.com", hashed_password="x")
+    db.add(admin)
+    db.commit()
+    authority = zarinpal.create_payment(15000, paid=True)
+    db.add(models.PaymentLog(admin_id=admin.id, amount=15000, authority=authority, status="pending",
+                             created_at=datetime.utcnow() - timedelta(hours=2)))
+    db.commit()
+    zarinpal.verify_errors = [(429, -1), (200, -9)]
+    try:
+        for _ in range(2):
+            stats = await reconciliation_service.reconcile_once()
+            assert (stats["settled"], stats["expired"], stats["retried"]) == (0, 0, 1)
+            assert db.query(models.PaymentLog.status).filter(models.PaymentLog.authority == authority).scalar() == "pending"
+
+        stats = await reconciliation_service.reconcile_once()
+        assert stats["settled"] == 1
+        db.refresh(admin)
+        assert admin.balance == 15000.0
+    finally:
+        db.query(models.PaymentLog).filter(models.PaymentLog.admin_id == admin.id).delete()
+        db.query(models.BalanceLedgerEntry).filter(models.BalanceLedgerEntry.admin_id == admin.id).delete()
+        db.delete(admin)
+        db.commit()
+        db.close()
+
+
+# --------------- Balance ledger ---------------
+from sqlalchemy.exc import IntegrityError
+from app.services import ledger_service
+
+async def test_balance_is_snapshot_plus_ledger_delta(monkeypatch):
+    """
+    Tests that balances are exact sums of integer ledger entries, that folding entries into the
+    snapshot doesn't change them, that a payment is credited only once and that old balances carry over.
+    """
+    monkeypatch.setattr(ledger_service, "LEDGER_SNAPSHOT_SETTLE_SECONDS", -60) # Fold everything, however new
+    db = SessionLocal()
+    admin = models.Admin(username="ledger-admin", email="ledger@admin.com", hashed_password="x")
+    legacy = models.Admin(username="legacy-admin", email="legacy@admin.com", hashed_password="x", legacy_balance=12.5)
+    db.add_all([admin, legacy])
+    db.flush()
+    ledger_service.open_ledger(db, admin, opening_balance=10.005)
+    db.commit()
+    try:
+        for payment_id in (1, 2, 3):
+            db.add(ledger_service.payment_credit(900000 + payment_id, admin.id, 0.1))
+        db.commit()
+        db.refresh(admin)
+        assert admin.balance_minor == 1001 + 30 # 0.1 + 0.1 + 0.1 is exactly 0.3 here
+
+        db.add(ledger_service.payment_credit(900001, admin.id, 0.1))
+        with pytest.raises(IntegrityError):
+            db.commit()
+        db.rollback()
+
+        stats = await ledger_service.refresh_snapshots()
+        assert stats["snapshots_refreshed"] >= 1
+        snapshot = db.get(models.BalanceSnapshot, admin.id)
+        db.refresh(snapshot)
+        assert snapshot.balance_minor == 1031
+        db.add(ledger_service.ledger_entry(admin.id, -531, ledger_service.KIND_PURCHASE))
+        db.commit()
+        db.refresh(admin)
+        assert admin.balance == 5.0
+        assert ledger_service.lock_balance(db, admin.id) == 500 # Snapshot plus the entry after it
+        db.commit()
+
+        ledger_service.open_ledgers(db)
+        db.refresh(legacy)
+        assert legacy.balance == 12.5
+        assert (await ledger_service.get_ledger_stats())["entries_after_snapshots"] >= 2
+    finally:
+        for row in (admin, legacy):
+            db.query(models.BalanceLedgerEntry).filter(models.BalanceLedgerEntry.admin_id == row.id).delete()
+            db.query(models.BalanceSnapshot).filter(models.BalanceSnapshot.admin_id == row.id).delete()
+            db.delete(row)
+        db.commit()
+        db.close()
+
+
+async def test_admin_with_balance_history_is_not_deleted():
+    """
+    Tests that deleting an admin with ledger entries is refused, so the history isn't lost,
+    while an admin without any can still be deleted.
+    """
+    from fastapi import HTTPException
+    from app.api.v1.endpoints import admins as admins_endpoint
+    db = SessionLocal()
+    funded = models.Admin(username="funded-admin", email="funded@admin.com", hashed_password="x")
+    empty = models.Admin(username="empty-admin", email="empty@admin.com", hashed_password="x")
+    db.add_all([funded, empty])
+    db.flush()
+    ledger_service.open_ledger(db, funded, opening_balance=5)
+    ledger_service.open_ledger(db, empty)
+    db.commit()
+    try:
+        with pytest.raises(HTTPException) as exc_info:
+            admins_endpoint.delete_admin(funded.id, db=db, current_super_admin=None)
+        assert exc_info.value.status_code == 409
+        admins_endpoint.delete_admin(empty.id, db=db, current_super_admin=None)
+        assert db.get(models.Admin, empty.id) is None
+    finally:
+        db.query(models.BalanceLedgerEntry).filter(models.BalanceLedgerEntry.admin_id == funded.id).delete()
+        db.query(models.BalanceSnapshot).filter(models.BalanceSnapshot.admin_id.in_([funded.id, empty.id])).delete()
+        db.delete(funded)
+        db.commit()
+        db.close()
+
+
+async def test_balance_holds_commit_release_and_expire(monkeypatch):
+    """
+    Tests that holds can't exceed the available balance, that committing books the debit,
+    releasing and expiring free the held amount, and that settling twice does nothing.
+    """
+    db = SessionLocal()
+    admin = models.Admin(username="hold-admin", email="hold@admin.com", hashed_password="x")
+    db.add(admin)
+    db.flush()
+    ledger_service.open_ledger(db, admin, opening_balance=10)
+    db.commit()
+    try:
+        async with AsyncSessionLocal() as session:
+            first_id = (await ledger_service.place_hold(session, admin.id, 600, note="first")).id
+            await session.commit()
+            with pytest.raises(ledger_service.InsufficientBalanceError) as exc_info:
+                await ledger_service.place_hold(session, admin.id, 600)
+            assert exc_info.value.available_minor == 400
+            await session.rollback()
+
+            assert await ledger_service.settle_hold(session, first_id) == ledger_service.HOLD_COMMITTED
+            await session.commit()
+            assert await ledger_service.settle_hold(session, first_id, []) == ledger_service.HOLD_COMMITTED
+            released_id = (await ledger_service.place_hold(session, admin.id, 300)).id
+            await session.commit()
+            assert await ledger_service.settle_hold(session, released_id, []) == ledger_service.HOLD_RELEASED
+            await session.commit()
+
+            monkeypatch.setattr(ledger_service, "BALANCE_HOLD_TTL_SECONDS", -1)
+            abandoned_id = (await ledger_service.place_hold(session, admin.id, 400)).id
+            await session.commit()
+        assert (await ledger_service.refresh_snapshots())["holds_expired"] == 1
+
+        db.refresh(admin)
+        assert (admin.balance_minor, admin.held_minor) == (400, 0)
+        async with AsyncSessionLocal() as session:
+            # The purchase went through after all: an expired hold still books its debit
+            assert await ledger_service.settle_hold(session, abandoned_id) == ledger_service.HOLD_COMMITTED
+            await session.commit()
+        db.refresh(admin)
+        assert (admin.balance_minor, admin.held_minor) == (0, 0)
+    finally:
+        db.query(models.BalanceHold).filter(models.BalanceHold.admin_id == admin.id).delete()
+        db.query(models.BalanceLedgerEntry).filter(models.BalanceLedgerEntry.admin_id == admin.id).delete()
+        db.query(models.BalanceSnapshot).filter(models.BalanceSnapshot.admin_id == admin.id).delete()
+        db.delete(admin)
+        db.commit()
+        db.close()
+
+
+# --- Metrics ---
+
+from app import metrics
+
+
+@respx.mock
+async def test_marzban_calls_are_timed_per_endpoint_template_and_outcome(marzban_config):
+    """
+    Tests that Marzban calls land in upstream_request_duration_seconds under the endpoint
+    without the username, labelled with Marzban's status code.
+    """
+    metrics.reset_metrics()
+    marzban_service.get_node().auth_cache = {"token": "tok", "expires_at": 2**40}
+    respx.get(f"{MARZBAN_TEST_URL}/api/user/alice").mock(return_value=Response(200, json={"username": "alice"}))
+    respx.get(f"{MARZBAN_TEST_URL}/api/user/bob").mock(return_value=Response(404, json={"detail": "User not found"}))
+    await marzban_service._make_marzban_request("GET", "user/alice")
+    with pytest.raises(marzban_service.MarzbanAPIError):
+        await marzban_service._make_marzban_request("GET", "user/bob")
+
+    body = metrics.render_metrics()
+    labels = f'upstream="marzban",operation="GET user/{{username}}",node="{marzban_service.MARZBAN_DEFAULT_NODE}"'
+    assert f'upstream_request_duration_seconds_count{{{labels},outcome="ok"}} 1' in body
+    assert f'upstream_request_duration_seconds_count{{{labels},outcome="404"}} 1' in body
+    assert "alice" not in body
+    metrics.reset_metrics()
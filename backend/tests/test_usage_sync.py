@@ -0,0 +1,317 @@
+import json
+import pytest
+import respx
+from httpx import Response
+
+# Add the parent directory to the path to allow imports from 'app'
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import models
+from app.database import SessionLocal
+from app.services import marzban_service, usage_sync_service
+
+# Mark all tests in this file as async
+pytestmark = pytest.mark.asyncio
+
+MARZBAN_TEST_URL = "https://marzban.test"
+
+
+@pytest.fixture
+def sync_db(monkeypatch):
+    """
+    Creates an admin, a plan and three VPN users, and points the Marzban service at a fake panel.
+    The rows are removed again after the test.
+    """
+    node = marzban_service.MarzbanNode(marzban_service.MARZBAN_DEFAULT_NODE, MARZBAN_TEST_URL, "sudo", "secret")
+    node.auth_cache = {"token": "tok", "expires_at": 2**40}
+    monkeypatch.setitem(marzban_service._nodes, marzban_service.MARZBAN_DEFAULT_NODE, node)
+    monkeypatch.setattr(usage_sync_service, "_page_sizes", {})
+
+    db = SessionLocal()
+    admin = models.Admin(username="sync-admin", email="sync@admin.com", hashed_password="x")
+    plan = models.Plan(name="sync-plan", price=1000, duration_days=30, data_limit_gb=10)
+    db.add_all([admin, plan])
+    db.commit()
+    for name in ("sync-u1", "sync-u2", "sync-u3"):
+        db.add(models.VpnUser(marzban_username=name, admin_id=admin.id, plan_id=plan.id))
+    db.commit()
+    yield db
+
+    db.query(models.VpnUser).filter(models.VpnUser.admin_id == admin.id).delete()
+    db.delete(plan)
+    db.delete(admin)
+    db.commit()
+    db.close()
+
+
+def _marzban_user(username: str, used: int) -> dict:
+    return {"username": username, "status": "active", "used_traffic": used,
+            "data_limit": 10 * 1024 ** 3, "expire": 1900000000, "subscription_url": f"https://sub/{username}"}
+
+
+@respx.mock
+async def test_sync_marzban_usage_pages_and_updates_snapshot(sync_db):
+    """
+    Tests that the sync pages through Marzban users and writes the usage snapshot
+    for users that belong to our panel, ignoring the ones that don't.
+    """
+    users_route = respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(
+        side_effect=[
+            Response(200, json={"users": [_marzban_user("sync-u1", 100), _marzban_user("not-ours", 5)], "total": 3}),
+            Response(200, json={"users": [_marzban_user("sync-u2", 200)], "total": 3}),
+        ]
+    )
+
+    stats = await usage_sync_service.sync_marzban_usage(page_size=2)
+
+    assert users_route.call_count == 2
+    assert stats["scanned"] == 3
+    assert stats["written"] == 2
+
+    sync_db.expire_all()
+    u1 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u1").one()
+    u3 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u3").one()
+    assert u1.used_traffic == 100
+    assert u1.subscription_url == "https://sub/sync-u1"
+    assert usage_sync_service.is_snapshot_fresh(u1)
+    assert u3.usage_synced_at is None
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_sync_marzban_usage_writes_only_changed_rows(sync_db):
+    """
+    Tests that a second cycle only writes the users whose usage changed.
+    """
+    respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(
+        side_effect=[
+            Response(200, json={"users": [_marzban_user("sync-u1", 100), _marzban_user("sync-u2", 200)], "total": 2}),
+            Response(200, json={"users": [_marzban_user("sync-u1", 100), _marzban_user("sync-u2", 250)], "total": 2}),
+        ]
+    )
+
+    first = await usage_sync_service.sync_marzban_usage(page_size=10)
+    second = await usage_sync_service.sync_marzban_usage(page_size=10)
+
+    assert first["written"] == 2
+    assert second["scanned"] == 2
+    assert second["written"] == 1
+
+    sync_db.expire_all()
+    u2 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u2").one()
+    assert u2.used_traffic == 250
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_sync_rewrites_rows_changed_by_another_writer(sync_db):
+    """
+    Tests that the sync compares against the fingerprint in the DB, so a row written
+    elsewhere in between (another worker, a live lookup) is corrected by the next cycle.
+    """
+    respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(
+        return_value=Response(200, json={"users": [_marzban_user("sync-u1", 100)], "total": 1})
+    )
+    first = await usage_sync_service.sync_marzban_usage(page_size=10)
+    assert first["written"] == 1
+
+    sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u1").update(
+        {"used_traffic": 5, "usage_fingerprint": "written-elsewhere"}
+    )
+    sync_db.commit()
+
+    second = await usage_sync_service.sync_marzban_usage(page_size=10)
+    assert second["written"] == 1
+
+    sync_db.expire_all()
+    u1 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u1").one()
+    assert u1.used_traffic == 100
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_failed_node_does_not_mark_its_snapshots_fresh(sync_db, monkeypatch):
+    """
+    Tests that a sync where one node fails only vouches for the unchanged snapshots of the
+    node that synced, so users on the failed node are looked up live again.
+    """
+    from datetime import datetime, timedelta
+
+    node_b = marzban_service.MarzbanNode("node-b", "https://marzban-b.test", "sudo", "secret")
+    node_b.auth_cache = {"token": "tok", "expires_at": 2**40}
+    monkeypatch.setitem(marzban_service._nodes, "node-b", node_b)
+    synced_long_ago = datetime.utcnow() - timedelta(hours=1)
+    sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u2").update({"marzban_node": "node-b"})
+    sync_db.query(models.VpnUser).update({"usage_synced_at": synced_long_ago, "usage_fingerprint": usage_sync_service.usage_fingerprint(
+        usage_sync_service.snapshot_from_marzban(_marzban_user("sync-u1", 1)))})
+    sync_db.commit()
+    respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(return_value=Response(200, json={"users": [_marzban_user("sync-u1", 1)], "total": 1}))
+    respx.get("https://marzban-b.test/api/users").mock(return_value=Response(500, json={"detail": "boom"}))
+
+    stats = await usage_sync_service.sync_marzban_usage()
+    assert "error" in stats["nodes"]["node-b"]
+    assert stats["written"] == 0
+
+    sync_db.expire_all()
+    on_default = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u1").one()
+    on_node_b = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u2").one()
+    assert usage_sync_service.is_snapshot_fresh(on_default)
+    assert not usage_sync_service.is_snapshot_fresh(on_node_b)
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_user_missing_from_marzban_is_not_marked_fresh(sync_db):
+    """
+    Tests that a user who disappeared from Marzban between two syncs is not vouched for by
+    the second sync, even though the node synced completely.
+    """
+    from datetime import datetime, timedelta
+
+    respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(
+        side_effect=[
+            Response(200, json={"users": [_marzban_user("sync-u1", 100), _marzban_user("sync-u2", 200)], "total": 2}),
+            Response(200, json={"users": [_marzban_user("sync-u1", 100)], "total": 1}),
+        ]
+    )
+    await usage_sync_service.sync_marzban_usage(page_size=10)
+    checked_long_ago = datetime.utcnow() - timedelta(hours=1)
+    sync_db.query(models.VpnUser).update({"usage_synced_at": checked_long_ago, "usage_checked_at": checked_long_ago})
+    sync_db.commit()
+
+    stats = await usage_sync_service.sync_marzban_usage(page_size=10)
+    assert stats["written"] == 0
+
+    sync_db.expire_all()
+    u1 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u1").one()
+    u2 = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "sync-u2").one()
+    assert usage_sync_service.is_snapshot_fresh(u1) # Seen unchanged, so only marked as checked
+    assert u1.used_traffic == 100
+    assert not usage_sync_service.is_snapshot_fresh(u2)
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_import_marzban_users_maps_plans_and_skips_existing(sync_db):
+    """
+    Tests that the import maps users to plans by data limit, skips users already in the panel,
+    reports unmapped users, and only writes when dry_run is off.
+    """
+    from app import schemas
+    from app.services import import_service, node_service
+
+    # Marzban's timestamps carry no offset and are UTC, whatever the local time zone
+    import time
+    from datetime import datetime, timezone
+    expire = int(datetime(2030, 1, 1, tzinfo=timezone.utc).timestamp()) + 30 * 86400
+    previous_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Asia/Tehran"
+    time.tzset()
+    try:
+        assert import_service._user_duration_days({"expire": expire, "created_at": "2030-01-01T00:00:00"}) == 30
+    finally:
+        if previous_tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = previous_tz
+        time.tzset()
+
+    admin = sync_db.query(models.Admin).filter(models.Admin.username == "sync-admin").one()
+    plan = sync_db.query(models.Plan).filter(models.Plan.name == "sync-plan").one()
+    small_user = {**_marzban_user("new-small", 0), "data_limit": 5 * 1024 ** 3}
+    respx.get(f"{MARZBAN_TEST_URL}/api/users").mock(
+        side_effect=lambda request: Response(200, json=(
+            {"users": [_marzban_user("sync-u1", 1), _marzban_user("new-a", 7)], "total": 3}
+            if request.url.params["offset"] == "0" else
+            {"users": [small_user], "total": 3}
+        ))
+    )
+    import_in = schemas.MarzbanImportRequest(admin_id=admin.id, page_size=2)
+    plans = await import_service.validate_import_request(import_in)
+
+    dry_run = [progress async for progress in import_service.import_marzban_users(import_in, plans)]
+    summary = dry_run[-1]
+    assert (summary["scanned"], summary["mapped"], summary["unmapped"]) == (3, 2, 1)
+    assert (summary["inserted"], summary["already_present"]) == (1, 1)
+    assert summary["unmapped_usernames"] == ["new-small"]
+    assert sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "new-a").count() == 0
+
+    import_in.dry_run = False
+    import_in.default_plan_id = plan.id
+    node_service._loads["stale"] = 0
+    summary = [progress async for progress in import_service.import_marzban_users(import_in, plans)][-1]
+    assert (summary["inserted"], summary["already_present"], summary["unmapped"]) == (2, 1, 0)
+    assert "stale" not in node_service._loads # Placement recounts the nodes' users after the import
+
+    sync_db.expire_all()
+    new_a = sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username == "new-a").one()
+    assert (new_a.admin_id, new_a.plan_id, new_a.used_traffic) == (admin.id, plan.id, 7)
+    await marzban_service.close_marzban_clients()
+
+
+@respx.mock
+async def test_enforcement_sweep_deactivates_expired_and_over_quota_users(sync_db):
+    """
+    Tests that a sweep deactivates expired and over-quota users in batches and queues disabling
+    them in Marzban, that the next sweep only looks at snapshots synced since the last one, and
+    that resetting the traffic activates the over-quota user again.
+    """
+    from datetime import datetime, timedelta
+    from app.services import enforcement_service, outbox_service
+
+    users = {u.marzban_username: u for u in sync_db.query(models.VpnUser).filter(models.VpnUser.marzban_username.like("sync-u%"))}
+    users["sync-u1"].expires_at = datetime.utcnow() - timedelta(minutes=1)
+    users["sync-u2"].used_traffic, users["sync-u2"].data_limit = 11, 10
+    users["sync-u2"].usage_synced_at = users["sync-u3"].usage_synced_at = datetime.utcnow()
+    users["sync-u3"].used_traffic, users["sync-u3"].data_limit = 5, 10
+    sync_db.commit()
+
+    first = await enforcement_service.sweep_once()
+    assert first["expired"] >= 1 and first["over_quota"] >= 1
+    sync_db.expire_all()
+    assert [users[name].is_active for name in ("sync-u1", "sync-u2", "sync-u3")] == [False, False, True]
+    queued = sync_db.query(models.MarzbanOutbox).filter(models.MarzbanOutbox.operation == outbox_service.OP_MODIFY_USER)
+    assert sorted(entry.marzban_username for entry in queued) == ["sync-u1", "sync-u2"]
+
+    disable_route = respx.put(url__regex=rf"{MARZBAN_TEST_URL}/api/user/sync-u[12]").mock(
+        return_value=Response(200, json=_marzban_user("sync-u1", 0) | {"status": "disabled"})
+    )
+    assert (await outbox_service.process_outbox_once())["done"] == 2
+    assert disable_route.call_count == 2
+    assert disable_route.calls[0].request.content == b'{"status": "disabled"}'
+
+    # Nothing changed since: the second sweep only rescans the overlap window, and deactivates nobody
+    second = await enforcement_service.sweep_once()
+    assert (second["expired"], second["over_quota"]) == (0, 0)
+
+    # Resetting the traffic activates the over-quota user again (in Marzban too); the expired one stays off
+    from httpx import AsyncClient
+    from app.main import app
+    from app.security import get_current_admin
+    respx.post(url__regex=rf"{MARZBAN_TEST_URL}/api/user/sync-u[12]/reset").mock(return_value=Response(200, json={}))
+    admin = sync_db.query(models.Admin).filter(models.Admin.username == "sync-admin").one()
+    previous_override = app.dependency_overrides.get(get_current_admin)
+    app.dependency_overrides[get_current_admin] = lambda: admin
+    try:
+        async with AsyncClient(app=app, base_url="http://test") as client:
+            response = await client.post("/api/v1/admin/vpnusers/bulk/reset-traffic", json={"usernames": ["sync-u1", "sync-u2"]})
+    finally:
+        if previous_override is None:
+            app.dependency_overrides.pop(get_current_admin)
+        else:
+            app.dependency_overrides[get_current_admin] = previous_override
+    assert json.loads(response.text.splitlines()[-1])["succeeded"] == 2
+    sync_db.expire_all()
+    assert [users[name].is_active for name in ("sync-u1", "sync-u2")] == [False, True]
+    assert (users["sync-u2"].disabled_reason, users["sync-u2"].used_traffic) == (None, 0)
+    assert (await outbox_service.process_outbox_once())["done"] == 1
+    assert disable_route.calls[-1].request.content == b'{"status": "active"}'
+    third = await enforcement_service.sweep_once()
+    assert third["over_quota"] == 0
+
+    sync_db.query(models.MarzbanOutbox).filter(models.MarzbanOutbox.marzban_username.like("sync-u%")).delete(synchronize_session=False)
+    sync_db.query(models.SchedulerLease).delete()
+    sync_db.commit()
+    await marzban_service.close_marzban_clients()
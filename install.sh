@@ -279,6 +279,9 @@ After=network.target
 User=root
 Group=www-data
 WorkingDirectory=$PROJECT_DIR/backend
+# Workers share their metrics through this directory; systemd empties it on every (re)start
+RuntimeDirectory=vpnpanel-metrics
+Environment=METRICS_MULTIPROC_DIR=/run/vpnpanel-metrics
 # ExecStart uses the full path to gunicorn inside the venv
 ExecStart=$PROJECT_DIR/backend/venv/bin/gunicorn -w 4 -k uvicorn.workers.UvicornWorker -b 127.0.0.1:8000 app.main:app
 